@@ -0,0 +1,124 @@
+# query plan regression check for the database lookups used by the pipeline and the data viewer
+# every lookup is executed against a temporary database, and "EXPLAIN QUERY PLAN" is run for each SELECT statement it issues.
+# a lookup fails the check if any of its statements has to scan a whole table instead of using an index
+#
+# usage: python3 code/benchmarks/check_query_plans.py [--db path/to/db.sqlite]
+import os
+import sys
+import argparse
+import tempfile
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+
+sys.path.insert(0, parentdir)
+from common import database
+
+# lookups that must use an index
+def get_lookups(db):
+    return [
+        ("get_participant_id(study_id)", lambda: db.get_participant_id(study_id="sub-M001")),
+        ("get_participant_id(deidentified_id)", lambda: db.get_participant_id(deidentified_id="sub-D001")),
+        ("get_participant_data(id)", lambda: db.get_participant_data(id=1)),
+        ("get_mri_session_id(data_file)", lambda: db.get_mri_session_id(data_file="session_1.zip")),
+        ("get_mri_session_id(data_file, archived)", lambda: db.get_mri_session_id(data_file="session_0.zip")),
+        ("get_mri_session_data(id)", lambda: db.get_mri_session_data(id=1)),
+        ("get_mri_session_data(participant_id)", lambda: db.get_mri_session_data(participant_id=1)),
+        ("get_mri_series_data(session_id)", lambda: db.get_mri_series_data(session_id=1)),
+        ("get_mri_series_data(session_id, series_number)", lambda: db.get_mri_series_data(session_id=1, series_number=1)),
+        ("find_duplicate_series_in_session", lambda: db.find_duplicate_series_in_session(session_id=1)),
+        ("find_mri_sessions_with_missing_summary", lambda: db.find_mri_sessions_with_missing_summary(exclude_skipped=True)),
+        ("find_mri_sessions_requiring_data_download", lambda: db.find_mri_sessions_requiring_data_download(exclude_skipped=True)),
+        ("find_mri_sessions_requiring_summary_download", lambda: db.find_mri_sessions_requiring_summary_download(exclude_skipped=True)),
+        ("find_mri_sessions_requiring_first_notification", lambda: db.find_mri_sessions_requiring_first_notification(exclude_skipped=True)),
+        ("find_mri_sessions_requiring_reminder_notification", lambda: db.find_mri_sessions_requiring_reminder_notification(exclude_skipped=True)),
+        ("find_mri_sessions_requiring_conversion_to_nifti", lambda: db.find_mri_sessions_requiring_conversion_to_nifti(exclude_skipped=True)),
+        ("find_mri_sessions_requiring_data_validation", lambda: db.find_mri_sessions_requiring_data_validation(exclude_skipped=True)),
+        ("find_mri_sessions_requiring_data_validation_with_summary", lambda: db.find_mri_sessions_requiring_data_validation_with_summary(exclude_skipped=True)),
+        ("find_mri_sessions_requiring_conversion_to_bids", lambda: db.find_mri_sessions_requiring_conversion_to_bids(exclude_skipped=True)),
+        ("find_mri_sessions_requiring_upload", lambda: db.find_mri_sessions_requiring_upload(exclude_skipped=True)),
+        ("count_mri_sessions_by_stage", lambda: db.count_mri_sessions_by_stage(exclude_skipped=True)),
+        ("get_mri_session_stages(stage)", lambda: db.get_mri_session_stages(stage=("conversion_to_nifti", "upload"), exclude_skipped=True)),
+        ("get_mri_session_stages(ids)", lambda: db.get_mri_session_stages(ids=(1,), exclude_skipped=True)),
+        ("get_mri_sessions_with_participants(stage)", lambda: db.get_mri_sessions_with_participants(stage="conversion_to_bids", exclude_skipped=True, include_series=True)),
+        ("get_mri_sessions_page", lambda: db.get_mri_sessions_page(page_size=2, cursor={"value": 0, "id": 1}, include_series=True)),
+        ("get_mri_sessions_page(stage)", lambda: db.get_mri_sessions_page(page_size=2, stage="conversion_to_bids", exclude_skipped=True)),
+        ("get_participants_page", lambda: db.get_participants_page(page_size=2, cursor={"value": 1, "id": 1})),
+        ("search", lambda: db.search("sub-M00")),
+        ("search(include_archived)", lambda: db.search("sub-M00", include_archived=True)),
+        ("get_mri_session_data(participant_id, include_archived)", lambda: db.get_mri_session_data(participant_id=1, include_archived=True)),
+        ("get_participants_page(study_id)", lambda: db.get_participants_page(page_size=2, sort_column="study_id", cursor={"value": "sub-M001", "id": 1})),
+    ]
+
+# check if a step of the query plan reads a full table
+def is_full_scan(step):
+    return step.startswith("SCAN") and ("INDEX" not in step)
+
+# run check for all lookups. Returns the number of lookups failing the check
+def check_query_plans(db):
+
+    n_failed = 0
+    for label, lookup in get_lookups(db):
+
+        # collect all statements issued by this lookup
+        statements = []
+        db.trace_statements(statements.append)
+        res = lookup()
+        db.trace_statements(None)
+        if res == -1:
+            print("ERROR    " + label + ": lookup failed")
+            n_failed = n_failed+1
+            continue
+
+        # get query plan of each SELECT statement
+        full_scans = []
+        for statement in statements:
+            if not statement.lstrip().upper().startswith("SELECT"):
+                continue
+            plan = db.explain_query_plan(statement)
+            if plan == -1:
+                full_scans.append("could not get query plan for: " + statement)
+                continue
+            for step in plan:
+                if is_full_scan(step):
+                    full_scans.append(step)
+
+        if len(full_scans) > 0:
+            print("FAIL     " + label + ": " + "; ".join(full_scans))
+            n_failed = n_failed+1
+        else:
+            print("OK       " + label)
+
+    return n_failed
+
+# fill database with a few records
+def populate_database(db):
+    participant_id = db.add_participant(study_id="sub-M001", deidentified_id="sub-D001", group_assignment="patient")
+    for i in range(1, 4):
+        session_id = db.add_mri_session(participant_id=participant_id, participant_session_id="ses-0" + str(i), data_file="session_" + str(i) + ".zip")
+        for series_number in range(1, 4):
+            db.add_mri_series(participant_id=participant_id, session_id=session_id, series_number=series_number)
+    db.commit()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check that database lookups use indexes.")
+    parser.add_argument("--db", default=None, help="check an existing database instead of a temporary one")
+    args = parser.parse_args()
+
+    if args.db != None:
+        db = database.db(args.db)
+        n_failed = check_query_plans(db)
+        db.close()
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = database.db(os.path.join(tmp_dir, "db.sqlite"))
+            populate_database(db)
+            n_failed = check_query_plans(db)
+            db.close()
+
+    if n_failed > 0:
+        print(str(n_failed) + " lookup(s) not using an index.")
+        sys.exit(1)
+
+    print("All lookups use an index.")
@@ -0,0 +1,78 @@
+# benchmark for writing the series of MRI sessions to the database
+# compares adding and updating series one at a time (committing after every series, as the stage scripts used to do)
+# with the bulk methods "add_mri_series_many" and "update_mri_series_many" (one transaction per session)
+#
+# usage: python3 code/benchmarks/db_bulk_write_benchmark.py [--sessions N] [--series N]
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+
+sys.path.insert(0, parentdir)
+from common import database
+
+# add and update series one at a time
+def write_series_individually(db, participant_id, session_id, n_series):
+
+    series_ids = []
+    for series_number in range(1, n_series+1):
+        series_id = db.add_mri_series(participant_id=participant_id, session_id=session_id, series_number=series_number, description="series " + str(series_number))
+        series_ids.append(series_id)
+        db.commit()
+
+    for series_id in series_ids:
+        db.update_mri_series(id=series_id, files_validated_dt=time.time(), files_valid=True, number_files=100)
+        db.commit()
+
+# add and update all series of a session at once
+def write_series_in_bulk(db, participant_id, session_id, n_series):
+
+    new_series = []
+    for series_number in range(1, n_series+1):
+        new_series.append({"participant_id": participant_id, "session_id": session_id, "series_number": series_number, "description": "series " + str(series_number)})
+    series_ids = db.add_mri_series_many(new_series)
+    db.commit()
+
+    series_updates = []
+    for series_id in series_ids:
+        series_updates.append({"id": series_id, "files_validated_dt": time.time(), "files_valid": True, "number_files": 100})
+    db.update_mri_series_many(series_updates)
+    db.commit()
+
+# run one benchmark configuration
+def run_benchmark(label, write_function, journal_mode, n_sessions, n_series):
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = database.db(os.path.join(tmp_dir, "db.sqlite"), journal_mode=journal_mode)
+        participant_id = db.add_participant(study_id="sub-M001", deidentified_id="sub-D001", group_assignment="patient")
+        db.commit()
+
+        durations = []
+        for i in range(n_sessions):
+            session_id = db.add_mri_session(participant_id=participant_id, data_file="session_" + str(i) + ".zip")
+            db.commit()
+
+            t_start = time.perf_counter()
+            write_function(db, participant_id, session_id, n_series)
+            durations.append(time.perf_counter()-t_start)
+
+        db.close()
+
+    # report results
+    print(label + " (journal mode: " + journal_mode + ")")
+    print("  mean time per session: " + "{:.2f}".format(1000*sum(durations)/len(durations)) + " ms")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare individual and bulk writes of MRI series.")
+    parser.add_argument("--sessions", type=int, default=5, help="number of MRI sessions to write")
+    parser.add_argument("--series", type=int, default=200, help="number of series per session")
+    args = parser.parse_args()
+
+    for journal_mode in ("wal", "delete"):
+        run_benchmark("One series at a time", write_series_individually, journal_mode, args.sessions, args.series)
+        run_benchmark("Bulk write per session", write_series_in_bulk, journal_mode, args.sessions, args.series)
@@ -0,0 +1,129 @@
+# multi-process stress benchmark for concurrent database access
+# a writer process repeatedly updates MRI sessions in short transactions (similar to a pipeline stage),
+# while several reader processes open the database and run typical data viewer queries.
+# the benchmark reports the latency observed by the readers while the writer is active
+#
+# usage: python3 code/benchmarks/db_concurrency_benchmark.py [--readers N] [--duration S] [--sessions N]
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import multiprocessing
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+
+sys.path.insert(0, parentdir)
+from common import database
+
+# fill database with dummy data
+def populate_database(db_file, n_sessions, journal_mode):
+
+    db = database.db(db_file, journal_mode=journal_mode)
+    participant_id = db.add_participant(study_id="sub-M001", deidentified_id="sub-D001", group_assignment="patient")
+    for i in range(n_sessions):
+        session_id = db.add_mri_session(participant_id=participant_id,
+                                        participant_session_id="ses-01",
+                                        data_file="session_" + str(i) + ".zip",
+                                        description="session " + str(i),
+                                        data_recorded_dt=time.time())
+        for series_number in range(1, 11):
+            db.add_mri_series(participant_id=participant_id, session_id=session_id, series_number=series_number, description="series " + str(series_number))
+    db.commit()
+    db.close()
+
+# writer: update sessions in short transactions for the given duration
+def run_writer(db_file, journal_mode, use_file_lock, duration, n_sessions, ready_event):
+
+    db = database.db(db_file, journal_mode=journal_mode, use_file_lock=use_file_lock)
+    ready_event.set()
+
+    n_writes = 0
+    t_end = time.perf_counter() + duration
+    while time.perf_counter() < t_end:
+        session_id = (n_writes % n_sessions) + 1
+        db.update_mri_session(session_id, data_downloaded_dt=time.time())
+        db.commit()
+        n_writes = n_writes+1
+
+        # simulate processing work between database updates (e.g. running dcm2niix)
+        time.sleep(0.01)
+
+    db.close()
+
+# reader: open database, run typical viewer queries, close database. Report latency of each iteration
+def run_reader(db_file, journal_mode, use_file_lock, duration, n_sessions, results):
+
+    latencies = []
+    n_errors = 0
+    t_end = time.perf_counter() + duration
+    i = 0
+    while time.perf_counter() < t_end:
+        t_start = time.perf_counter()
+
+        db = database.db(db_file, journal_mode=journal_mode, use_file_lock=use_file_lock)
+        sessions = db.get_all_mri_session_data(sort_column="data_recorded_dt", sort_dir="descending")
+        session_series = db.get_mri_series_data(session_id=(i % n_sessions) + 1)
+        db.close()
+
+        if (sessions == -1) or (session_series == -1):
+            n_errors = n_errors+1
+        latencies.append(time.perf_counter()-t_start)
+        i = i+1
+
+    results.put({"latencies": latencies, "n_errors": n_errors})
+
+# run one benchmark configuration
+def run_benchmark(label, journal_mode, use_file_lock, n_readers, duration, n_sessions):
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, "db.sqlite")
+        populate_database(db_file, n_sessions, journal_mode)
+
+        ready_event = multiprocessing.Event()
+        results = multiprocessing.Queue()
+
+        writer = multiprocessing.Process(target=run_writer, args=(db_file, journal_mode, use_file_lock, duration, n_sessions, ready_event))
+        writer.start()
+        ready_event.wait()
+
+        readers = []
+        for i in range(n_readers):
+            reader = multiprocessing.Process(target=run_reader, args=(db_file, journal_mode, use_file_lock, duration, n_sessions, results))
+            reader.start()
+            readers.append(reader)
+
+        latencies = []
+        n_errors = 0
+        for reader in readers:
+            res = results.get()
+            latencies.extend(res["latencies"])
+            n_errors = n_errors + res["n_errors"]
+
+        for reader in readers:
+            reader.join()
+        writer.join()
+
+    # report results
+    latencies_ms = sorted([latency*1000 for latency in latencies])
+    print(label)
+    if len(latencies_ms) < 1:
+        print("  no reads completed")
+        return
+    print("  reads completed: " + str(len(latencies_ms)) + " (errors: " + str(n_errors) + ")")
+    print("  median latency:  " + "{:.2f}".format(statistics.median(latencies_ms)) + " ms")
+    print("  95th percentile: " + "{:.2f}".format(latencies_ms[int(0.95*(len(latencies_ms)-1))]) + " ms")
+    print("  max latency:     " + "{:.2f}".format(latencies_ms[-1]) + " ms")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure database read latency while a writer is active.")
+    parser.add_argument("--readers", type=int, default=4, help="number of reader processes")
+    parser.add_argument("--duration", type=float, default=5, help="duration of each run (in s)")
+    parser.add_argument("--sessions", type=int, default=500, help="number of MRI sessions in the test database")
+    args = parser.parse_args()
+
+    run_benchmark("WAL mode, lock only during schema setup", "wal", False, args.readers, args.duration, args.sessions)
+    run_benchmark("Rollback journal, lock held by writer (legacy behavior)", "delete", True, args.readers, args.duration, args.sessions)
@@ -0,0 +1,126 @@
+# benchmark for the stage scheduler of the MRI pipeline (see "common/stage_scheduler.py")
+# sessions pass through dummy stages that wait for an external program ("sleep") like the real stages wait for dcm2niix,
+# dcm2bids or pydeface. One session is much slower to extract than the others. The benchmark compares the time until all
+# sessions are uploaded when the stages are run one after the other (like the stage scripts) and when they are run by the scheduler
+#
+# usage: python3 code/benchmarks/stage_scheduler_benchmark.py [--sessions N] [--workers N] [--duration S]
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+
+sys.path.insert(0, parentdir)
+from common import database_settings
+from common import pipeline_context
+from common import stage_scheduler
+
+# fill database with sessions that were downloaded and whose participant and session IDs were validated
+def populate_database(db, n_sessions):
+
+    participant_id = db.add_participant(study_id="sub-M001", deidentified_id="sub-D001", group_assignment="patient")
+    for i in range(n_sessions):
+        db.add_mri_session(participant_id=participant_id,
+                           participant_session_id="ses-" + str(i+1).zfill(2),
+                           data_file="session_" + str(i) + ".zip",
+                           description="session " + str(i),
+                           data_recorded_dt=time.time(),
+                           data_downloaded_dt=time.time(),
+                           study_id_validated_dt=time.time(),
+                           session_id_validated_dt=time.time())
+    db.commit()
+
+# create dummy stage: waits for the given time (the first session waits "slow_factor" times as long) and then updates the session
+def create_stage(duration_s, slow_factor, **session_update):
+
+    def prepare(context):
+        return {}
+
+    def process_session(context, state, session):
+        db = context.get_db()
+        wait_s = duration_s*slow_factor if session["data_file"] == "session_0.zip" else duration_s
+        subprocess.run(["sleep", str(wait_s)])
+        db.update_mri_session(session["id"], **{key: (time.time() if value == "now" else value) for key, value in session_update.items()})
+        db.commit()
+
+    return prepare, process_session
+
+# stages of the benchmark: name, value of the "stage" column of sessions waiting for the stage, and dummy stage
+def create_stages(duration_s):
+    return (("conversion_to_nifti", "conversion_to_nifti", create_stage(duration_s, 5, converted_to_nifti_dt="now")),
+            ("data_validation", "data_validation", create_stage(duration_s/10, 1, conversion_validated_dt="now", conversion_valid=True)),
+            ("data_validation_with_summary", "data_validation_with_summary", create_stage(duration_s/10, 1, conversion_validated_with_summary_dt="now")),
+            ("conversion_to_bids", "conversion_to_bids", create_stage(duration_s, 1, data_converted_dt="now")),
+            ("upload", "upload", create_stage(duration_s/2, 1, data_uploaded_dt="now")))
+
+# create pipeline context using a temporary database
+def create_context(tmp_dir):
+
+    settings_db = database_settings._init()
+    settings_db["db_path"] = os.path.join(tmp_dir, "db.sqlite")
+
+    context = pipeline_context.pipeline_context()
+    context.set_settings("database", settings_db)
+    context.set_settings("notification", {"errors": {"send_notification": False}})
+
+    return context
+
+# run the stages one after the other, each processing all sessions waiting for it
+def run_serial(context, stages):
+
+    db = context.get_db()
+    for name, db_stage, (prepare, process_session) in stages:
+        state = prepare(context)
+        sessions = db.get_mri_sessions_with_participants(stage=db_stage)
+        for session in sessions:
+            process_session(context, state, session)
+
+# run the stages with the scheduler
+def run_scheduled(context, stages, tmp_dir, max_workers):
+
+    scheduler = stage_scheduler.stage_scheduler(context, max_workers=max_workers)
+    for name, db_stage, (prepare, process_session) in stages:
+        scheduler.add_stage(name, db_stage, name + ".py", os.path.join(tmp_dir, name + "_log.txt"), (name, ),
+                            prepare, process_session, max_workers=max_workers)
+    if not scheduler.run():
+        print("ERROR: The scheduler reported errors.")
+
+# run benchmark in the given mode and return the time until all sessions were uploaded
+def run_benchmark(mode, n_sessions, max_workers, duration_s):
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        context = create_context(tmp_dir)
+        db = context.get_db()
+        populate_database(db, n_sessions)
+
+        stages = create_stages(duration_s)
+        start_time = time.monotonic()
+        if mode == "serial":
+            run_serial(context, stages)
+        else:
+            run_scheduled(context, stages, tmp_dir, max_workers)
+        total_s = time.monotonic() - start_time
+
+        # make sure all sessions were processed
+        session_stages = db.get_mri_session_stages()
+        n_complete = list(session_stages.values()).count("complete")
+        context.close()
+
+    return total_s, n_complete
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark of the stage scheduler of the MRI pipeline.")
+    parser.add_argument("--sessions", type=int, default=8, help="number of sessions")
+    parser.add_argument("--workers", type=int, default=4, help="number of workers of the scheduler")
+    parser.add_argument("--duration", type=float, default=0.5, help="time (in s) the extraction and conversion of a session take")
+    args = parser.parse_args()
+
+    print("Sessions: " + str(args.sessions) + ", workers: " + str(args.workers) + ", stage duration: " + str(args.duration) + " s")
+    for mode in ("serial", "scheduled"):
+        total_s, n_complete = run_benchmark(mode, args.sessions, args.workers, args.duration)
+        print("{:<10s} {:>8.2f} s  ({:d} of {:d} sessions complete)".format(mode, total_s, n_complete, args.sessions))
@@ -7,8 +7,9 @@ import json
 import paramiko
 import scp
 
-# get list of available files
-def get_sessions(host, data_folder, credentials_file):
+# open SSH connection to CBI Home, so it can be used for several queries and downloads (see "ssh_client" of "get_sessions" and "download_file")
+# the caller needs to close the returned client
+def connect(host, credentials_file):
 
     # get SSH credentials from file
     try:
@@ -33,6 +34,20 @@ def get_sessions(host, data_folder, credentials_file):
         print(e)
         return -1
     
+    return sshClient
+
+# get list of available files
+# ssh_client: connection opened with "connect". If None, a new connection is opened and closed again
+def get_sessions(host, data_folder, credentials_file, ssh_client=None):
+
+    # connect to server
+    if ssh_client == None:
+        sshClient = connect(host, credentials_file)
+        if sshClient == -1:
+            return -1
+    else:
+        sshClient = ssh_client
+    
     # query data and summary files
     data_files = []
     summary_files = []
@@ -77,38 +92,30 @@ def get_sessions(host, data_folder, credentials_file):
         return -1
     
     # close connection and clean up
-    sshClient.close()
     del stdin, stdout, stderr
-    del sshClient
+    if ssh_client == None:
+        sshClient.close()
+        del sshClient
     
     return {"data_files": data_files, "summary_files": summary_files}
 
 # download a file
-def download_file(filename, host, data_folder, credentials_file, destination_folder, show_progress=False):
+# ssh_client: connection opened with "connect". If None, a new connection is opened and closed again
+def download_file(filename, host, data_folder, credentials_file, destination_folder, show_progress=False, ssh_client=None):
 
-    # get SSH credentials from file
-    try:
-        if Path(credentials_file).exists:
-            with open(credentials_file, 'r') as f:
-                credentials = json.load(f)
-        else:
-            print("ERROR: Could not find credentials file.")
-            return -1
-    except Exception as e:
-        print("ERROR: Unable to load credentials file:\n")
-        print(e)
-        return -1
-    
     # check if destination folder exists
     if not os.path.exists(destination_folder):
         os.mkdir(destination_folder)
     
     # connect to server
-    try:
-        sshClient = paramiko.SSHClient()
-        sshClient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        sshClient.connect(host,username=credentials["user"],password=credentials["password"],timeout=10)
+    if ssh_client == None:
+        sshClient = connect(host, credentials_file)
+        if sshClient == -1:
+            return -1
+    else:
+        sshClient = ssh_client
 
+    try:
         if show_progress:
             scpClient = scp.SCPClient(sshClient.get_transport(), progress = scp_show_progress)
         else:
@@ -134,8 +141,10 @@ def download_file(filename, host, data_folder, credentials_file, destination_fol
 
     # close connection and clean up
     scpClient.close()
-    sshClient.close()
-    del sshClient, scpClient
+    del scpClient
+    if ssh_client == None:
+        sshClient.close()
+        del sshClient
 
     return 1
 
@@ -1,7 +1,127 @@
 # module with functions managing the MRI database
 import os
+import time
+from pathlib import Path
+import random
+import atexit
 import sqlite3
 from filelock import FileLock, Timeout
+from common import database_stats
+
+# processing stages of an MRI session, in the order in which they are executed
+# sessions that are waiting for manual validation of the participant and session IDs (or whose conversion was
+# not valid) are "on_hold", sessions that were uploaded are "complete"
+mri_session_stages = ("data_download",
+                      "conversion_to_nifti",
+                      "data_validation",
+                      "data_validation_with_summary",
+                      "conversion_to_bids",
+                      "upload",
+                      "complete",
+                      "on_hold")
+
+# expression used to derive the current stage of an MRI session from its timestamps (see "stage" column of the mri_sessions table)
+# the prefix is used to reference the columns of a specific row (e.g. "NEW." inside triggers)
+def mri_session_stage_expression(prefix=""):
+    return "CASE \
+        WHEN " + prefix + "data_downloaded_dt IS NULL THEN 'data_download' \
+        WHEN " + prefix + "converted_to_nifti_dt IS NULL THEN 'conversion_to_nifti' \
+        WHEN " + prefix + "conversion_validated_dt IS NULL THEN 'data_validation' \
+        WHEN " + prefix + "conversion_validated_with_summary_dt IS NULL THEN 'data_validation_with_summary' \
+        WHEN (" + prefix + "conversion_valid IS NOT 1) \
+            OR (" + prefix + "study_id_validated_dt IS NULL) OR (" + prefix + "session_id_validated_dt IS NULL) \
+            OR (" + prefix + "participant_id IS NULL) \
+            OR (" + prefix + "participant_session_id IS NULL) OR (" + prefix + "participant_session_id IS '') THEN 'on_hold' \
+        WHEN " + prefix + "data_converted_dt IS NULL THEN 'conversion_to_bids' \
+        WHEN " + prefix + "data_uploaded_dt IS NULL THEN 'upload' \
+        ELSE 'complete' END"
+
+# columns the stage of an MRI session depends on
+mri_session_stage_columns = ("data_downloaded_dt",
+                             "converted_to_nifti_dt",
+                             "conversion_validated_dt",
+                             "conversion_validated_with_summary_dt",
+                             "conversion_valid",
+                             "study_id_validated_dt",
+                             "session_id_validated_dt",
+                             "participant_id",
+                             "participant_session_id",
+                             "data_converted_dt",
+                             "data_uploaded_dt")
+
+# tables whose changes are recorded in the change_log table, together with the column stored as parent of each changed row
+# (e.g. the session of a changed series), so readers can tell which views need to be refreshed
+change_log_tables = {"participants": None,
+                     "mri_sessions": "participant_id",
+                     "mri_series": "session_id"}
+
+# tables storing archived records (uploaded sessions and their series), by the table the records are moved from
+# archived records have the same columns and keep their ids (see "archive_mri_sessions")
+archive_tables = {"mri_sessions": "mri_sessions_archive",
+                  "mri_series": "mri_series_archive"}
+
+# get SQL expression for the id of a new record of the given table (None to let SQLite assign the id)
+# records of tables with an archive get an id larger than the ids of all records in the table and its archive, so the ids of
+# archived records are never assigned to new records
+def new_record_id_expression(table_name):
+
+    if not table_name in archive_tables:
+        return None
+
+    return "(SELECT COALESCE(MAX(max_id), 0) + 1 FROM (SELECT MAX(id) AS max_id FROM " + table_name + " \
+            UNION ALL SELECT MAX(id) FROM " + archive_tables[table_name] + "))"
+
+# columns that can be used to sort the records of each table
+# sort columns are inserted into the SQL statements, so only these columns are accepted
+sortable_columns = {"participants": ("id", "study", "study_id", "deidentified_id", "group_assignment"),
+                    "mri_sessions": ("id", "study", "participant_id", "participant_session_id", "data_file", "description",
+                                     "data_recorded_date", "data_recorded_time", "data_recorded_dt", "data_downloaded_dt",
+                                     "converted_to_nifti_dt", "conversion_validated_dt", "conversion_valid", "study_id_validated_dt",
+                                     "session_id_validated_dt", "skip_processing", "data_converted_dt", "data_uploaded_dt", "stage"),
+                    "mri_series": ("id", "session_id", "series_number", "series_recorded_dt", "description", "number_files",
+                                   "files_valid", "skip_processing", "data_converted_dt")}
+for table_name, archive_table_name in archive_tables.items():
+    sortable_columns[archive_table_name] = sortable_columns[table_name]
+
+# statistics of the statements executed by all connections of this process (None if statement logging is disabled)
+statement_stats = None
+
+# enable statement logging, if requested in the database settings
+# the slow statement log and the statement summary are written next to the given log file (e.g. "log/extract_data_log.txt"
+# results in "log/extract_data_slow_statements.txt" and "log/extract_data_statement_summary.txt").
+# the summary is written when the process exits
+def enable_statement_log(settings, log_file_name):
+    global statement_stats
+
+    if (not settings["log_statements"]) or (statement_stats != None):
+        return
+    
+    log_file_prefix = str(log_file_name).removesuffix(".txt").removesuffix("_log")
+    statement_stats = database_stats.statement_stats(log_file_prefix + "_slow_statements.txt",
+                                                     log_file_prefix + "_statement_summary.txt",
+                                                     slow_statement_threshold_ms=settings["slow_statement_threshold_ms"])
+    atexit.register(statement_stats.write_summary)
+
+# open database connection using the parameters stored in the database settings
+# read_only: open a read-only connection (see "db" class constructor)
+def connect(settings, read_only=False):
+
+    connection = db(settings["db_path"],
+                    journal_mode=settings["journal_mode"],
+                    busy_timeout=settings["busy_timeout_s"],
+                    use_file_lock=settings["use_file_lock"],
+                    read_only=read_only)
+
+    # retry policy if the database is locked by another process
+    connection.retry_initial_delay_s = settings["retry_initial_delay_s"]
+    connection.retry_max_delay_s = settings["retry_max_delay_s"]
+    connection.retry_time_budget_s = settings["retry_time_budget_s"]
+
+    return connection
+
+# check if an exception was raised because the database is locked by another connection
+def is_lock_error(e):
+    return isinstance(e, sqlite3.OperationalError) and (("locked" in str(e)) or ("busy" in str(e)))
 
 class db:
 
@@ -9,49 +129,54 @@ class db:
     _cursor = None
     lastrowid = None
     _lock = None
+    _column_names = None
+    _stats = None
 
     # class constructor
-    def __init__(self, db_file):
-        
+    # journal_mode: SQLite journal mode. "wal" allows readers to access the database while another process is writing
+    # busy_timeout: time (in s) a statement waits for a competing transaction to finish before giving up
+    # use_file_lock: if True, an exclusive file lock is held for the whole lifetime of the connection (legacy behavior).
+    #                Otherwise, the lock is only held while the database schema is being migrated
+    # read_only: open the database in read-only mode. The connection never takes the file lock and never changes the schema.
+    #            If the database does not exist yet or its schema is outdated, it is set up with a temporary regular connection first
+    def __init__(self, db_file, journal_mode="wal", busy_timeout=30, use_file_lock=False, read_only=False):
+
         # initialize connection and cursor
         self._connection = None
         self._cursor = None
         self.lastrowid = None
+        self._lock = None
+        self._use_file_lock = use_file_lock and (not read_only)
+        self.read_only = read_only
+        self._column_names = {} # cached column names of each table
+        self._stats = statement_stats
 
         # create necessary folders, if they don't exist
         db_folder = os.path.dirname(db_file)
         if (len(db_folder)>0) and (not os.path.isdir(db_folder)):
             os.makedirs(db_folder, exist_ok=True)
 
-        # initialize file lock
-        self._locked = False
-        timeout = 5
-        try:
-            self._lock = FileLock(db_file + ".lock",timeout=0,mode=0o664)
-        except Timeout as te:
-                pass # will try again below
-        except Exception as e:
-            print("ERROR: Could not acquire database lock:")
-            print(e)
+        # initialize retry policy if the database is locked by another process (see "run_with_retry")
+        self.retry_initial_delay_s = 0.05
+        self.retry_max_delay_s = 2
+        self.retry_time_budget_s = 60
+
+        # if requested, hold an exclusive file lock for the whole lifetime of the connection
+        if self._use_file_lock and (not self.acquire_lock(db_file)):
             return
-        
-        while not self._lock.is_locked:
-            try:
-                self._lock.acquire(timeout=timeout)
-            except Timeout as te:
-                print("WARNING: Another process is currently accessing the database. Waiting for another " + str(timeout) + " s.")
-                continue
-            except Exception as e:
-                print("ERROR: Could not acquire database lock:")
-                print(e)
-                return
 
-        # initialize other attributes
-        self.n_default_query_attempts = 2
+        # a read-only connection can't create the database
+        if read_only and (not os.path.isfile(db_file)):
+            db(db_file, journal_mode=journal_mode, busy_timeout=busy_timeout).close()
 
         # open connection
+        # note: the timeout sets how long SQLite waits for a lock held by another connection before raising an error
         try:
-            self._connection = sqlite3.connect(db_file)
+            if read_only:
+                self._connection = sqlite3.connect(Path(db_file).resolve().as_uri() + "?mode=ro", timeout=busy_timeout, uri=True)
+            else:
+                self._connection = sqlite3.connect(db_file, timeout=busy_timeout)
+            self._connection.row_factory = sqlite3.Row # rows can be accessed by index or column name, and converted to dicts
             self._cursor = self._connection.cursor()
         except Exception as e:
             print("ERROR: Could not connect to database:")
@@ -59,93 +184,40 @@ class db:
             self._connection = None
             self._cursor = None
             self.lastrowid = None
+            self.release_lock()
             return
 
-        # make sure all tables are in the database
-        try:
-            # create studies table if it doesn't exist
-            self._cursor.execute("CREATE TABLE IF NOT EXISTS studies (\
-                                id INTEGER PRIMARY KEY, \
-                                title TEXT, \
-                                description TEXT);")
-            
-            # create participants table if it doesn't exist
-            self._cursor.execute("CREATE TABLE IF NOT EXISTS participants (\
-                                id INTEGER PRIMARY KEY, \
-                                study TEXT, \
-                                study_id TEXT, \
-                                deidentified_id TEXT, \
-                                group_assignment TEXT);")
-
-            # create mri sessions table if it doesn't exist
-            self._cursor.execute("CREATE TABLE IF NOT EXISTS mri_sessions (\
-                                id INTEGER PRIMARY KEY, \
-                                study TEXT, \
-                                participant_id INTEGER, \
-                                participant_session_id TEXT, \
-                                data_file TEXT, \
-                                summary_file TEXT, \
-                                description TEXT, \
-                                data_recorded_date TEXT, \
-                                data_recorded_time TEXT, \
-                                data_recorded_dt REAL, \
-                                data_downloaded_dt REAL, \
-                                notification_sent_dt REAL, \
-                                summary_downloaded_dt REAL, \
-                                converted_to_nifti_dt REAL, \
-                                conversion_validated_dt REAL, \
-                                conversion_validated_with_summary_dt REAL, \
-                                conversion_valid INTEGER, \
-                                study_id_validated_dt REAL, \
-                                session_id_validated_dt REAL, \
-                                skip_processing INTEGER, \
-                                data_converted_dt REAL, \
-                                data_uploaded_dt REAL);")
-
-            # create mri scans table if it doesn't exist
-            self._cursor.execute("CREATE TABLE IF NOT EXISTS mri_series (\
-                                id INTEGER PRIMARY KEY, \
-                                study TEXT, \
-                                participant_id INTEGER, \
-                                session_id INTEGER, \
-                                series_number INTEGER, \
-                                series_recorded_dt REAL, \
-                                description TEXT, \
-                                number_files INTEGER, \
-                                files_validated_dt REAL, \
-                                files_validated_with_summary_dt REAL, \
-                                files_valid INTEGER, \
-                                dcm2bids_criteria TEXT, \
-                                dcm2bids_criteria_in_config INTEGER, \
-                                duplicate_series TEXT, \
-                                skip_processing INTEGER, \
-                                data_converted_dt REAL);")
-            
-            # participants, mri_sessions and mri_series tables originally did not have the "study" column
-            # therefore, we need to check if it should be added
-            if not self.column_exists(table="participants", column="study"):
-                self._cursor.execute("ALTER TABLE participants ADD COLUMN study TEXT;")
-
-            if not self.column_exists(table="mri_sessions", column="study"):
-                self._cursor.execute("ALTER TABLE mri_sessions ADD COLUMN study TEXT;")
-
-            if not self.column_exists(table="mri_series", column="study"):
-                self._cursor.execute("ALTER TABLE mri_series ADD COLUMN study TEXT;")
-
-            # commit changes (just to be safe, this does not seem to be necessary but doesn't hurt)
-            self._connection.commit()
+        # a read-only connection only needs to make sure the schema is current
+        # the journal mode is stored in the database file, so it does not need to be set again
+        if read_only:
+            version = self.get_schema_version()
+            if (version != -1) and (version < len(self.get_schema_migrations())):
+                db(db_file, journal_mode=journal_mode, busy_timeout=busy_timeout).close()
+            return
 
-        except Exception as e:
-            print("ERROR: Could not initialize database:")
-            print(e)
+        # set journal mode
+        # in WAL mode, readers don't block writers and a writer doesn't block readers
+        if (journal_mode != None) and (journal_mode != ""):
+            res = self.execute("PRAGMA journal_mode=" + journal_mode + ";")
+            if (res == -1) or (res == None) or (len(res)<1) or (str(res[0][0]).lower() != journal_mode.lower()):
+                print("WARNING: Could not set database journal mode to \"" + journal_mode + "\".")
+            elif journal_mode.lower() == "wal":
+                # with WAL, a full sync on every commit is not necessary to keep the database consistent
+                self.execute("PRAGMA synchronous=NORMAL;")
+
+        # bring database schema up to date
+        if self.migrate_schema(db_file) == -1:
+            print("ERROR: Could not initialize database.")
+            self._connection.close()
             self._connection = None
             self._cursor = None
             self.lastrowid = None
+            self.release_lock()
             return
 
     # class destructor
     def __del__(self):
-        self.close()        
+        self.close()
 
     # close database connection
     def close(self):
@@ -155,14 +227,542 @@ class db:
         del self._cursor, self._connection
         self._connection = None
         self._cursor = None
-        self.lastrowid = None    
+        self.lastrowid = None
 
         # release lock
+        self.release_lock()
+
+    # acquire exclusive file lock
+    def acquire_lock(self, db_file):
+
+        timeout = 5
+        try:
+            self._lock = FileLock(db_file + ".lock",timeout=0,mode=0o664)
+        except Timeout as te:
+                pass # will try again below
+        except Exception as e:
+            print("ERROR: Could not acquire database lock:")
+            print(e)
+            self._lock = None
+            return False
+
+        while not self._lock.is_locked:
+            try:
+                self._lock.acquire(timeout=timeout)
+            except Timeout as te:
+                print("WARNING: Another process is currently accessing the database. Waiting for another " + str(timeout) + " s.")
+                continue
+            except Exception as e:
+                print("ERROR: Could not acquire database lock:")
+                print(e)
+                return False
+
+        return True
+
+    # release exclusive file lock
+    def release_lock(self):
+
+        if self._lock == None:
+            return
+
         while self._lock.is_locked:
-            self._lock.release()      
+            self._lock.release()
+
+
+    # get schema migrations
+    # each migration brings the schema from the previous version to the next one. The version of the database is stored in "PRAGMA user_version"
+    # note: new migrations must be added at the end of the list. Existing migrations must not be changed
+    def get_schema_migrations(self):
+        return [self.migrate_schema_to_version_1,
+                self.migrate_schema_to_version_2,
+                self.migrate_schema_to_version_3,
+                self.migrate_schema_to_version_4,
+                self.migrate_schema_to_version_5,
+                self.migrate_schema_to_version_6,
+                self.migrate_schema_to_version_7,
+                self.migrate_schema_to_version_8,
+                self.migrate_schema_to_version_9,
+                self.migrate_schema_to_version_10,
+                self.migrate_schema_to_version_11]
+
+    # get schema version of the database
+    def get_schema_version(self):
+
+        res = self.execute("PRAGMA user_version;")
+        if (res == -1) or (res == None) or (len(res)<1):
+            print("ERROR: Could not get database schema version.")
+            return -1
+        
+        return res[0][0]
+
+    # bring database schema up to date
+    # if the schema is current, no other statements are executed
+    def migrate_schema(self, db_file):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+        
+        # check schema version
+        migrations = self.get_schema_migrations()
+        version = self.get_schema_version()
+        if version == -1:
+            return -1
+        
+        if version > len(migrations):
+            print("WARNING: Database schema version (" + str(version) + ") is newer than the version supported by this application (" + str(len(migrations)) + ").")
+            return 1
+        
+        if version == len(migrations):
+            return 1
+        
+        # acquire file lock (needed to make sure only one process at a time migrates the database schema)
+        if (not self._use_file_lock) and (not self.acquire_lock(db_file)):
+            return -1
+        
+        try:
+            # lock database and check version again (another process may have migrated the schema in the meantime)
+            self._cursor.execute("BEGIN IMMEDIATE;")
+            version = self._cursor.execute("PRAGMA user_version;").fetchone()[0]
+
+            # run all outstanding migrations in a single transaction
+            for i in range(version, len(migrations)):
+                print("Migrating database schema to version " + str(i+1) + ".")
+                self._column_names = {}
+                migrations[i]()
+
+            self._cursor.execute("PRAGMA user_version = " + str(max(version, len(migrations))) + ";")
+            self._connection.commit()
+
+        except Exception as e:
+            print("ERROR: Could not migrate database schema:")
+            print(e)
+            if self._connection.in_transaction:
+                self._connection.rollback()
+            if not self._use_file_lock:
+                self.release_lock()
+            return -1
+
+        # the schema changed, so clear the cached column names
+        self._column_names = {}
+        
+        # schema is ready. Unless requested otherwise, release the lock so other processes can migrate the database
+        if not self._use_file_lock:
+            self.release_lock()
+
+        return 1
+
+    # schema version 1: tables
+    # databases created before schema versions were introduced have version 0, but already contain some or all of these tables
+    def migrate_schema_to_version_1(self):
+
+        # create studies table if it doesn't exist
+        self._cursor.execute("CREATE TABLE IF NOT EXISTS studies (\
+                            id INTEGER PRIMARY KEY, \
+                            title TEXT, \
+                            description TEXT);")
+        
+        # create participants table if it doesn't exist
+        self._cursor.execute("CREATE TABLE IF NOT EXISTS participants (\
+                            id INTEGER PRIMARY KEY, \
+                            study TEXT, \
+                            study_id TEXT, \
+                            deidentified_id TEXT, \
+                            group_assignment TEXT);")
+
+        # create mri sessions table if it doesn't exist
+        self._cursor.execute("CREATE TABLE IF NOT EXISTS mri_sessions (\
+                            id INTEGER PRIMARY KEY, \
+                            study TEXT, \
+                            participant_id INTEGER, \
+                            participant_session_id TEXT, \
+                            data_file TEXT, \
+                            summary_file TEXT, \
+                            description TEXT, \
+                            data_recorded_date TEXT, \
+                            data_recorded_time TEXT, \
+                            data_recorded_dt REAL, \
+                            data_downloaded_dt REAL, \
+                            notification_sent_dt REAL, \
+                            summary_downloaded_dt REAL, \
+                            converted_to_nifti_dt REAL, \
+                            conversion_validated_dt REAL, \
+                            conversion_validated_with_summary_dt REAL, \
+                            conversion_valid INTEGER, \
+                            study_id_validated_dt REAL, \
+                            session_id_validated_dt REAL, \
+                            skip_processing INTEGER, \
+                            data_converted_dt REAL, \
+                            data_uploaded_dt REAL);")
+
+        # create mri scans table if it doesn't exist
+        self._cursor.execute("CREATE TABLE IF NOT EXISTS mri_series (\
+                            id INTEGER PRIMARY KEY, \
+                            study TEXT, \
+                            participant_id INTEGER, \
+                            session_id INTEGER, \
+                            series_number INTEGER, \
+                            series_recorded_dt REAL, \
+                            description TEXT, \
+                            number_files INTEGER, \
+                            files_validated_dt REAL, \
+                            files_validated_with_summary_dt REAL, \
+                            files_valid INTEGER, \
+                            dcm2bids_criteria TEXT, \
+                            dcm2bids_criteria_in_config INTEGER, \
+                            duplicate_series TEXT, \
+                            skip_processing INTEGER, \
+                            data_converted_dt REAL);")
+        
+        # participants, mri_sessions and mri_series tables originally did not have the "study" column
+        # therefore, we need to check if it should be added
+        if not self.column_exists(table="participants", column="study"):
+            self._cursor.execute("ALTER TABLE participants ADD COLUMN study TEXT;")
+
+        if not self.column_exists(table="mri_sessions", column="study"):
+            self._cursor.execute("ALTER TABLE mri_sessions ADD COLUMN study TEXT;")
+
+        if not self.column_exists(table="mri_series", column="study"):
+            self._cursor.execute("ALTER TABLE mri_series ADD COLUMN study TEXT;")
+
+    # schema version 2: indexes used by the most frequent lookups (e.g. sync scripts check every remote file against the database)
+    def migrate_schema_to_version_2(self):
+
+        self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_participants_study_id ON participants (study_id);")
+        self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_participants_deidentified_id ON participants (deidentified_id);")
+        self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_mri_sessions_data_file ON mri_sessions (data_file);")
+        self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_mri_sessions_participant_id ON mri_sessions (participant_id);")
+        self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_mri_series_session_id_series_number ON mri_series (session_id, series_number);")
+
+    # schema version 3: processing stage of mri sessions, and indexes used by the pipeline stages to find the sessions they need to process
+    def migrate_schema_to_version_3(self):
+
+        # add "stage" column and derive the stage of all existing sessions
+        if not self.column_exists(table="mri_sessions", column="stage"):
+            self._cursor.execute("ALTER TABLE mri_sessions ADD COLUMN stage TEXT;")
+        self._cursor.execute("UPDATE mri_sessions SET stage = " + mri_session_stage_expression() + ";")
+
+        # keep the stage of each session up to date whenever a session is added or one of the relevant columns changes
+        self._cursor.execute("CREATE TRIGGER IF NOT EXISTS trg_mri_sessions_stage_insert AFTER INSERT ON mri_sessions \
+                            BEGIN \
+                            UPDATE mri_sessions SET stage = " + mri_session_stage_expression("NEW.") + " WHERE id = NEW.id; \
+                            END;")
+        self._cursor.execute("CREATE TRIGGER IF NOT EXISTS trg_mri_sessions_stage_update AFTER UPDATE OF " + ", ".join(mri_session_stage_columns) + " ON mri_sessions \
+                            BEGIN \
+                            UPDATE mri_sessions SET stage = " + mri_session_stage_expression("NEW.") + " WHERE id = NEW.id; \
+                            END;")
+
+        # the partial indexes only contain the (few) sessions waiting for the corresponding sync or notification step
+        self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_mri_sessions_stage ON mri_sessions (stage, skip_processing);")
+        self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_mri_sessions_missing_summary ON mri_sessions (skip_processing) WHERE (summary_file IS NULL) OR (summary_file = '');")
+        self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_mri_sessions_summary_download ON mri_sessions (skip_processing) WHERE summary_downloaded_dt IS NULL;")
+        self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_mri_sessions_first_notification ON mri_sessions (skip_processing) WHERE notification_sent_dt IS NULL;")
+        self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_mri_sessions_id_validation ON mri_sessions (skip_processing) WHERE (study_id_validated_dt IS NULL) OR (session_id_validated_dt IS NULL);")
+
+    # schema version 4: change log. Every added, updated or removed participant, session and series is recorded by a trigger,
+    # so that readers (e.g. the data viewer) can refresh only the rows that changed since their last refresh
+    def migrate_schema_to_version_4(self):
+
+        # AUTOINCREMENT makes sure ids are never reused, even after old changes were removed
+        self._cursor.execute("CREATE TABLE IF NOT EXISTS change_log (\
+                            id INTEGER PRIMARY KEY AUTOINCREMENT, \
+                            table_name TEXT, \
+                            row_id INTEGER, \
+                            parent_id INTEGER, \
+                            operation TEXT, \
+                            changed_dt REAL);")
+        self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_change_log_changed_dt ON change_log (changed_dt);")
+
+        # record changes
+        for table_name, parent_column in change_log_tables.items():
+            for operation in ("insert", "update", "delete"):
+                row = "OLD." if operation == "delete" else "NEW."
+                parent_id = "NULL" if parent_column == None else row + parent_column
+                self._cursor.execute("CREATE TRIGGER IF NOT EXISTS trg_" + table_name + "_change_log_" + operation + " AFTER " + operation.upper() + " ON " + table_name + " \
+                                    BEGIN \
+                                    INSERT INTO change_log (table_name, row_id, parent_id, operation, changed_dt) \
+                                    VALUES ('" + table_name + "', " + row + "id, " + parent_id + ", '" + operation + "', (julianday('now') - 2440587.5)*86400.0); \
+                                    END;")
+
+    # schema version 5: index used to page through the mri sessions in the order they were recorded (see "get_mri_sessions_page")
+    # the index also contains the row id, so sessions recorded at the same time are returned in a stable order
+    def migrate_schema_to_version_5(self):
+
+        self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_mri_sessions_data_recorded_dt ON mri_sessions (data_recorded_dt);")
+
+    # schema version 6: full-text search index of session descriptions, session IDs, participant IDs and series descriptions (see "search")
+    # the trigram tokenizer allows searching for any fragment of at least 3 characters (e.g. "sub-XYZ_ses-2")
+    # the rows of the search tables have the same ids as the sessions and series they index, and are kept up to date by triggers
+    # if SQLite was built without FTS5, no search tables are created and "search" scans the tables instead
+    def migrate_schema_to_version_6(self):
+
+        try:
+            self._cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS mri_sessions_search USING fts5(description, participant_session_id, study_id, deidentified_id, tokenize='trigram');")
+            self._cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS mri_series_search USING fts5(description, tokenize='trigram');")
+        except sqlite3.OperationalError as e:
+            print("WARNING: Could not create full-text search tables (" + str(e) + "). Searches will be slower.")
+            return
+
+        # index existing sessions and series
+        session_search_row = "SELECT mri_sessions.id, mri_sessions.description, mri_sessions.participant_session_id, participants.study_id, participants.deidentified_id \
+                              FROM mri_sessions LEFT JOIN participants ON participants.id = mri_sessions.participant_id"
+        self._cursor.execute("DELETE FROM mri_sessions_search;")
+        self._cursor.execute("INSERT INTO mri_sessions_search (rowid, description, participant_session_id, study_id, deidentified_id) " + session_search_row + ";")
+        self._cursor.execute("DELETE FROM mri_series_search;")
+        self._cursor.execute("INSERT INTO mri_series_search (rowid, description) SELECT id, description FROM mri_series;")
+
+        # keep sessions up to date
+        self._cursor.execute("CREATE TRIGGER IF NOT EXISTS trg_mri_sessions_search_insert AFTER INSERT ON mri_sessions \
+                            BEGIN \
+                            INSERT INTO mri_sessions_search (rowid, description, participant_session_id, study_id, deidentified_id) " + session_search_row + " WHERE mri_sessions.id = NEW.id; \
+                            END;")
+        self._cursor.execute("CREATE TRIGGER IF NOT EXISTS trg_mri_sessions_search_update AFTER UPDATE OF description, participant_session_id, participant_id ON mri_sessions \
+                            BEGIN \
+                            DELETE FROM mri_sessions_search WHERE rowid = OLD.id; \
+                            INSERT INTO mri_sessions_search (rowid, description, participant_session_id, study_id, deidentified_id) " + session_search_row + " WHERE mri_sessions.id = NEW.id; \
+                            END;")
+        self._cursor.execute("CREATE TRIGGER IF NOT EXISTS trg_mri_sessions_search_delete AFTER DELETE ON mri_sessions \
+                            BEGIN \
+                            DELETE FROM mri_sessions_search WHERE rowid = OLD.id; \
+                            END;")
+
+        # the participant IDs are stored with each session of the participant
+        self._cursor.execute("CREATE TRIGGER IF NOT EXISTS trg_participants_search_update AFTER UPDATE OF study_id, deidentified_id ON participants \
+                            BEGIN \
+                            UPDATE mri_sessions_search SET study_id = NEW.study_id, deidentified_id = NEW.deidentified_id \
+                            WHERE rowid IN (SELECT id FROM mri_sessions WHERE participant_id = NEW.id); \
+                            END;")
+        self._cursor.execute("CREATE TRIGGER IF NOT EXISTS trg_participants_search_delete AFTER DELETE ON participants \
+                            BEGIN \
+                            UPDATE mri_sessions_search SET study_id = NULL, deidentified_id = NULL \
+                            WHERE rowid IN (SELECT id FROM mri_sessions WHERE participant_id = OLD.id); \
+                            END;")
+
+        # keep series up to date
+        self._cursor.execute("CREATE TRIGGER IF NOT EXISTS trg_mri_series_search_insert AFTER INSERT ON mri_series \
+                            BEGIN \
+                            INSERT INTO mri_series_search (rowid, description) VALUES (NEW.id, NEW.description); \
+                            END;")
+        self._cursor.execute("CREATE TRIGGER IF NOT EXISTS trg_mri_series_search_update AFTER UPDATE OF description ON mri_series \
+                            BEGIN \
+                            UPDATE mri_series_search SET description = NEW.description WHERE rowid = NEW.id; \
+                            END;")
+        self._cursor.execute("CREATE TRIGGER IF NOT EXISTS trg_mri_series_search_delete AFTER DELETE ON mri_series \
+                            BEGIN \
+                            DELETE FROM mri_series_search WHERE rowid = OLD.id; \
+                            END;")
+
+    # schema version 7: views aggregating the sessions of each participant and of each processing stage (see "get_participant_stats"
+    # and "get_mri_session_stage_stats")
+    def migrate_schema_to_version_7(self):
+
+        self._cursor.execute("CREATE VIEW IF NOT EXISTS participant_stats AS \
+                            SELECT participants.id AS participant_id, \
+                            COUNT(mri_sessions.id) AS n_sessions, \
+                            COUNT(mri_sessions.data_converted_dt) AS n_converted_sessions, \
+                            COUNT(mri_sessions.data_uploaded_dt) AS n_uploaded_sessions, \
+                            MAX(mri_sessions.data_recorded_dt) AS last_recorded_dt \
+                            FROM participants LEFT JOIN mri_sessions ON mri_sessions.participant_id = participants.id \
+                            GROUP BY participants.id;")
+
+        # a session waits in its stage since the previous stage was completed
+        # the columns of the longest-waiting (earliest) session (bare columns next to MIN) are returned as the oldest pending session
+        self._cursor.execute("CREATE VIEW IF NOT EXISTS mri_session_stage_stats AS \
+                            SELECT stage, (skip_processing IS 1) AS skipped, COUNT(*) AS n_sessions, \
+                            MIN(CASE stage \
+                                WHEN 'data_download' THEN data_recorded_dt \
+                                WHEN 'conversion_to_nifti' THEN data_downloaded_dt \
+                                WHEN 'data_validation' THEN converted_to_nifti_dt \
+                                WHEN 'data_validation_with_summary' THEN conversion_validated_dt \
+                                WHEN 'on_hold' THEN conversion_validated_with_summary_dt \
+                                WHEN 'conversion_to_bids' THEN conversion_validated_with_summary_dt \
+                                WHEN 'upload' THEN data_converted_dt \
+                                ELSE data_uploaded_dt END) AS oldest_waiting_since_dt, \
+                            id AS oldest_session_id, \
+                            description AS oldest_session_description \
+                            FROM mri_sessions GROUP BY stage, skipped;")
+
+    # schema version 8: unique deidentified IDs (see "create_unique_deidentified_id_index")
+    def migrate_schema_to_version_8(self):
+        self.create_unique_deidentified_id_index()
+
+    # make sure no two participants can get the same deidentified ID (participants without a deidentified ID are not affected)
+    # if some participants already share a deidentified ID, the index can't be created until the duplicates were resolved
+    # (e.g. in the Data Viewer). In that case a warning is printed, and the data cleanup tries again to create the index
+    # once per run (see "check_unique_deidentified_id_index")
+    # returns 1 if the index exists, 0 if it could not be created because of duplicates, and -1 on error
+    def create_unique_deidentified_id_index(self):
+
+        qry_res = self.execute("SELECT deidentified_id, GROUP_CONCAT(study_id, ', ') FROM participants \
+                               WHERE (deidentified_id IS NOT NULL) AND (deidentified_id != '') \
+                               GROUP BY deidentified_id HAVING COUNT(*) > 1;")
+        if qry_res == -1:
+            print("ERROR: Could not check for duplicate deidentified IDs.")
+            return -1
+        
+        if len(qry_res) > 0:
+            print("WARNING: Deidentified IDs are not unique. Please assign new deidentified IDs to the following participants:")
+            for row in qry_res:
+                print("  " + str(row[0]) + ": " + str(row[1]))
+            return 0
+        
+        res = self.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_participants_deidentified_id_unique ON participants (deidentified_id) \
+                           WHERE (deidentified_id IS NOT NULL) AND (deidentified_id != '');")
+        if res == -1:
+            print("ERROR: Could not create unique index of deidentified IDs.")
+            return -1
+        
+        return 1
 
+    # make sure the unique index of deidentified IDs exists, and try to create it if it doesn't
+    # (it is missing if participants shared a deidentified ID when the schema was migrated to version 8)
+    # returns 1 if the index exists or could not be created because of duplicates, and -1 on error
+    def check_unique_deidentified_id_index(self):
+
+        qry_res = self.execute("SELECT 1 FROM sqlite_master WHERE (type = 'index') AND (name = 'idx_participants_deidentified_id_unique');")
+        if qry_res == -1:
+            print("ERROR: Could not check unique index of deidentified IDs.")
+            return -1
+        
+        if len(qry_res) > 0:
+            return 1
+        
+        res = self.create_unique_deidentified_id_index()
+        if res == -1:
+            return -1
+        
+        self.commit()
+        
+        return 1
+
+    # schema version 9: archive of uploaded sessions and their series (see "archive_mri_sessions")
+    # note: columns that are added to the mri_sessions or mri_series table by a later migration also need to be added to the archive tables
+    def migrate_schema_to_version_9(self):
+
+        # create archive tables with the same columns as the original tables
+        for table_name, archive_table_name in archive_tables.items():
+            columns = []
+            for column_info in self._cursor.execute("PRAGMA table_info(" + table_name + ");").fetchall():
+                if column_info["name"] == "id":
+                    columns.append("id INTEGER PRIMARY KEY")
+                else:
+                    columns.append(column_info["name"] + " " + column_info["type"])
+            self._cursor.execute("CREATE TABLE IF NOT EXISTS " + archive_table_name + " (" + ", ".join(columns) + ");")
+
+        # indexes used to check whether a data file is already known, to check the sessions of a participant and to get the series of a session
+        self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_mri_sessions_archive_data_file ON mri_sessions_archive (data_file);")
+        self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_mri_sessions_archive_participant_id ON mri_sessions_archive (participant_id);")
+        self._cursor.execute("CREATE INDEX IF NOT EXISTS idx_mri_series_archive_session_id_series_number ON mri_series_archive (session_id, series_number);")
+
+        # archived sessions still count as sessions of their participant
+        self._cursor.execute("DROP VIEW IF EXISTS participant_stats;")
+        self._cursor.execute("CREATE VIEW participant_stats AS \
+                            SELECT participants.id AS participant_id, \
+                            COUNT(sessions.id) AS n_sessions, \
+                            COUNT(sessions.data_converted_dt) AS n_converted_sessions, \
+                            COUNT(sessions.data_uploaded_dt) AS n_uploaded_sessions, \
+                            MAX(sessions.data_recorded_dt) AS last_recorded_dt \
+                            FROM participants LEFT JOIN \
+                            (SELECT id, participant_id, data_converted_dt, data_uploaded_dt, data_recorded_dt FROM mri_sessions \
+                            UNION ALL SELECT id, participant_id, data_converted_dt, data_uploaded_dt, data_recorded_dt FROM mri_sessions_archive) AS sessions \
+                            ON sessions.participant_id = participants.id \
+                            GROUP BY participants.id;")
+
+        # archived sessions and series stay searchable: their search rows are kept when they are moved to the archive
+        # (and replaced when they are restored)
+        if self._cursor.execute("SELECT name FROM sqlite_schema WHERE type='table' AND name='mri_sessions_search';").fetchone() == None:
+            return
+        
+        session_search_row = "SELECT mri_sessions.id, mri_sessions.description, mri_sessions.participant_session_id, participants.study_id, participants.deidentified_id \
+                              FROM mri_sessions LEFT JOIN participants ON participants.id = mri_sessions.participant_id"
+        for trigger in ("trg_mri_sessions_search_insert", "trg_mri_sessions_search_delete", "trg_participants_search_update", "trg_participants_search_delete",
+                        "trg_mri_series_search_insert", "trg_mri_series_search_delete"):
+            self._cursor.execute("DROP TRIGGER IF EXISTS " + trigger + ";")
+        
+        self._cursor.execute("CREATE TRIGGER trg_mri_sessions_search_insert AFTER INSERT ON mri_sessions \
+                            BEGIN \
+                            DELETE FROM mri_sessions_search WHERE rowid = NEW.id; \
+                            INSERT INTO mri_sessions_search (rowid, description, participant_session_id, study_id, deidentified_id) " + session_search_row + " WHERE mri_sessions.id = NEW.id; \
+                            END;")
+        self._cursor.execute("CREATE TRIGGER trg_mri_sessions_search_delete AFTER DELETE ON mri_sessions \
+                            WHEN NOT EXISTS (SELECT 1 FROM mri_sessions_archive WHERE id = OLD.id) \
+                            BEGIN \
+                            DELETE FROM mri_sessions_search WHERE rowid = OLD.id; \
+                            END;")
+        self._cursor.execute("CREATE TRIGGER trg_mri_sessions_archive_search_delete AFTER DELETE ON mri_sessions_archive \
+                            WHEN NOT EXISTS (SELECT 1 FROM mri_sessions WHERE id = OLD.id) \
+                            BEGIN \
+                            DELETE FROM mri_sessions_search WHERE rowid = OLD.id; \
+                            END;")
+        self._cursor.execute("CREATE TRIGGER trg_participants_search_update AFTER UPDATE OF study_id, deidentified_id ON participants \
+                            BEGIN \
+                            UPDATE mri_sessions_search SET study_id = NEW.study_id, deidentified_id = NEW.deidentified_id \
+                            WHERE rowid IN (SELECT id FROM mri_sessions WHERE participant_id = NEW.id UNION ALL SELECT id FROM mri_sessions_archive WHERE participant_id = NEW.id); \
+                            END;")
+        self._cursor.execute("CREATE TRIGGER trg_participants_search_delete AFTER DELETE ON participants \
+                            BEGIN \
+                            UPDATE mri_sessions_search SET study_id = NULL, deidentified_id = NULL \
+                            WHERE rowid IN (SELECT id FROM mri_sessions WHERE participant_id = OLD.id UNION ALL SELECT id FROM mri_sessions_archive WHERE participant_id = OLD.id); \
+                            END;")
+        self._cursor.execute("CREATE TRIGGER trg_mri_series_search_insert AFTER INSERT ON mri_series \
+                            BEGIN \
+                            DELETE FROM mri_series_search WHERE rowid = NEW.id; \
+                            INSERT INTO mri_series_search (rowid, description) VALUES (NEW.id, NEW.description); \
+                            END;")
+        self._cursor.execute("CREATE TRIGGER trg_mri_series_search_delete AFTER DELETE ON mri_series \
+                            WHEN NOT EXISTS (SELECT 1 FROM mri_series_archive WHERE id = OLD.id) \
+                            BEGIN \
+                            DELETE FROM mri_series_search WHERE rowid = OLD.id; \
+                            END;")
+        self._cursor.execute("CREATE TRIGGER trg_mri_series_archive_search_delete AFTER DELETE ON mri_series_archive \
+                            WHEN NOT EXISTS (SELECT 1 FROM mri_series WHERE id = OLD.id) \
+                            BEGIN \
+                            DELETE FROM mri_series_search WHERE rowid = OLD.id; \
+                            END;")
+
+    # schema version 10: the stage triggers (see "migrate_schema_to_version_3") update the stage of a session right after it was
+    # added or changed, so changes of the stage alone are not recorded again in the change log
+    # note: columns that are added to the mri_sessions table by a later migration also need to be added to this trigger
+    def migrate_schema_to_version_10(self):
+
+        columns = [column_info["name"] for column_info in self._cursor.execute("PRAGMA table_info(mri_sessions);").fetchall()
+                   if column_info["name"] != "stage"]
+        self._cursor.execute("DROP TRIGGER IF EXISTS trg_mri_sessions_change_log_update;")
+        self._cursor.execute("CREATE TRIGGER trg_mri_sessions_change_log_update AFTER UPDATE OF " + ", ".join(columns) + " ON mri_sessions \
+                            BEGIN \
+                            INSERT INTO change_log (table_name, row_id, parent_id, operation, changed_dt) \
+                            VALUES ('mri_sessions', NEW.id, NEW." + change_log_tables["mri_sessions"] + ", 'update', (julianday('now') - 2440587.5)*86400.0); \
+                            END;")
+
+    # schema version 11: the oldest pending session of each stage is selected explicitly (see "mri_session_stage_stats" view)
+    # with bare columns next to MIN, SQLite returns an arbitrary session if no session of a stage has a waiting time
+    # sessions without a waiting time are only returned if no session of the stage has one (then the session with the smallest id)
+    def migrate_schema_to_version_11(self):
+
+        self._cursor.execute("DROP VIEW IF EXISTS mri_session_stage_stats;")
+        self._cursor.execute("CREATE VIEW mri_session_stage_stats AS \
+                            SELECT stage, skipped, COUNT(*) AS n_sessions, \
+                            MIN(waiting_since_dt) AS oldest_waiting_since_dt, \
+                            MAX(CASE WHEN waiting_rank = 1 THEN id END) AS oldest_session_id, \
+                            MAX(CASE WHEN waiting_rank = 1 THEN description END) AS oldest_session_description \
+                            FROM (SELECT stage, skipped, id, description, waiting_since_dt, \
+                                  ROW_NUMBER() OVER (PARTITION BY stage, skipped ORDER BY waiting_since_dt IS NULL, waiting_since_dt, id) AS waiting_rank \
+                                  FROM (SELECT stage, (skip_processing IS 1) AS skipped, id, description, \
+                                        CASE stage \
+                                            WHEN 'data_download' THEN data_recorded_dt \
+                                            WHEN 'conversion_to_nifti' THEN data_downloaded_dt \
+                                            WHEN 'data_validation' THEN converted_to_nifti_dt \
+                                            WHEN 'data_validation_with_summary' THEN conversion_validated_dt \
+                                            WHEN 'on_hold' THEN conversion_validated_with_summary_dt \
+                                            WHEN 'conversion_to_bids' THEN conversion_validated_with_summary_dt \
+                                            WHEN 'upload' THEN data_converted_dt \
+                                            ELSE data_uploaded_dt END AS waiting_since_dt \
+                                        FROM mri_sessions)) \
+                            GROUP BY stage, skipped;")
 
     # execute command
+    # n_attempts: maximum number of attempts if the database is locked by another connection (None: retry until the time budget is used up)
     def execute(self, cmd, parameters = (), n_attempts = None):
 
         # make sure connection is open
@@ -170,42 +770,107 @@ class db:
             print("ERROR: Database not opened.")
             return -1
         
-        # check if number of attempts was provided
-        if n_attempts != None:
-            attempts = n_attempts
-        else:
-            attempts = self.n_default_query_attempts
+        # start timer (only if statements are logged)
+        if self._stats != None:
+            t_start = time.perf_counter()
         
         # execute query
-        # if an error is caught, try again
-        success = False
-        result = -1
-        for i in range (attempts):
-            try:
-                self._cursor.execute(cmd, parameters)
-                result = self._cursor.fetchall()
-                self.lastrowid = self._cursor.lastrowid
-                success = True
-            except Exception as e:
-                print("WARNING: Could not execute database query:")
-                print(e)
-                print("Remaining attempts: " + str(attempts-i-1) + "/" + str(attempts))
-                self.lastrowid = None
-                success = False
-                result = -1
-                continue
-
-            if success:
-                break
-
-        if not success:
+        success, n_retries, wait_s = self.run_with_retry(lambda: self._cursor.execute(cmd, parameters), n_attempts)
+        if success:
+            result = self._cursor.fetchall()
+            self.lastrowid = self._cursor.lastrowid
+
+            # statements changing the schema invalidate the cached column names
+            if cmd.lstrip().upper().startswith(("ALTER", "CREATE", "DROP")):
+                self._column_names = {}
+        else:
+            result = -1
+            self.lastrowid = None
             print("ERROR: Failed to execute query: \"" + cmd + "\"")
             if parameters:
                 print("with parameters:")
                 print(parameters)
 
+        # record statistics
+        if self._stats != None:
+            if not success:
+                n_rows = 0
+            elif len(result) > 0:
+                n_rows = len(result)
+            else:
+                n_rows = self._cursor.rowcount
+            self._stats.record(cmd, time.perf_counter()-t_start, n_rows, n_retries, wait_s, success)
+
         return result
-    
+
+    # execute command for each set of parameters in a sequence (e.g. to insert many records at once)
+    # note: callers should wrap this in a savepoint, so that a failed attempt does not leave partial results behind
+    def executemany(self, cmd, seq_of_parameters, n_attempts = None):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+
+        # start timer (only if statements are logged)
+        if self._stats != None:
+            t_start = time.perf_counter()
+
+        # execute query
+        # the parameters are converted to a list, so they can be used again if the statement needs to be retried
+        seq_of_parameters = list(seq_of_parameters)
+        success, n_retries, wait_s = self.run_with_retry(lambda: self._cursor.executemany(cmd, seq_of_parameters), n_attempts)
+        self.lastrowid = None
+
+        # record statistics
+        if self._stats != None:
+            self._stats.record(cmd, time.perf_counter()-t_start, self._cursor.rowcount if success else 0, n_retries, wait_s, success)
+
+        if not success:
+            print("ERROR: Failed to execute query: \"" + cmd + "\"")
+            return -1
+
+        return 1
+
+    # run a database operation. If the database is locked by another connection, try again after a delay
+    # the delay starts at "retry_initial_delay_s" and doubles after every attempt (up to "retry_max_delay_s"). A random jitter is added,
+    # so that competing processes don't retry at the same time. Once "retry_time_budget_s" has passed, the operation fails.
+    # other errors are not retried
+    # returns a tuple (success, number of retries, time spent waiting for the lock in s)
+    def run_with_retry(self, operation, n_attempts = None):
+
+        t_give_up = time.perf_counter() + self.retry_time_budget_s
+        delay = self.retry_initial_delay_s
+        n_retries = 0
+        wait_s = 0.0
+        while True:
+            t_attempt = time.perf_counter()
+            try:
+                operation()
+                return True, n_retries, wait_s
+            except Exception as e:
+                if not is_lock_error(e):
+                    print("WARNING: Could not execute database query:")
+                    print(e)
+                    return False, n_retries, wait_s
+                
+                # time spent in the failed attempt was spent waiting for the lock (see "busy_timeout")
+                wait_s = wait_s + time.perf_counter()-t_attempt
+
+                # check if we should give up
+                t_remaining = t_give_up-time.perf_counter()
+                if ((n_attempts != None) and (n_retries+1 >= n_attempts)) or (t_remaining <= 0):
+                    print("WARNING: Could not execute database query, the database is locked by another process:")
+                    print(e)
+                    print("Gave up after " + str(n_retries+1) + " attempt(s) and " + "{:.1f}".format(wait_s) + " s.")
+                    return False, n_retries, wait_s
+                
+                # wait and try again
+                sleep_s = min(delay/2 + random.uniform(0, delay/2), t_remaining)
+                time.sleep(sleep_s)
+                wait_s = wait_s + sleep_s
+                delay = min(2*delay, self.retry_max_delay_s)
+                n_retries = n_retries+1
 
     # commit changes
     def commit(self):
@@ -218,6 +883,54 @@ class db:
         # execute commit
         self._connection.commit()
 
+    # write a consistent copy of the database to a file
+    # note: in WAL mode, recent changes may not yet be in the main database file, so the file should not be copied directly
+    def backup_to_file(self, backup_file):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+
+        try:
+            backup_connection = sqlite3.connect(backup_file)
+            with backup_connection:
+                self._connection.backup(backup_connection)
+            backup_connection.close()
+        except Exception as e:
+            print("ERROR: Could not back up database to \"" + str(backup_file) + "\":")
+            print(e)
+            return -1
+
+        return 1
+
+    # register a function that is called with the SQL text of every executed statement (None to disable)
+    def trace_statements(self, callback):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+
+        self._connection.set_trace_callback(callback)
+
+    # get query plan of a statement
+    # returns a list with the description of each step (e.g. "SEARCH mri_sessions USING INDEX ...")
+    def explain_query_plan(self, cmd, parameters = ()):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+
+        res = self.execute("EXPLAIN QUERY PLAN " + cmd, parameters)
+        if res == -1:
+            print("ERROR: Could not get query plan.")
+            return -1
+
+        # the last column contains the description of each step
+        return [row[-1] for row in res]
+
     # check if table exists
     def table_exists(self, table=""):
 
@@ -261,23 +974,64 @@ class db:
             print("ERROR: Invalid column name.")
             return -1
 
-        # generate query
-        cmd = "PRAGMA table_info(" + table + ")"
-        
-        # execute query
-        res = self.execute(cmd)
-        if res == -1:
+        # get column names
+        column_names = self.get_column_names(table)
+        if column_names == -1:
             print("ERROR: Could not check if column exists.")
             return -1
         
-        column_found = False
-        for column_info in res:
-            if column_info[1]==column:
-                column_found = True
-                break
-        
         # check result
-        return column_found
+        return column in column_names
+
+    # check if all columns exist in table
+    def columns_exist(self, table="", columns=()):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+        
+        # make sure table is a valid string
+        if (table == None) or (not isinstance(table, str)) or (table == ""):
+            print("ERROR: Invalid table name.")
+            return -1
+        
+        # get column names
+        column_names = self.get_column_names(table)
+        if column_names == -1:
+            print("ERROR: Could not check if columns exist.")
+            return -1
+        
+        for column in columns:
+            if not column in column_names:
+                return False
+            
+        return True
+
+    # get names of all columns in table
+    # the names are cached, so the table information only needs to be read once per connection (until the schema changes)
+    def get_column_names(self, table=""):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+        
+        # check cache
+        if table in self._column_names:
+            return self._column_names[table]
+        
+        # get table information
+        res = self.execute("PRAGMA table_info(" + table + ");")
+        if res == -1:
+            print("ERROR: Could not get information for table '" + table + "'.")
+            return -1
+        
+        column_names = tuple(column_info["name"] for column_info in res)
+        if len(column_names) > 0:
+            self._column_names[table] = column_names
+
+        return column_names
 
     
     # add record
@@ -294,7 +1048,11 @@ class db:
             return -1
         
         # generate query command
-        cmd = "INSERT INTO " + table_name + " (" + query_args["columns"] + ") VALUES (" + query_args["questionmarks"] + ");"
+        id_expression = new_record_id_expression(table_name)
+        if id_expression == None:
+            cmd = "INSERT INTO " + table_name + " (" + query_args["columns"] + ") VALUES (" + query_args["questionmarks"] + ");"
+        else:
+            cmd = "INSERT INTO " + table_name + " (id, " + query_args["columns"] + ") VALUES (" + id_expression + ", " + query_args["questionmarks"] + ");"
         
         # generate parameter list
         params = tuple(query_args["values"])
@@ -305,17 +1063,164 @@ class db:
             print("ERROR: Could not add record to table '" + table_name + "'.")
             return -1
         
-        # get id
-        res = self.execute("SELECT * FROM " + table_name + " WHERE rowid = ?;",(self.lastrowid,))
-        if res == -1: 
-            print("ERROR: Could not find record added to table '" + table_name + "'.")
+        # return id (all tables use "id INTEGER PRIMARY KEY", which is an alias for the rowid)
+        return self.lastrowid
+
+    # add multiple records in a single transaction
+    # records: list of dicts mapping column names to values (None values are stored as NULL)
+    # returns a list with the ids of the new records (in the same order as the records)
+    def add_records(self, table_name, records):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
             return -1
         
-        # return id
-        if (res!=None) and (len(res)>0):
-            return res[0][0]
+        # make sure there is data to add
+        if (records == None) or (len(records) < 1):
+            return []
+
+        # get all columns used by any of the records
+        columns = []
+        for record in records:
+            for key in record:
+                if not key in columns:
+                    columns.append(key)
+
+        if self.columns_exist(table_name, columns) != True:
+            print("ERROR: Records can't be added to table '" + table_name + "' because they contain invalid columns.")
+            return -1
+        
+        # generate query command and parameter list
+        id_expression = new_record_id_expression(table_name)
+        if id_expression == None:
+            cmd = "INSERT INTO " + table_name + " (" + ", ".join(columns) + ") VALUES (" + ",".join(["?"]*len(columns)) + ");"
         else:
-            return None
+            cmd = "INSERT INTO " + table_name + " (id, " + ", ".join(columns) + ") VALUES (" + id_expression + ", " + ",".join(["?"]*len(columns)) + ");"
+        params = [tuple(record.get(column) for column in columns) for record in records]
+
+        # start transaction
+        # while the write lock is held, no other process can add records, so the new records get consecutive ids
+        if self.begin_bulk_write() == -1:
+            print("ERROR: Could not add records to table '" + table_name + "'.")
+            return -1
+
+        res = self.execute("SELECT MAX(id) FROM " + table_name + ";")
+        if res != -1:
+            max_id = res[0][0]
+            if max_id == None:
+                max_id = 0
+            res = self.executemany(cmd, params)
+        if res != -1:
+            res = self.execute("SELECT id FROM " + table_name + " WHERE id > ? ORDER BY id;", (max_id,))
+        if (res == -1) or (len(res) != len(records)):
+            print("ERROR: Could not add records to table '" + table_name + "'.")
+            self.end_bulk_write(success=False)
+            return -1
+        
+        if self.end_bulk_write(success=True) == -1:
+            return -1
+
+        # return ids
+        return [row[0] for row in res]
+
+    # update multiple records in a single transaction
+    # records: list of dicts that contain the "id" of the record and the columns to update (None values are not updated)
+    def update_records(self, table_name, records):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+        
+        # make sure there is data to update
+        if (records == None) or (len(records) < 1):
+            return 1
+
+        # group records that update the same set of columns, so that each group can be written with one statement
+        groups = {}
+        for record in records:
+            if (not "id" in record) or (record["id"] == None):
+                print("ERROR: Records in table '" + table_name + "' can't be updated because no id was provided.")
+                return -1
+            columns = tuple(key for key, value in record.items() if (key != "id") and (value != None))
+            if len(columns) < 1:
+                continue
+            if not columns in groups:
+                groups[columns] = []
+            groups[columns].append(tuple(record[column] for column in columns) + (record["id"],))
+
+        all_columns = []
+        for columns in groups:
+            all_columns.extend(columns)
+        if self.columns_exist(table_name, all_columns) != True:
+            print("ERROR: Records in table '" + table_name + "' can't be updated because they contain invalid columns.")
+            return -1
+
+        # start transaction
+        if self.begin_bulk_write() == -1:
+            print("ERROR: Could not update records in table '" + table_name + "'.")
+            return -1
+
+        for columns, params in groups.items():
+            cmd = "UPDATE " + table_name + " SET " + ", ".join([column + " = ?" for column in columns]) + " WHERE id = ?;"
+            res = self.executemany(cmd, params)
+            if res == -1:
+                print("ERROR: Could not update records in table '" + table_name + "'.")
+                self.end_bulk_write(success=False)
+                return -1
+            
+        if self.end_bulk_write(success=True) == -1:
+            return -1
+
+        # success
+        return 1
+
+    # start a transaction and acquire the write lock right away (unless a transaction is already open)
+    # data read after this call can't be changed by other connections until the transaction is committed or rolled back
+    def begin_write(self):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+        
+        if self._connection.in_transaction:
+            return 1
+        
+        if self.execute("BEGIN IMMEDIATE;") == -1:
+            return -1
+        
+        return 1
+
+    # undo all changes of the current transaction
+    def rollback(self):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+        
+        self._connection.rollback()
+
+    # start a bulk write
+    # if no transaction is open, a new one is started and the write lock is acquired right away.
+    # the changes are written inside a savepoint, so they can be undone without affecting earlier changes of the same transaction
+    def begin_bulk_write(self):
+
+        if self.begin_write() == -1:
+            return -1
+            
+        return self.execute("SAVEPOINT bulk_write;")
+    
+    # end a bulk write. If it was not successful, all changes made since the bulk write started are undone
+    # note: the transaction still needs to be committed by the caller
+    def end_bulk_write(self, success):
+
+        if not success:
+            self.execute("ROLLBACK TO bulk_write;")
+
+        return self.execute("RELEASE bulk_write;")
 
     # update record
     def update_record(self, table_name, id, query_args):
@@ -370,6 +1275,42 @@ class db:
         # success
         return 1
     
+    # get sort direction ("ASC" or "DESC") from the sort_dir argument of the get functions
+    def get_sort_direction(self, sort_dir):
+
+        if (sort_dir != None) and any(item.lower() == sort_dir.lower() for item in ("DESC", "descending", "-")):
+            return "DESC"
+        
+        return "ASC"
+
+    # get "ORDER BY" term for a column (e.g. "mri_sessions.data_recorded_dt DESC")
+    # returns -1 if the column can't be used to sort the table (see "sortable_columns")
+    def get_sort_term(self, table_name, sort_column, sort_dir, prefix=""):
+
+        if (not table_name in sortable_columns) or (not sort_column in sortable_columns[table_name]):
+            print("ERROR: Table '" + str(table_name) + "' can't be sorted by column '" + str(sort_column) + "'.")
+            return -1
+        
+        return prefix + sort_column + " " + self.get_sort_direction(sort_dir)
+
+    # get condition selecting the records after the cursor of a page (keyset pagination)
+    # records are sorted by the sort column and then by id. The cursor contains the values of the last record of the previous page
+    # NULL values are sorted first in ascending and last in descending order (same as SQLite's "ORDER BY")
+    # returns the condition and its parameters
+    def get_keyset_condition(self, sort_column, sort_dir, cursor, prefix=""):
+
+        column = prefix + sort_column
+        id = prefix + "id"
+        value = cursor["value"]
+        if self.get_sort_direction(sort_dir) == "ASC":
+            if value == None:
+                return "(((" + column + " IS NULL) AND (" + id + " > ?)) OR (" + column + " IS NOT NULL))", [cursor["id"]]
+            return "((" + column + " > ?) OR ((" + column + " = ?) AND (" + id + " > ?)))", [value, value, cursor["id"]]
+        else:
+            if value == None:
+                return "((" + column + " IS NULL) AND (" + id + " < ?))", [cursor["id"]]
+            return "((" + column + " < ?) OR ((" + column + " = ?) AND (" + id + " < ?)) OR (" + column + " IS NULL))", [value, value, cursor["id"]]
+
     # get records by multiple keys
     def get_records_by_keys(self, table_name, keys, sort_column=None, sort_dir=None):
 
@@ -390,36 +1331,20 @@ class db:
         if sort_column == None:
             qry_res = self.execute("SELECT * FROM " + table_name + " WHERE " + conditions + ";",list(key_values))
         else:
-            if (sort_dir != None) and any(item.lower() == sort_dir.lower() for item in ("ASC", "ascending", "+")):
-                direction = "ASC"
-            elif (sort_dir != None) and any(item.lower() == sort_dir.lower() for item in ("DESC", "descending", "-")):
-                direction = "DESC"
-            else:
-                direction = "ASC"
+            sort_term = self.get_sort_term(table_name, sort_column, sort_dir)
+            if sort_term == -1:
+                return -1
 
-            qry_res = self.execute("SELECT * FROM " + table_name + " WHERE " + conditions + " ORDER BY " + sort_column + " " + direction + ";",list(key_values))   
+            qry_res = self.execute("SELECT * FROM " + table_name + " WHERE " + conditions + " ORDER BY " + sort_term + ";",list(key_values))   
         if qry_res == -1: 
             print("ERROR: Could not get matching records from table '" + table_name + "'.")
             return -1
         
-        # get table information (containing column names)
-        info_res = self.execute("PRAGMA table_info(" + table_name + ");")
-        if info_res == -1: 
-            print("ERROR: Could not get information for table '" + table_name + "'.")
-            return -1
-        
-        if (qry_res==None) or (len(qry_res)<1) or (info_res==None) or (len(info_res)<1):
+        if (qry_res==None) or (len(qry_res)<1):
             return None
-        
-        # get column names
-        column_names = []
-        for column in info_res:
-            column_names.append(column[1])
 
         # convert data to dict
-        res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        res = self.rows_to_dicts(qry_res)
 
         return res
 
@@ -542,6 +1467,16 @@ class db:
         res = self.add_record("mri_series", query_args)
 
         return res
+
+    # add multiple mri scans to database in a single transaction
+    # series: list of dicts with the same keys as the arguments of "add_mri_series"
+    # returns a list with the ids of the new series
+    def add_mri_series_many(self, series):
+
+        # update table
+        res = self.add_records("mri_series", series)
+
+        return res
     
     # update study
     def update_study(self,
@@ -640,6 +1575,15 @@ class db:
         res = self.update_record("mri_series", id, query_args)
 
         return res
+
+    # update multiple mri scans in a single transaction
+    # series: list of dicts with the "id" of each series and the same keys as the arguments of "update_mri_series"
+    def update_mri_series_many(self, series):
+
+        # update table
+        res = self.update_records("mri_series", series)
+
+        return res
     
     # clear values from study
     def clear_values_from_study(self,
@@ -831,41 +1775,41 @@ class db:
         if sort_column == None:
             qry_res = self.execute("SELECT * FROM participants;")
         else:
-            if (sort_dir != None) and any(item.lower() == sort_dir.lower() for item in ("ASC", "ascending", "+")):
-                direction = "ASC"
-            elif (sort_dir != None) and any(item.lower() == sort_dir.lower() for item in ("DESC", "descending", "-")):
-                direction = "DESC"
-            else:
-                direction = "ASC"
+            sort_term = self.get_sort_term("participants", sort_column, sort_dir)
+            if sort_term == -1:
+                return -1
 
-            qry_res = self.execute("SELECT * FROM participants ORDER BY " + sort_column + " " + direction + ";")
+            qry_res = self.execute("SELECT * FROM participants ORDER BY " + sort_term + ";")
 
         if qry_res == -1: 
             print("ERROR: Could not get all participants.")
             return -1
         
-        # get table information (containing column names)
-        info_res = self.execute("PRAGMA table_info(participants);")
-        if info_res == -1: 
-            print("ERROR: Could not get information for table 'participants'.")
-            return -1
-        
-        if (qry_res==None) or (info_res==None):
+        if (qry_res==None):
             return None
-        
-        # get column names
-        column_names = []
-        for column in info_res:
-            column_names.append(column[1])
 
         # convert data to dict
-        res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        res = self.rows_to_dicts(qry_res)
         
         return res  
     
+    # get all deidentified IDs that are used by a participant
+    def get_used_deidentified_ids(self):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+        
+        qry_res = self.execute("SELECT deidentified_id FROM participants WHERE (deidentified_id IS NOT NULL) AND (deidentified_id != '');")
+        if qry_res == -1:
+            print("ERROR: Could not get deidentified IDs.")
+            return -1
+        
+        return set(row[0] for row in qry_res)
+    
     # get mri session id from database
+    # archived sessions are also found (their ids are never used by other sessions, see "new_record_id_expression")
     def get_mri_session_id(self, data_file=None, study=None):
 
         # get input arguments
@@ -876,20 +1820,29 @@ class db:
             res = -1
         else:
             res = self.get_record_id_by_keys("mri_sessions", keys)
+            if res == None:
+                res = self.get_record_id_by_keys("mri_sessions_archive", keys)
 
         return res
     
     # get MRI session data
-    def get_mri_session_data(self, id=None, data_file=None, study=None, participant_id=None, return_only_first=False, sort_column=None, sort_dir=None):
+    # include_archived: also return archived sessions (after the other sessions)
+    def get_mri_session_data(self, id=None, data_file=None, study=None, participant_id=None, return_only_first=False, sort_column=None, sort_dir=None, include_archived=False):
 
         # get input arguments
         args = locals()
-        keys = self.remove_keys_from_dict(args, ("self", "return_only_first", "sort_column", "sort_dir"))
+        keys = self.remove_keys_from_dict(args, ("self", "return_only_first", "sort_column", "sort_dir", "include_archived"))
 
         if len(keys)<1:
             res = -1
         else:
             res = self.get_records_by_keys("mri_sessions", keys, sort_column, sort_dir)
+            if include_archived and (res != -1):
+                archived_res = self.get_records_by_keys("mri_sessions_archive", keys, sort_column, sort_dir)
+                if archived_res == -1:
+                    res = -1
+                elif archived_res != None:
+                    res = archived_res if res == None else res + archived_res
 
         if (res!=None) and (res != -1) and return_only_first:
             if len(res)>0:
@@ -900,48 +1853,44 @@ class db:
             return res
 
     # get all MRI sessions
-    def get_all_mri_session_data(self, sort_column=None, sort_dir=None):
+    # include_archived: also return archived sessions
+    def get_all_mri_session_data(self, sort_column=None, sort_dir=None, include_archived=False):
 
         # make sure connection is open
         if (self._connection == None) or (self._cursor == None):
             print("ERROR: Database not opened.")
             return -1
+        
+        # get sessions (archived sessions are selected with the same columns)
+        if include_archived:
+            columns = self.get_column_names("mri_sessions")
+            if columns == -1:
+                print("ERROR: Could not get all MRI sessions.")
+                return -1
+            column_list = ", ".join(columns)
+            sessions = "SELECT " + column_list + " FROM mri_sessions UNION ALL SELECT " + column_list + " FROM mri_sessions_archive"
+        else:
+            sessions = "SELECT * FROM mri_sessions"
 
         # get data and sort if requested
         if sort_column == None:
-            qry_res = self.execute("SELECT * FROM mri_sessions;")
+            qry_res = self.execute(sessions + ";")
         else:
-            if (sort_dir != None) and any(item.lower() == sort_dir.lower() for item in ("ASC", "ascending", "+")):
-                direction = "ASC"
-            elif (sort_dir != None) and any(item.lower() == sort_dir.lower() for item in ("DESC", "descending", "-")):
-                direction = "DESC"
-            else:
-                direction = "ASC"
+            sort_term = self.get_sort_term("mri_sessions", sort_column, sort_dir)
+            if sort_term == -1:
+                return -1
 
-            qry_res = self.execute("SELECT * FROM mri_sessions ORDER BY " + sort_column + " " + direction + ";")
+            qry_res = self.execute(sessions + " ORDER BY " + sort_term + ";")
 
         if qry_res == -1: 
             print("ERROR: Could not get all MRI sessions.")
             return -1
         
-        # get table information (containing column names)
-        info_res = self.execute("PRAGMA table_info(mri_sessions);")
-        if info_res == -1: 
-            print("ERROR: Could not get information for table 'mri_sessions'.")
-            return -1
-        
-        if (qry_res==None) or (info_res==None):
+        if (qry_res==None):
             return None
-        
-        # get column names
-        column_names = []
-        for column in info_res:
-            column_names.append(column[1])
 
         # convert data to dict
-        res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        res = self.rows_to_dicts(qry_res)
         
         return res 
     
@@ -979,26 +1928,361 @@ class db:
             print("ERROR: Could not get all MRI series.")
             return -1
         
-        # get table information (containing column names)
-        info_res = self.execute("PRAGMA table_info(mri_series);")
-        if info_res == -1: 
-            print("ERROR: Could not get information for table 'mri_series'.")
+        if (qry_res==None):
+            return None
+
+        # convert data to dict
+        res = self.rows_to_dicts(qry_res)
+
+        return res  
+
+    # get MRI series of several sessions with one query
+    # include_archived: also get the series of archived sessions (with a second query)
+    # returns a dict with the list of series of every session (empty list if a session has no series)
+    def get_mri_series_of_sessions(self, session_ids, sort_column=None, sort_dir=None, include_archived=False):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
             return -1
         
-        if (qry_res==None) or (info_res==None):
-            return None
+        # get sorting (series are grouped by session)
+        sorting = " ORDER BY session_id"
+        if sort_column != None:
+            sort_term = self.get_sort_term("mri_series", sort_column, sort_dir)
+            if sort_term == -1:
+                return -1
+            sorting = sorting + ", " + sort_term
+
+        # get data
+        session_ids = list(session_ids)
+        res = {session_id: [] for session_id in session_ids}
+        for table_name in (("mri_series", "mri_series_archive") if include_archived else ("mri_series",)):
+            qry_res = self.execute("SELECT * FROM " + table_name + " WHERE session_id IN (" + ",".join(["?"]*len(session_ids)) + ")" + sorting + ";", session_ids)
+            if qry_res == -1: 
+                print("ERROR: Could not get MRI series of sessions.")
+                return -1
+            
+            # convert data to dict
+            for series in self.rows_to_dicts(qry_res):
+                res[series["session_id"]].append(series)
+
+        return res
+
+    # get mri sessions together with their participant and (optionally) their series
+    # stage: only return sessions in this stage (or in any of the stages, if a list is provided). See "mri_session_stages"
+    # ids: only return the sessions with these ids
+    # participant_ids: only return the sessions of these participants
+    # exclude_skipped: do not return sessions that should be skipped
+    # include_series: also get all series of the returned sessions
+    # study: only return the sessions of this study
+    # recorded_from, recorded_to: only return sessions recorded in this time range (timestamps, both inclusive)
+    # conversion_valid: only return sessions whose conversion was (True) or was not (False) valid
+    # ids_validated: only return sessions whose participant and session IDs were (True) or were not (False) validated
+    # limit: maximum number of returned sessions
+    # cursor: only return the sessions sorted after this cursor (see "get_mri_sessions_page")
+    # archived: return archived sessions instead of the other sessions (see "archive_mri_sessions")
+    # each returned session contains the key "participant" (dict with the participant data, or None if no participant is assigned)
+    # and, if requested, the key "series" (list with the data of all series, in the order they were added)
+    # the data is retrieved with one query for the sessions and participants and one query for the series, independent of the number of sessions
+    def get_mri_sessions_with_participants(self, stage=None, ids=None, participant_ids=None, exclude_skipped=False, include_series=False, sort_column=None, sort_dir=None,
+                                           study=None, recorded_from=None, recorded_to=None, conversion_valid=None, ids_validated=None, limit=None, cursor=None, archived=False):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
         
-        # get column names
-        column_names = []
-        for column in info_res:
-            column_names.append(column[1])
+        # get participant columns. They are returned with a prefix, since some names are also used by the sessions table
+        participant_columns = self.get_column_names("participants")
+        if participant_columns == -1:
+            print("ERROR: Could not get MRI sessions with participants.")
+            return -1
+        participant_column_list = ", ".join(["participants." + column + " AS \"participant." + column + "\"" for column in participant_columns])
+
+        # archived sessions and series are selected under the names of the original tables, so the same conditions can be used
+        if archived:
+            session_table = "mri_sessions_archive AS mri_sessions"
+            series_table = "mri_series_archive AS mri_series"
+        else:
+            session_table = "mri_sessions"
+            series_table = "mri_series"
+
+        # generate filter
+        conditions = []
+        params = []
+        if stage != None:
+            if isinstance(stage, str):
+                stage = (stage,)
+            conditions.append("(mri_sessions.stage IN (" + ",".join(["?"]*len(stage)) + "))")
+            params.extend(stage)
+        if ids != None:
+            conditions.append("(mri_sessions.id IN (" + ",".join(["?"]*len(ids)) + "))")
+            params.extend(ids)
+        if participant_ids != None:
+            conditions.append("(mri_sessions.participant_id IN (" + ",".join(["?"]*len(participant_ids)) + "))")
+            params.extend(participant_ids)
+        if exclude_skipped:
+            conditions.append("(mri_sessions.skip_processing IS NOT 1)")
+        if study != None:
+            conditions.append("(mri_sessions.study = ?)")
+            params.append(study)
+        if recorded_from != None:
+            conditions.append("(mri_sessions.data_recorded_dt >= ?)")
+            params.append(recorded_from)
+        if recorded_to != None:
+            conditions.append("(mri_sessions.data_recorded_dt <= ?)")
+            params.append(recorded_to)
+        if conversion_valid != None:
+            conditions.append("(mri_sessions.conversion_valid IS 1)" if conversion_valid else "(mri_sessions.conversion_valid IS NOT 1)")
+        if ids_validated != None:
+            if ids_validated:
+                conditions.append("(mri_sessions.study_id_validated_dt IS NOT NULL) AND (mri_sessions.session_id_validated_dt IS NOT NULL)")
+            else:
+                conditions.append("((mri_sessions.study_id_validated_dt IS NULL) OR (mri_sessions.session_id_validated_dt IS NULL))")
+
+        # get sorting
+        sorting = ""
+        if sort_column != None:
+            sort_term = self.get_sort_term("mri_sessions", sort_column, sort_dir, "mri_sessions.")
+            if sort_term == -1:
+                return -1
+            sorting = " ORDER BY " + sort_term
+
+        # get page (sessions are additionally sorted by id, so the order is unique)
+        page_conditions = list(conditions)
+        page_params = list(params)
+        if (limit != None) or (cursor != None):
+            if sort_column == None:
+                sort_column = "id"
+                sorting = " ORDER BY " + self.get_sort_term("mri_sessions", sort_column, sort_dir, "mri_sessions.")
+            elif sort_column != "id":
+                sorting = sorting + ", mri_sessions.id " + self.get_sort_direction(sort_dir)
+            if cursor != None:
+                condition, condition_params = self.get_keyset_condition(sort_column, sort_dir, cursor, "mri_sessions.")
+                page_conditions.append(condition)
+                page_params.extend(condition_params)
+            if limit != None:
+                sorting = sorting + " LIMIT ?"
+                page_params.append(limit)
+
+        if len(page_conditions) > 0:
+            filter = " WHERE " + " AND ".join(page_conditions)
+        else:
+            filter = ""
 
+        # get sessions and participants
+        qry_res = self.execute("SELECT mri_sessions.*, " + participant_column_list + " FROM " + session_table + " \
+                               LEFT JOIN participants ON participants.id = mri_sessions.participant_id" + filter + sorting + ";", tuple(page_params))
+        if qry_res == -1: 
+            print("ERROR: Could not get MRI sessions with participants.")
+            return -1
+        
         # convert data to dict
         res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        sessions_by_id = {}
+        for row in self.rows_to_dicts(qry_res):
+            session = {}
+            participant = {}
+            for column, value in row.items():
+                if column.startswith("participant."):
+                    participant[column[12:]] = value
+                else:
+                    session[column] = value
+
+            if participant["id"] != None:
+                session["participant"] = participant
+            else:
+                session["participant"] = None
+
+            if include_series:
+                session["series"] = []
+                sessions_by_id[session["id"]] = session
+
+            res.append(session)
+
+        # get series of all sessions (a page only contains few sessions, so its series are retrieved by session id)
+        if include_series and (len(res) > 0) and (limit != None):
+            series = self.get_mri_series_of_sessions(sessions_by_id.keys(), include_archived=archived)
+            if series == -1:
+                return -1
+            for session_id, session_series in series.items():
+                sessions_by_id[session_id]["series"] = session_series
+        elif include_series and (len(res) > 0):
+            if len(conditions) > 0:
+                filter = " WHERE " + " AND ".join(conditions)
+            else:
+                filter = ""
+            qry_res = self.execute("SELECT mri_series.* FROM " + series_table + " \
+                                   WHERE mri_series.session_id IN (SELECT mri_sessions.id FROM " + session_table + filter + ") \
+                                   ORDER BY mri_series.session_id, mri_series.id;", tuple(params))
+            if qry_res == -1: 
+                print("ERROR: Could not get MRI series of sessions.")
+                return -1
+            
+            for series in self.rows_to_dicts(qry_res):
+                if series["session_id"] in sessions_by_id:
+                    sessions_by_id[series["session_id"]]["series"].append(series)
 
-        return res  
+        return res
+
+    # get one page of mri sessions together with their participant (keyset pagination)
+    # the filters and sessions returned are the same as for "get_mri_sessions_with_participants"
+    # page_size: maximum number of sessions on the page
+    # cursor: cursor returned with the previous page (None: first page). The same filters and sorting must be used for all pages
+    # returns a dict with the sessions of the page ("records") and the cursor of the next page ("next_cursor", None if this is the last page)
+    def get_mri_sessions_page(self, page_size=100, cursor=None, sort_column="data_recorded_dt", sort_dir=None, **filters):
+
+        if sort_column == None:
+            sort_column = "id"
+
+        # get one more session than requested, to find out whether there is another page
+        sessions = self.get_mri_sessions_with_participants(sort_column=sort_column, sort_dir=sort_dir, limit=page_size+1, cursor=cursor, **filters)
+        if sessions == -1:
+            return -1
+        
+        return self.get_page(sessions, page_size, sort_column)
+
+    # get one page of participants (keyset pagination)
+    # study, group_assignment: only return the participants of this study or group
+    # see "get_mri_sessions_page" for the other arguments and the returned data
+    def get_participants_page(self, page_size=100, cursor=None, sort_column="id", sort_dir=None, study=None, group_assignment=None):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+        
+        # get sorting (participants are additionally sorted by id, so the order is unique)
+        sort_term = self.get_sort_term("participants", sort_column, sort_dir)
+        if sort_term == -1:
+            return -1
+        if sort_column != "id":
+            sort_term = sort_term + ", id " + self.get_sort_direction(sort_dir)
+
+        # generate filter
+        conditions = []
+        params = []
+        if study != None:
+            conditions.append("(study = ?)")
+            params.append(study)
+        if group_assignment != None:
+            conditions.append("(group_assignment = ?)")
+            params.append(group_assignment)
+        if cursor != None:
+            condition, condition_params = self.get_keyset_condition(sort_column, sort_dir, cursor)
+            conditions.append(condition)
+            params.extend(condition_params)
+
+        if len(conditions) > 0:
+            filter = " WHERE " + " AND ".join(conditions)
+        else:
+            filter = ""
+
+        # get one more participant than requested, to find out whether there is another page
+        qry_res = self.execute("SELECT * FROM participants" + filter + " ORDER BY " + sort_term + " LIMIT ?;", tuple(params) + (page_size+1,))
+        if qry_res == -1:
+            print("ERROR: Could not get participants.")
+            return -1
+
+        return self.get_page(self.rows_to_dicts(qry_res), page_size, sort_column)
+
+    # split records of a page from the additional record that indicates whether there is another page, and get the cursor of the next page
+    def get_page(self, records, page_size, sort_column):
+
+        if len(records) <= page_size:
+            return {"records": records, "next_cursor": None}
+        
+        records = records[:page_size]
+        last_record = records[-1]
+
+        return {"records": records, "next_cursor": {"value": last_record[sort_column], "id": last_record["id"]}}
+
+    # search mri sessions by a fragment of their description, session ID, participant IDs or the description of one of their series
+    # the search is not case-sensitive
+    # returns the ids of all matching sessions (sorted)
+    # the full-text search index only supports fragments of at least 3 characters. Shorter fragments (or databases without the
+    # search index) are searched by scanning the tables
+    def search(self, text, include_archived=False):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+        
+        if (text == None) or (len(text.strip()) < 1):
+            return []
+        text = text.strip()
+
+        # check if the search index exists (the column names are cached, so this doesn't require a query)
+        search_columns = self.get_column_names("mri_sessions_search")
+        search_index_exists = (search_columns != -1) and (len(search_columns) > 0)
+
+        if (len(text) >= 3) and search_index_exists:
+            # search for the fragment as a phrase (double quotes are escaped by doubling them)
+            # the index also contains archived sessions and series (their ids are never used by other records, see "new_record_id_expression")
+            phrase = "\"" + text.replace("\"", "\"\"") + "\""
+            qry = "SELECT rowid FROM mri_sessions_search WHERE (mri_sessions_search MATCH ?1)"
+            if not include_archived:
+                qry += " AND EXISTS (SELECT 1 FROM mri_sessions WHERE mri_sessions.id = mri_sessions_search.rowid)"
+            qry += " UNION SELECT mri_series.session_id FROM mri_series_search JOIN mri_series ON mri_series.id = mri_series_search.rowid WHERE mri_series_search MATCH ?1"
+            if include_archived:
+                qry += " UNION SELECT mri_series_archive.session_id FROM mri_series_search JOIN mri_series_archive ON mri_series_archive.id = mri_series_search.rowid WHERE mri_series_search MATCH ?1"
+            qry_res = self.execute(qry + ";", (phrase,))
+        else:
+            # escape wildcards of the LIKE operator
+            pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            qry = ""
+            for session_table, series_table in ((("mri_sessions", "mri_series"), ("mri_sessions_archive", "mri_series_archive")) if include_archived else (("mri_sessions", "mri_series"),)):
+                if len(qry) > 0:
+                    qry += " UNION "
+                qry += "SELECT mri_sessions.id FROM " + session_table + " AS mri_sessions LEFT JOIN participants ON participants.id = mri_sessions.participant_id \
+                        WHERE (mri_sessions.description LIKE ?1 ESCAPE '\\') OR (mri_sessions.participant_session_id LIKE ?1 ESCAPE '\\') \
+                        OR (participants.study_id LIKE ?1 ESCAPE '\\') OR (participants.deidentified_id LIKE ?1 ESCAPE '\\') \
+                        UNION SELECT session_id FROM " + series_table + " WHERE description LIKE ?1 ESCAPE '\\'"
+            qry_res = self.execute(qry + ";", (pattern,))
+        if qry_res == -1:
+            print("ERROR: Could not search MRI sessions.")
+            return -1
+
+        return sorted([row[0] for row in qry_res if row[0] != None])
+
+    # get current processing stage of mri sessions (see "mri_session_stages")
+    # stage: only return sessions in these stages (string or list of strings)
+    # ids: only return these sessions
+    # returns a dict with the stage of each session, indexed by session id
+    def get_mri_session_stages(self, stage=None, ids=None, exclude_skipped=False):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+
+        # generate filter
+        conditions = []
+        params = []
+        if stage != None:
+            if isinstance(stage, str):
+                stage = (stage,)
+            conditions.append("(stage IN (" + ",".join(["?"]*len(stage)) + "))")
+            params.extend(stage)
+        if ids != None:
+            conditions.append("(id IN (" + ",".join(["?"]*len(ids)) + "))")
+            params.extend(ids)
+        if exclude_skipped:
+            conditions.append("(skip_processing IS NOT 1)")
+
+        if len(conditions) > 0:
+            filter = " WHERE " + " AND ".join(conditions)
+        else:
+            filter = ""
+
+        qry_res = self.execute("SELECT id, stage FROM mri_sessions" + filter + " ORDER BY id;", tuple(params))
+        if qry_res == -1:
+            print("ERROR: Could not get stages of MRI sessions from database.")
+            return -1
+
+        return {row[0]: row[1] for row in qry_res}
 
     # find mri sessions with missing summary file
     def find_mri_sessions_with_missing_summary(self, exclude_skipped = False):
@@ -1012,9 +2296,9 @@ class db:
         column_names = ["id", "data_file", "data_recorded_date", "data_recorded_time"]
         column_list = ", ".join(column_names)
         if exclude_skipped:
-            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE ((summary_file IS NULL) OR (summary_file == \"\")) AND (skip_processing IS NOT 1);")
+            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE ((summary_file IS NULL) OR (summary_file = '')) AND (skip_processing IS NOT 1);")
         else:
-            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (summary_file IS NULL) OR (summary_file == \"\");")
+            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (summary_file IS NULL) OR (summary_file = '');")
         if qry_res == -1: 
             print("ERROR: Could not get MRI sessions with missing summary from database.")
             return -1
@@ -1023,9 +2307,7 @@ class db:
             return None
         
         # convert data to dict
-        res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        res = self.rows_to_dicts(qry_res)
         
         return res   
     
@@ -1041,9 +2323,9 @@ class db:
         column_names = ["id", "data_file"]
         column_list = ", ".join(column_names)
         if exclude_skipped:
-            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (data_downloaded_dt IS NULL) AND (skip_processing IS NOT 1);")
+            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (stage = 'data_download') AND (skip_processing IS NOT 1);")
         else:
-            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE data_downloaded_dt IS NULL;")
+            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE stage = 'data_download';")
         if qry_res == -1: 
             print("ERROR: Could not get MRI sessions with missing summary from database.")
             return -1
@@ -1052,9 +2334,7 @@ class db:
             return None
         
         # convert data to dict
-        res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        res = self.rows_to_dicts(qry_res)
         
         return res  
     
@@ -1070,9 +2350,9 @@ class db:
         column_names = ["id", "data_file", "summary_file"]
         column_list = ", ".join(column_names)
         if exclude_skipped:
-            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (summary_file IS NOT NULL) AND (summary_file != \"\") AND (summary_downloaded_dt IS NULL) AND (skip_processing IS NOT 1);")
+            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (summary_downloaded_dt IS NULL) AND (summary_file IS NOT NULL) AND (summary_file != '') AND (skip_processing IS NOT 1);")
         else:
-            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (summary_file IS NOT NULL) AND (summary_file != \"\") AND (summary_downloaded_dt IS NULL);")
+            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (summary_downloaded_dt IS NULL) AND (summary_file IS NOT NULL) AND (summary_file != '');")
         if qry_res == -1: 
             print("ERROR: Could not get MRI sessions with missing summary from database.")
             return -1
@@ -1081,9 +2361,7 @@ class db:
             return None
         
         # convert data to dict
-        res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        res = self.rows_to_dicts(qry_res)
 
         return res 
     
@@ -1110,9 +2388,7 @@ class db:
             return None
         
         # convert data to dict
-        res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        res = self.rows_to_dicts(qry_res)
 
         return res  
     
@@ -1139,9 +2415,7 @@ class db:
             return None
         
         # convert data to dict
-        res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        res = self.rows_to_dicts(qry_res)
 
         return res   
     
@@ -1157,9 +2431,9 @@ class db:
         column_list = ", ".join(column_names)
 
         if exclude_skipped:
-            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (data_downloaded_dt IS NOT NULL) AND (converted_to_nifti_dt IS NULL) AND (skip_processing IS NOT 1);")
+            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (stage = 'conversion_to_nifti') AND (skip_processing IS NOT 1);")
         else:
-            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (data_downloaded_dt IS NOT NULL) AND (converted_to_nifti_dt IS NULL);")
+            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE stage = 'conversion_to_nifti';")
         if qry_res == -1: 
             print("ERROR: Could not get MRI sessions requirig nifti conversion from database.")
             return -1
@@ -1168,9 +2442,7 @@ class db:
             return None
         
         # convert data to dict
-        res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        res = self.rows_to_dicts(qry_res)
 
         return res  
 
@@ -1186,9 +2458,9 @@ class db:
         column_list = ", ".join(column_names)
 
         if exclude_skipped:
-            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (data_downloaded_dt IS NOT NULL) AND (converted_to_nifti_dt IS NOT NULL) AND (conversion_validated_dt IS NULL) AND (skip_processing IS NOT 1);")
+            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (stage = 'data_validation') AND (skip_processing IS NOT 1);")
         else:
-            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (data_downloaded_dt IS NOT NULL) AND (converted_to_nifti_dt IS NOT NULL) AND (conversion_validated_dt IS NULL);")
+            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE stage = 'data_validation';")
         if qry_res == -1: 
             print("ERROR: Could not get MRI sessions requirig data validation from database.")
             return -1
@@ -1197,9 +2469,7 @@ class db:
             return None
         
         # convert data to dict
-        res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        res = self.rows_to_dicts(qry_res)
 
         return res   
 
@@ -1215,9 +2485,9 @@ class db:
         column_list = ", ".join(column_names)
 
         if exclude_skipped:
-            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (data_downloaded_dt IS NOT NULL) AND (converted_to_nifti_dt IS NOT NULL) AND (conversion_validated_dt IS NOT NULL) AND (conversion_validated_with_summary_dt IS NULL) AND (skip_processing IS NOT 1);")
+            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (stage = 'data_validation_with_summary') AND (skip_processing IS NOT 1);")
         else:
-            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE (data_downloaded_dt IS NOT NULL) AND (converted_to_nifti_dt IS NOT NULL) AND (conversion_validated_dt IS NOT NULL) AND (conversion_validated_with_summary_dt IS NULL);")
+            qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE stage = 'data_validation_with_summary';")
         if qry_res == -1: 
             print("ERROR: Could not get MRI sessions requirig data validation with summary from database.")
             return -1
@@ -1226,9 +2496,7 @@ class db:
             return None
         
         # convert data to dict
-        res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        res = self.rows_to_dicts(qry_res)
 
         return res  
 
@@ -1252,9 +2520,7 @@ class db:
             return None
         
         # convert data to dict
-        res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        res = self.rows_to_dicts(qry_res)
 
         return res  
 
@@ -1269,13 +2535,7 @@ class db:
         column_names = ["id", "participant_id", "data_file", "summary_file", "participant_session_id"]
         column_list = ", ".join(column_names)
 
-        filter = "(data_downloaded_dt IS NOT NULL) \
-        AND (converted_to_nifti_dt IS NOT NULL) \
-        AND (conversion_validated_dt IS NOT NULL) AND (conversion_validated_with_summary_dt IS NOT NULL) AND (conversion_valid IS 1) \
-        AND (study_id_validated_dt IS NOT NULL) AND (session_id_validated_dt IS NOT NULL) \
-        AND (participant_id IS NOT NULL) \
-        AND (participant_session_id IS NOT NULL) AND (participant_session_id IS NOT \"\") \
-        AND (data_converted_dt IS NULL)"
+        filter = "(stage = 'conversion_to_bids')"
         if exclude_skipped:
             qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE " + filter + " AND (skip_processing IS NOT 1);")
         else:
@@ -1288,9 +2548,7 @@ class db:
             return None
         
         # convert data to dict
-        res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        res = self.rows_to_dicts(qry_res)
 
         return res
     
@@ -1305,14 +2563,7 @@ class db:
         column_names = ["id", "participant_id", "data_file", "summary_file", "participant_session_id"]
         column_list = ", ".join(column_names)
 
-        filter = "(data_downloaded_dt IS NOT NULL) \
-        AND (converted_to_nifti_dt IS NOT NULL) \
-        AND (conversion_validated_dt IS NOT NULL) AND (conversion_validated_with_summary_dt IS NOT NULL) AND (conversion_valid IS 1) \
-        AND (study_id_validated_dt IS NOT NULL) AND (session_id_validated_dt IS NOT NULL) \
-        AND (participant_id IS NOT NULL) \
-        AND (participant_session_id IS NOT NULL) AND (participant_session_id IS NOT \"\") \
-        AND (data_converted_dt IS NOT NULL) \
-        AND (data_uploaded_dt IS NULL)"
+        filter = "(stage = 'upload')"
         if exclude_skipped:
             qry_res = self.execute("SELECT " + column_list + " FROM mri_sessions WHERE " + filter + " AND (skip_processing IS NOT 1);")
         else:
@@ -1325,9 +2576,7 @@ class db:
             return None
         
         # convert data to dict
-        res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        res = self.rows_to_dicts(qry_res)
 
         return res
     
@@ -1353,11 +2602,265 @@ class db:
             return None
         
         # convert data to dict
-        res = []
-        for row in qry_res:
-            res.append(dict(zip(column_names, row)))
+        res = self.rows_to_dicts(qry_res)
+
+        return res
+
+    # move uploaded sessions and their series to the archive tables, so the tables used for processing stay small
+    # archived sessions are still found by "get_mri_session_id" (so their data files are not added again) and can be restored (see "restore_mri_session")
+    # uploaded_before_dt: only archive sessions that were uploaded before this time (timestamp)
+    # returns the number of archived sessions
+    def archive_mri_sessions(self, uploaded_before_dt):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+        
+        qry_res = self.execute("SELECT id FROM mri_sessions WHERE (stage = 'complete') AND (data_uploaded_dt < ?);", (uploaded_before_dt,))
+        if qry_res == -1: 
+            print("ERROR: Could not get MRI sessions to archive from database.")
+            return -1
+        
+        session_ids = [row[0] for row in qry_res]
+        if len(session_ids) < 1:
+            return 0
+
+        if self.begin_bulk_write() == -1:
+            return -1
+        success = self.move_mri_sessions(session_ids, to_archive=True)
+        self.end_bulk_write(success)
+        if not success:
+            print("ERROR: Could not archive MRI sessions.")
+            return -1
+
+        return len(session_ids)
+
+    # move an archived session and its series back to the other sessions (e.g. to process it again)
+    def restore_mri_session(self, id):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+        
+        if not self.is_mri_session_archived(id):
+            print("ERROR: MRI session " + str(id) + " is not archived.")
+            return -1
+
+        if self.get_record_id_by_keys("mri_sessions", {"id": id}) != None:
+            print("ERROR: MRI session " + str(id) + " can't be restored, because its ID is used by another session.")
+            return -1
+
+        if self.begin_bulk_write() == -1:
+            return -1
+        success = self.move_mri_sessions([id], to_archive=False)
+        self.end_bulk_write(success)
+        if not success:
+            print("ERROR: Could not restore MRI session " + str(id) + ".")
+            return -1
+
+        return 1
+
+    # check if a session is archived
+    def is_mri_session_archived(self, id):
+
+        res = self.get_record_id_by_keys("mri_sessions_archive", {"id": id})
+        return (res != None) and (res != -1)
+
+    # move sessions and their series to or from the archive tables (must be called within a bulk write)
+    # the records keep their ids. The search index keeps the entries of moved records
+    # returns True if successful
+    def move_mri_sessions(self, session_ids, to_archive):
+
+        columns = {}
+        for table_name in archive_tables.keys():
+            columns[table_name] = self.get_column_names(table_name)
+            if columns[table_name] == -1:
+                return False
+
+        # move sessions in chunks, so the number of query parameters stays below the limit of SQLite
+        chunk_size = 500
+        for i in range(0, len(session_ids), chunk_size):
+            ids = session_ids[i:i+chunk_size]
+            placeholders = ",".join(["?"]*len(ids))
+
+            # copy sessions and series first and then delete them, so the foreign keys of the series remain valid
+            for table_name, key in (("mri_sessions", "id"), ("mri_series", "session_id")):
+                column_list = ", ".join(columns[table_name])
+                if to_archive:
+                    source, target = table_name, archive_tables[table_name]
+                else:
+                    source, target = archive_tables[table_name], table_name
+                if self.execute("INSERT INTO " + target + " (" + column_list + ") SELECT " + column_list + " FROM " + source + " WHERE " + key + " IN (" + placeholders + ");", ids) == -1:
+                    return False
+
+            for table_name, key in (("mri_series", "session_id"), ("mri_sessions", "id")):
+                if to_archive:
+                    source = table_name
+                else:
+                    source = archive_tables[table_name]
+                if self.execute("DELETE FROM " + source + " WHERE " + key + " IN (" + placeholders + ");", ids) == -1:
+                    return False
+
+        return True
+
+    # count mri sessions in each processing stage
+    # returns a dict with the number of sessions for every stage in "mri_session_stages"
+    def count_mri_sessions_by_stage(self, exclude_skipped = False):
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+
+        # get data
+        if exclude_skipped:
+            qry_res = self.execute("SELECT stage, COUNT(*) FROM mri_sessions WHERE skip_processing IS NOT 1 GROUP BY stage;")
+        else:
+            qry_res = self.execute("SELECT stage, COUNT(*) FROM mri_sessions GROUP BY stage;")
+        if qry_res == -1:
+            print("ERROR: Could not count MRI sessions by stage.")
+            return -1
+
+        # convert data to dict
+        res = dict.fromkeys(mri_session_stages, 0)
+        if qry_res != None:
+            for row in qry_res:
+                if row[0] in res:
+                    res[row[0]] = row[1]
+
+        return res
+
+    # get number of sessions of each participant (see "participant_stats" view)
+    # participant_ids: only get statistics of these participants (None: all participants)
+    # returns a dict with the statistics of every participant ("n_sessions", "n_converted_sessions", "n_uploaded_sessions" and "last_recorded_dt")
+    def get_participant_stats(self, participant_ids=None):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+        
+        # get data
+        if participant_ids == None:
+            qry_res = self.execute("SELECT * FROM participant_stats;")
+        else:
+            participant_ids = list(participant_ids)
+            qry_res = self.execute("SELECT * FROM participant_stats WHERE participant_id IN (" + ",".join(["?"]*len(participant_ids)) + ");", participant_ids)
+        if qry_res == -1:
+            print("ERROR: Could not get participant statistics.")
+            return -1
+
+        # convert data to dict
+        res = {}
+        for stats in self.rows_to_dicts(qry_res):
+            res[stats["participant_id"]] = stats
+
+        return res
+
+    # get number of sessions in each processing stage, and the session that has been waiting the longest (see "mri_session_stage_stats" view)
+    # returns a dict with the statistics of every stage in "mri_session_stages":
+    # "n_sessions" (not counting skipped sessions), "n_skipped", "oldest_waiting_since_dt", "oldest_session_id" and "oldest_session_description"
+    # the oldest session is the session that has been waiting the longest, not counting skipped sessions (None if no session is waiting)
+    def get_mri_session_stage_stats(self):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+        
+        # get data
+        qry_res = self.execute("SELECT * FROM mri_session_stage_stats;")
+        if qry_res == -1:
+            print("ERROR: Could not get MRI session stage statistics.")
+            return -1
+
+        # convert data to dict
+        res = {}
+        for stage in mri_session_stages:
+            res[stage] = {"n_sessions": 0, "n_skipped": 0, "oldest_waiting_since_dt": None, "oldest_session_id": None, "oldest_session_description": None}
+        for stats in self.rows_to_dicts(qry_res):
+            if not stats["stage"] in res:
+                continue
+            if stats["skipped"] == 1:
+                res[stats["stage"]]["n_skipped"] = stats["n_sessions"]
+            else:
+                res[stats["stage"]]["n_sessions"] = stats["n_sessions"]
+                res[stats["stage"]]["oldest_waiting_since_dt"] = stats["oldest_waiting_since_dt"]
+                res[stats["stage"]]["oldest_session_id"] = stats["oldest_session_id"]
+                res[stats["stage"]]["oldest_session_description"] = stats["oldest_session_description"]
+
+        return res
+
+    # get data version of the database
+    # the value changes whenever another connection commits changes to the database. It can only be compared to values returned by the same connection
+    def get_data_version(self):
+
+        res = self.execute("PRAGMA data_version;")
+        if (res == -1) or (res == None) or (len(res)<1):
+            print("ERROR: Could not get database data version.")
+            return -1
+        
+        return res[0][0]
+    
+    # get id of the last change recorded in the change log (0 if no changes were recorded yet)
+    def get_last_change_id(self):
+
+        res = self.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log';")
+        if res == -1:
+            print("ERROR: Could not get last change from database.")
+            return -1
+        
+        if (res == None) or (len(res)<1):
+            return 0
+        
+        return res[0][0]
+
+    # get all changes recorded after the given change, in the order in which they were made
+    # each change contains the name of the table, the id of the changed row, the id of its parent (see "change_log_tables"),
+    # the operation ("insert", "update" or "delete") and the time of the change
+    def get_changes(self, since_change_id=0):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+        
+        qry_res = self.execute("SELECT * FROM change_log WHERE id > ? ORDER BY id;", (since_change_id,))
+        if qry_res == -1: 
+            print("ERROR: Could not get changes from database.")
+            return -1
+        
+        # convert data to dict
+        res = self.rows_to_dicts(qry_res)
 
         return res
+    
+    # remove changes that are older than the given number of days from the change log
+    def remove_old_changes(self, max_age_days):
+
+        # make sure connection is open
+        if (self._connection == None) or (self._cursor == None):
+            print("ERROR: Database not opened.")
+            return -1
+        
+        qry_res = self.execute("DELETE FROM change_log WHERE changed_dt < ?;", (time.time()-max_age_days*24*3600,))
+        if qry_res == -1: 
+            print("ERROR: Could not remove old changes from database.")
+            return -1
+        
+        return 1
+
+    # convert rows returned by a query to dicts
+    # note: the column names are only read from the first row. This is much faster than converting each row with "dict(row)",
+    # which looks up every column by name
+    def rows_to_dicts(self, rows):
+
+        if (rows == None) or (len(rows) < 1):
+            return []
+        
+        column_names = rows[0].keys()
+        return [dict(zip(column_names, row)) for row in rows]
 
     # convert dictionary to query inputs
     def dict_to_query_input(self, d, keys_to_exclude = ()):
@@ -8,7 +8,16 @@ def _init():
     
     settings = {
         "db_path": "database/db.sqlite",
-        "n_default_query_attempts": 5
+        "journal_mode": "wal",
+        "busy_timeout_s": 30,
+        "use_file_lock": False,
+        "retry_initial_delay_s": 0.05,
+        "retry_max_delay_s": 2,
+        "retry_time_budget_s": 60,
+        "log_statements": False,
+        "slow_statement_threshold_ms": 100,
+        "change_log_retention_days": 7,
+        "archive_after_days": 30
     }
         
     return settings
@@ -38,6 +47,11 @@ def load_from_file(settings_file):
             print("ERROR: Unable to load settings file:\n")
             print(e)
             return -1 
+
+        # add default values for settings that were introduced after the file was created
+        for key, value in _init().items():
+            if not key in settings:
+                settings[key] = value
             
     else:
         # initialize settings
@@ -0,0 +1,104 @@
+# module collecting statistics about the statements executed on the MRI database
+# slow statements are written to a log file as soon as they are executed, and a summary of all statements is written at the end of a run
+
+import os
+import re
+import threading
+from datetime import datetime
+
+class statement_stats:
+
+    # class constructor
+    # slow_statement_file: file listing every statement that took longer than the threshold
+    # summary_file: file the aggregated statistics are written to (see "write_summary")
+    # slow_statement_threshold_ms: minimum duration of a statement to be considered slow (in ms)
+    def __init__(self, slow_statement_file, summary_file, slow_statement_threshold_ms=100):
+
+        self._slow_statement_file = slow_statement_file
+        self._summary_file = summary_file
+        self._slow_statement_threshold_s = slow_statement_threshold_ms/1000
+        self._slow_statement_log = None
+        self._stats = {}
+        self._start_dt = datetime.now()
+
+        # statements may be recorded by several threads at once (see "stage_scheduler")
+        self._lock = threading.Lock()
+
+    # record execution of a statement
+    # duration_s: total time (in s) spent executing the statement, including all attempts
+    # n_rows: number of rows returned (or changed, for INSERT/UPDATE/DELETE statements)
+    # n_retries: number of times the statement was executed again after a failed attempt
+    # wait_s: time (in s) spent waiting for other connections to release their locks
+    # success: False if all attempts failed
+    def record(self, cmd, duration_s, n_rows, n_retries, wait_s, success):
+
+        # statements that only differ in whitespace are aggregated
+        statement = re.sub(r"\s+", " ", cmd).strip()
+
+        with self._lock:
+            if not statement in self._stats:
+                self._stats[statement] = {"count": 0, "failed": 0, "total_s": 0.0, "max_s": 0.0, "rows": 0, "retries": 0, "wait_s": 0.0}
+            stats = self._stats[statement]
+            stats["count"] = stats["count"]+1
+            stats["total_s"] = stats["total_s"]+duration_s
+            stats["max_s"] = max(stats["max_s"], duration_s)
+            stats["rows"] = stats["rows"]+max(n_rows, 0)
+            stats["retries"] = stats["retries"]+n_retries
+            stats["wait_s"] = stats["wait_s"]+wait_s
+            if not success:
+                stats["failed"] = stats["failed"]+1
+
+            # log slow statements
+            if duration_s >= self._slow_statement_threshold_s:
+                self.log_slow_statement(statement, duration_s, n_rows, n_retries, wait_s)
+
+    # write slow statement to log file
+    def log_slow_statement(self, statement, duration_s, n_rows, n_retries, wait_s):
+
+        try:
+            if self._slow_statement_log == None:
+                os.makedirs(os.path.dirname(self._slow_statement_file), exist_ok=True)
+                self._slow_statement_log = open(self._slow_statement_file, "w")
+                self._slow_statement_log.write("Statements slower than " + "{:.0f}".format(1000*self._slow_statement_threshold_s) + " ms (run started " + str(self._start_dt) + ")\n")
+
+            self._slow_statement_log.write(str(datetime.now()) + " | " + "{:.1f}".format(1000*duration_s) + " ms"
+                                           + " | rows: " + str(n_rows)
+                                           + " | retries: " + str(n_retries)
+                                           + " | lock wait: " + "{:.1f}".format(1000*wait_s) + " ms"
+                                           + " | " + statement + "\n")
+            self._slow_statement_log.flush()
+        except Exception as e:
+            print("WARNING: Could not write to slow statement log:")
+            print(e)
+
+    # write summary of all recorded statements, sorted by total execution time
+    def write_summary(self):
+
+        if self._slow_statement_log != None:
+            self._slow_statement_log.close()
+            self._slow_statement_log = None
+
+        try:
+            os.makedirs(os.path.dirname(self._summary_file), exist_ok=True)
+            with open(self._summary_file, "w") as f:
+                total_s = sum([stats["total_s"] for stats in self._stats.values()])
+                total_count = sum([stats["count"] for stats in self._stats.values()])
+                f.write("Database statement summary\n")
+                f.write("Run started:  " + str(self._start_dt) + "\n")
+                f.write("Run finished: " + str(datetime.now()) + "\n")
+                f.write("Statements executed: " + str(total_count) + " (" + "{:.1f}".format(1000*total_s) + " ms)\n\n")
+                f.write("count | failed | total ms | mean ms | max ms | rows | retries | lock wait ms | statement\n")
+
+                for statement, stats in sorted(self._stats.items(), key=lambda item: item[1]["total_s"], reverse=True):
+                    f.write(str(stats["count"])
+                            + " | " + str(stats["failed"])
+                            + " | " + "{:.1f}".format(1000*stats["total_s"])
+                            + " | " + "{:.2f}".format(1000*stats["total_s"]/stats["count"])
+                            + " | " + "{:.1f}".format(1000*stats["max_s"])
+                            + " | " + str(stats["rows"])
+                            + " | " + str(stats["retries"])
+                            + " | " + "{:.1f}".format(1000*stats["wait_s"])
+                            + " | " + statement + "\n")
+        except Exception as e:
+            print("WARNING: Could not write database statement summary:")
+            print(e)
@@ -0,0 +1,104 @@
+# module with the job queue defacing anatomical images with pydeface (see "process_data.py")
+# pydeface registers each image to a template with FSL, which takes several minutes per image. The queue runs the jobs of
+# all images (of the same and of different sessions) on a pool of worker threads, so several images are defaced at once.
+# The number of jobs running at once is limited, and a job is only started if enough memory is free for it. Each job
+# writes the output of pydeface to its own log file
+
+import subprocess
+import threading
+import concurrent.futures
+
+# time (in s) after which a job waiting for memory checks again if enough memory is available
+memory_check_interval_s = 5
+
+# get memory currently available on this machine (in GB)
+# this is "MemAvailable" in /proc/meminfo, which includes page cache that can be reclaimed (unlike the free memory, which
+# drops to almost nothing while large files are copied)
+# returns None if the available memory can't be determined on this platform (only "memory_limit_gb" is used then)
+def get_available_memory_gb():
+
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1])/(1024**2) # value in kB
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return None
+
+class defacing_queue:
+
+    # class constructor
+    # max_workers: maximum number of pydeface jobs running at once
+    # memory_limit_gb: maximum memory (in GB) used by all jobs running at once (0 for no limit)
+    # memory_per_job_gb: memory (in GB) one pydeface job is expected to use
+    def __init__(self, max_workers=4, memory_limit_gb=0, memory_per_job_gb=2):
+
+        self._max_workers = max(int(max_workers), 1)
+        self._memory_limit_gb = memory_limit_gb
+        self._memory_per_job_gb = memory_per_job_gb
+        self._memory_reserved_gb = 0
+        self._n_running = 0
+        self._condition = threading.Condition()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="pydeface")
+
+    # check if a job can be started with the memory that is currently reserved and available
+    # a job is always started if no other job is running, so jobs can't wait forever
+    def can_start_job(self):
+
+        if self._n_running == 0:
+            return True
+
+        if (self._memory_limit_gb > 0) and (self._memory_reserved_gb + self._memory_per_job_gb > self._memory_limit_gb):
+            return False
+
+        available_memory_gb = get_available_memory_gb()
+        if (available_memory_gb != None) and (available_memory_gb < self._memory_per_job_gb):
+            return False
+
+        return True
+
+    # wait until a job can be started and reserve memory for it
+    def reserve_memory(self):
+
+        with self._condition:
+            while not self.can_start_job():
+                self._condition.wait(timeout=memory_check_interval_s)
+            self._memory_reserved_gb = self._memory_reserved_gb+self._memory_per_job_gb
+            self._n_running = self._n_running+1
+
+    # release memory reserved for a job once it completed
+    def release_memory(self):
+
+        with self._condition:
+            self._memory_reserved_gb = self._memory_reserved_gb-self._memory_per_job_gb
+            self._n_running = self._n_running-1
+            self._condition.notify_all()
+
+    # run pydeface job (runs in a worker thread)
+    # returns the return code of pydeface
+    def run_job(self, file_path, log_file_name):
+
+        self.reserve_memory()
+        try:
+            with open(log_file_name, "w") as logfile:
+                result = subprocess.run(["pydeface",
+                                         file_path,
+                                         "--outfile", file_path,
+                                         "--force"],
+                                         stdout=logfile)
+        finally:
+            self.release_memory()
+
+        return result.returncode
+
+    # queue job defacing an image (the image is replaced by the defaced image)
+    # log_file_name: file the output of pydeface is written to
+    # returns a future, whose result is the return code of pydeface
+    def submit(self, file_path, log_file_name):
+        return self._executor.submit(self.run_job, str(file_path), str(log_file_name))
+
+    # wait for all queued jobs to complete and stop the worker threads
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
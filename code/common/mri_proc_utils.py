@@ -394,4 +394,31 @@ def deidentify_files_and_folders(old_root_folder, new_root_folder, old_id, new_i
                     
 
 
-    return True
\ No newline at end of file
+    return True
+
+
+# move all files and folders of a folder into another folder (files that already exist in the destination folder are replaced)
+def merge_folders(src_folder, dst_folder):
+
+    # make sure source folder exists
+    if not Path(src_folder).exists():
+        print("ERROR: Could not find folder \"" + str(src_folder) + "\" to be merged.")
+        return -1
+
+    try:
+        for dirpath, dirnames, filenames in os.walk(src_folder):
+
+            # get equivalent path in destination folder
+            dirpath_stem = os.path.relpath(dirpath, src_folder)
+            new_dirpath = os.path.join(dst_folder, dirpath_stem)
+            os.makedirs(new_dirpath, exist_ok=True)
+
+            # move files
+            for filename in filenames:
+                os.replace(os.path.join(dirpath, filename), os.path.join(new_dirpath, filename))
+    except Exception as e:
+        print("ERROR: Unable to merge folder \"" + str(src_folder) + "\":\n")
+        print(e)
+        return -1
+
+    return True
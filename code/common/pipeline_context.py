@@ -0,0 +1,354 @@
+# module with the context shared by the stages of the MRI pipeline
+# the context loads each settings file only once, keeps one database connection and one connection to CBI Home and Box,
+# and redirects the output of the current stage to its log file. All stages can run in the same process (see "run_pipeline.py"),
+# so the cost of starting the interpreter, loading the settings and opening the database is only paid once per run
+
+import os
+import sys
+import threading
+import traceback
+from datetime import datetime
+
+from common import cbi_settings, local_sync_settings, processing_settings
+from common import database, database_settings
+from common import notifications, notification_settings
+from common import study_settings
+from common import box_sync_settings
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+rootdir = os.path.dirname(parentdir)
+
+# settings used by the stages: settings module, file name in the "settings" folder and name used in error messages
+settings_files = {"notification": (notification_settings, "notification_settings.json", "notification"),
+                  "cbi": (cbi_settings, "cbi_settings.json", "CBI"),
+                  "local_sync": (local_sync_settings, "local_sync_settings.json", "local sync"),
+                  "study": (study_settings, "study_settings.json", "study"),
+                  "processing": (processing_settings, "processing_settings.json", "processing"),
+                  "database": (database_settings, "database_settings.json", "database"),
+                  "box": (box_sync_settings, "box_sync_settings.json", "Box")}
+
+# raised by "terminate_after_error" to stop the current stage
+class stage_terminated(Exception):
+    pass
+
+# output stream that forwards everything written to it to a different stream in each thread
+# used by the scheduler (see "stage_scheduler") to collect the output of each work item separately
+class thread_output:
+
+    # class constructor
+    # default_stream: stream used by threads for which no stream was set
+    def __init__(self, default_stream):
+
+        self._default_stream = default_stream
+        self._local = threading.local()
+
+    # set stream of the calling thread (None to use the default stream)
+    def set_stream(self, stream):
+        self._local.stream = stream
+
+    # get stream of the calling thread
+    def get_stream(self):
+
+        stream = getattr(self._local, "stream", None)
+        if stream == None:
+            return self._default_stream
+        return stream
+
+    def write(self, text):
+        return self.get_stream().write(text)
+
+    def flush(self):
+        self.get_stream().flush()
+
+class pipeline_context:
+
+    # class constructor
+    def __init__(self):
+
+        self._settings = {}
+        self._db = None
+        self._current_study = None
+        self._current_study_read = False
+        self._cbi_ssh_client = None
+        self._box = None
+
+        # log file and name of the current stage
+        self._log_file = None
+        self._log_file_name = None
+        self._original_stdout = None
+        self._script_name = None
+
+        # log file used to name the statement logs (see "database.enable_statement_log"). If not set, the log file
+        # of the stage that opens the database is used
+        self.statement_log_file_name = None
+
+        # if False, errors are not reported by this context (used by worker contexts, whose errors are reported by the scheduler)
+        self.report_errors = True
+
+    # open log file of the current stage. Everything printed until the log file is closed is written to it
+    # title_lines: lines of the header written to the log file
+    def open_log_file(self, log_file_name, *title_lines):
+
+        self._log_file_name = log_file_name
+        self._log_file = open(log_file_name, "w")
+        self._original_stdout = sys.stdout
+        sys.stdout = self._log_file
+        print("--------------------------")
+        for line in title_lines:
+            print(line)
+        print(datetime.now())
+        print("--------------------------")
+
+    # close log file of the current stage
+    def close_log_file(self):
+
+        if self._log_file == None:
+            return
+
+        sys.stdout = self._original_stdout
+        self._log_file.close()
+        self._log_file = None
+
+    # get name of the log file of the current stage (None if the stage doesn't write a log file)
+    def get_log_file_name(self):
+        return self._log_file_name
+
+    # report an error of the current stage: close its log file and send a notification (with the log file, if there is one)
+    def report_error(self):
+
+        log_file_name = self._log_file_name if self._log_file != None else None
+        self.close_log_file()
+
+        if not self.report_errors:
+            return
+
+        self.send_error_notification(self._script_name, log_file_name)
+
+    # send notification about errors during the execution of a stage script
+    # log_file_name: log file attached to the notification (None to send the notification without attachment)
+    def send_error_notification(self, script_name, log_file_name=None):
+
+        settings_notification = self._settings.get("notification")
+        if (settings_notification == None) or (not settings_notification["errors"]["send_notification"]):
+            return
+
+        if log_file_name != None:
+            body = "Attention: Errors were encountered during the execution of '" + str(script_name) + "'\nPlease check the attached log file for further information."
+            attachments = (log_file_name, )
+        else:
+            body = "Attention: Errors were encountered during the execution of '" + str(script_name) + "'."
+            attachments = None
+
+        notifications.send_email(settings_notification["errors"]["subject"],
+                                 body,
+                                 settings_notification["errors"]["recipients"],
+                                 settings_notification["mail_server"]["address"],
+                                 settings_notification["mail_server"]["port"],
+                                 settings_notification["mail_server"]["user"],
+                                 settings_notification["mail_server"]["password"],
+                                 attachments)
+
+    # stop the current stage after an error (changes that were not committed are discarded by "run_stage")
+    # in a worker context of the scheduler, only the processing of the current session is stopped (see "stage_scheduler")
+    def terminate_after_error(self):
+
+        print("\nTerminating script.")
+        self.report_error()
+
+        raise stage_terminated()
+
+    # run a stage function with this context
+    # script_name: name of the stage script used in error notifications
+    # errors of the stage only stop this stage, as if it was run in its own process
+    # returns True if the stage completed, False if it was terminated after an error
+    def run_stage(self, script_name, run):
+
+        self._script_name = script_name
+        completed = False
+        try:
+            run(self)
+            completed = True
+        except stage_terminated:
+            pass
+        except Exception:
+            print("ERROR: Unexpected error in '" + str(self._script_name) + "':")
+            traceback.print_exc(file=sys.stdout)
+            print("\nTerminating script.")
+            self.report_error()
+
+        # discard changes the stage did not commit
+        if not completed:
+            self.rollback()
+
+        # make sure the output is not redirected to the log file of this stage anymore
+        self.close_log_file()
+        self._log_file_name = None
+        self._script_name = None
+
+        return completed
+
+    # discard changes to the database that were not committed
+    def rollback(self):
+
+        if self._db != None:
+            self._db.rollback()
+
+    # get settings (they are loaded from file when they are used for the first time)
+    # returns -1 if the settings could not be loaded
+    def get_settings(self, name):
+
+        if name in self._settings:
+            return self._settings[name]
+
+        settings_module, file_name, description = settings_files[name]
+        settings_file = os.path.join(rootdir,"settings",file_name)
+        settings = settings_module.load_from_file(settings_file)
+        if settings == -1:
+            print("ERROR: Unable to load " + description + " settings from \"" + settings_file + "\".")
+            return -1
+
+        self._settings[name] = settings
+        return settings
+
+    # use the given settings instead of loading them from file (e.g. for benchmarks using a temporary database)
+    def set_settings(self, name, settings):
+        self._settings[name] = settings
+
+    # get database connection (opened when it is used for the first time)
+    # returns -1 if the database settings could not be loaded
+    def get_db(self):
+
+        if self._db != None:
+            return self._db
+
+        settings_db = self.get_settings("database")
+        if settings_db == -1:
+            return -1
+
+        # log database statements, if requested
+        if self.statement_log_file_name != None:
+            database.enable_statement_log(settings_db, self.statement_log_file_name)
+        elif self._log_file_name != None:
+            database.enable_statement_log(settings_db, self._log_file_name)
+
+        self._db = database.connect(settings_db)
+        return self._db
+
+    # get id of the current study in the database (the study is added if it is not in the database yet)
+    # returns None if no study title is set in the study settings, and -1 if there was an error
+    def get_current_study(self):
+
+        if self._current_study_read:
+            return self._current_study
+
+        settings_study = self.get_settings("study")
+        db = self.get_db()
+        if (settings_study == -1) or (db == -1):
+            return -1
+
+        current_study = None
+        if (settings_study["title"] != None) and (isinstance(settings_study["title"], str)) and (settings_study["title"] != ""):
+            res = db.get_study(title=settings_study["title"])
+            if res == -1:
+                return -1
+            if res is not None:
+                current_study = res
+            else:
+                res = db.add_study(title=settings_study["title"], description=settings_study["description"])
+                if res == -1:
+                    return -1
+                current_study = res
+
+                # commit right away, so the write lock is not held while other contexts (e.g. stage scheduler workers) write
+                db.commit()
+
+        self._current_study = current_study
+        self._current_study_read = True
+
+        return current_study
+
+    # get SSH connection to CBI Home (connected when it is used for the first time)
+    # returns -1 if the connection could not be established
+    def get_cbi_ssh_client(self):
+
+        if self._cbi_ssh_client != None:
+            return self._cbi_ssh_client
+
+        settings_cbi = self.get_settings("cbi")
+        if settings_cbi == -1:
+            return -1
+
+        # imported here, so stages that don't access CBI Home don't need to load the SSH library
+        from common import cbi_query
+
+        ssh_client = cbi_query.connect(settings_cbi["connection"]["host"], settings_cbi["connection"]["credentials_file"])
+        if ssh_client == -1:
+            return -1
+
+        self._cbi_ssh_client = ssh_client
+        return ssh_client
+
+    # get Box client (connected when it is used for the first time)
+    # returns -1 if the connection could not be established
+    def get_box_client(self):
+
+        if self._box != None:
+            return self._box
+
+        settings_box = self.get_settings("box")
+        if settings_box == -1:
+            return -1
+
+        # imported here, so stages that don't access Box don't need to load the Box SDK
+        from common import box_client
+
+        box = box_client.box_client()
+        success = box.connect(
+            client_id=settings_box["authentication"]["client_id"],
+            client_secret=settings_box["authentication"]["client_secret"],
+            user_id=settings_box["authentication"]["user_id"]
+            )
+        if not success:
+            print("ERROR: Unable to connect to Box.")
+            return -1
+
+        self._box = box
+        return box
+
+    # create context used by a worker thread of the scheduler (see "stage_scheduler")
+    # the worker context shares the loaded settings, the current study and the Box client with this context,
+    # but opens its own database connection (a connection can only be used by the thread that opened it).
+    # Errors are not reported by the worker context, since they are collected and reported by the scheduler
+    def create_worker_context(self):
+
+        worker_context = pipeline_context()
+        worker_context._settings = self._settings
+        worker_context._current_study = self._current_study
+        worker_context._current_study_read = self._current_study_read
+        worker_context._box = self._box
+        worker_context.report_errors = False
+
+        return worker_context
+
+    # close all connections
+    def close(self):
+
+        self.close_log_file()
+
+        if self._db != None:
+            self._db.close()
+            self._db = None
+
+        if self._cbi_ssh_client != None:
+            self._cbi_ssh_client.close()
+            self._cbi_ssh_client = None
+
+        self._box = None
+
+# run a stage script on its own (used when a stage script is called directly instead of through "run_pipeline.py")
+def run_script(script_name, run):
+
+    context = pipeline_context()
+    context.run_stage(script_name, run)
+    context.close()
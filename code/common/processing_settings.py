@@ -12,12 +12,46 @@ def _init():
             "sourcedata_dir": "sourcedata",
             "data_dir": "data",
             "deidentified_data_dir": "deidentified_data",
-            "summary_file_wait_timeout_h": 36
+            "summary_file_wait_timeout_h": 36,
+            "extraction": {
+                "max_workers": 1,
+                "threads_per_worker": 0
+            },
+            "bids_conversion": {
+                "mode": "serial",
+                "max_workers": 4
+            },
+            "defacing": {
+                "max_workers": 1,
+                "memory_limit_gb": 16,
+                "memory_per_job_gb": 2
+            }
+        },
+        "scheduler": {
+            "enabled": False,
+            "max_workers": 4,
+            "max_workers_per_stage": {
+                "conversion_to_nifti": 2,
+                "data_validation": 2,
+                "data_validation_with_summary": 2,
+                "conversion_to_bids": 2,
+                "upload": 1,
+                "cleanup": 1
+            }
         }
     }
         
     return settings
 
+# add default values for settings that are missing in the given settings (e.g. settings that were introduced after the file was created)
+def add_defaults(settings, defaults):
+
+    for key, value in defaults.items():
+        if not key in settings:
+            settings[key] = value
+        elif isinstance(value, dict) and isinstance(settings[key], dict):
+            add_defaults(settings[key], value)
+
 # write settings to file    
 def write_to_file(settings, settings_file):
     
@@ -43,6 +77,9 @@ def load_from_file(settings_file):
             print("ERROR: Unable to load settings file:\n")
             print(e)
             return -1 
+
+        # add default values for settings that were introduced after the file was created
+        add_defaults(settings, _init())
             
     else:
         # initialize settings
@@ -0,0 +1,268 @@
+# module with the scheduler running the per-session stages of the MRI pipeline concurrently
+# each (session, stage) pair is a work item. When a session completes a stage, the work item for its next stage is queued,
+# so independent sessions move through the stages on their own, and a slow conversion of one session doesn't block the others.
+# Work items run on a pool of worker threads (the expensive steps run in external programs like dcm2niix, dcm2bids and pydeface,
+# which don't hold the interpreter lock). The number of work items running at once can be limited per stage
+
+import io
+import sys
+import time
+import traceback
+from datetime import datetime
+import concurrent.futures
+
+from common import pipeline_context
+
+class stage_scheduler:
+
+    # class constructor
+    # context: pipeline context used to prepare and finish the stages (see "pipeline_context")
+    # max_workers: maximum number of work items running at once (over all stages)
+    def __init__(self, context, max_workers=4):
+
+        self._context = context
+        self._max_workers = max(int(max_workers), 1)
+        self._stages = []
+
+    # add stage (stages have to be added in the order sessions pass through them)
+    # name: name of the stage, used for the settings and in the summary
+    # db_stage: value of the "stage" column of the mri_sessions table of sessions waiting for this stage
+    # script_name: name of the stage script used in error notifications
+    # log_file_name: log file of the stage; log_title: lines of the header of the log file
+    # prepare: function called once before the first session is processed. It returns the state shared by all
+    #          sessions, or None if the stage is disabled (sessions waiting for a disabled stage are not processed)
+    # process_session: function processing one session. Its return value is passed to "finish"
+    # finish: function called after all sessions were processed and the log file was closed (None if not needed)
+    # max_workers: maximum number of sessions processed by this stage at once
+    # include_series: pass the series of each session to "process_session"
+    # queue_pending: queue sessions that are already waiting for this stage when the scheduler starts. If False,
+    #                only sessions completing the previous stage during this run are processed by this stage
+    def add_stage(self, name, db_stage, script_name, log_file_name, log_title, prepare, process_session, finish=None,
+                  max_workers=1, include_series=False, queue_pending=True):
+
+        self._stages.append({"name": name,
+                             "db_stage": db_stage,
+                             "script_name": script_name,
+                             "log_file_name": log_file_name,
+                             "log_title": log_title,
+                             "prepare": prepare,
+                             "process_session": process_session,
+                             "finish": finish,
+                             "max_workers": max(int(max_workers), 1),
+                             "include_series": include_series,
+                             "queue_pending": queue_pending,
+                             "log_file": None,
+                             "state": None,
+                             "enabled": False,
+                             "pending": [],
+                             "running": 0,
+                             "results": [],
+                             "n_completed": 0,
+                             "n_failed": 0,
+                             "busy_s": 0.0})
+
+    # get stages with the number of processed sessions and the time spent processing them (see "add_stage")
+    def get_stages(self):
+        return self._stages
+
+    # open the log files of all stages and prepare the stages (in the calling thread)
+    def prepare_stages(self, output):
+
+        # errors are reported once all sessions were processed (see "run")
+        self._context.report_errors = False
+
+        for stage in self._stages:
+
+            stage["log_file"] = open(stage["log_file_name"], "w")
+            output.set_stream(stage["log_file"])
+
+            print("--------------------------")
+            for line in stage["log_title"]:
+                print(line)
+            print(datetime.now())
+            print("--------------------------")
+            print("Sessions are processed by the stage scheduler (at most " + str(stage["max_workers"]) + " at once).")
+
+            try:
+                stage["state"] = stage["prepare"](self._context)
+                stage["enabled"] = stage["state"] != None
+            except pipeline_context.stage_terminated:
+                stage["enabled"] = False
+                stage["n_failed"] = stage["n_failed"]+1
+            except Exception:
+                print("ERROR: Unexpected error in '" + stage["script_name"] + "':")
+                traceback.print_exc(file=sys.stdout)
+                print("\nTerminating script.")
+                stage["enabled"] = False
+                stage["n_failed"] = stage["n_failed"]+1
+
+            output.set_stream(None)
+
+        self._context.report_errors = True
+
+    # run work item: process one session in a stage (runs in a worker thread)
+    # returns a dict with the result of the work item and its output
+    def run_work_item(self, stage, session_id, output):
+
+        # collect the output of this work item, so the output of different sessions is not mixed in the log file
+        buffer = io.StringIO()
+        output.set_stream(buffer)
+
+        start_time = time.monotonic()
+        worker_context = self._context.create_worker_context()
+        completed = False
+        processed = False
+        result = None
+        try:
+            db = worker_context.get_db()
+            if db == -1: worker_context.terminate_after_error()
+
+            # get session (it is only processed if it is still waiting for this stage)
+            sessions = db.get_mri_sessions_with_participants(stage=stage["db_stage"], ids=(session_id,), exclude_skipped=True, include_series=stage["include_series"])
+            if sessions == -1: worker_context.terminate_after_error()
+
+            if len(sessions) > 0:
+                print("Session " + str(session_id) + " (\"" + str(sessions[0]["data_file"]) + "\"):")
+                result = stage["process_session"](worker_context, stage["state"], sessions[0])
+                processed = True
+            completed = True
+        except pipeline_context.stage_terminated:
+            pass
+        except Exception:
+            print("ERROR: Unexpected error in '" + stage["script_name"] + "' for session " + str(session_id) + ":")
+            traceback.print_exc(file=sys.stdout)
+            print("\nTerminating script.")
+
+        # discard changes the stage did not commit, and close the connection of this thread
+        if not completed:
+            worker_context.rollback()
+        worker_context.close()
+
+        output.set_stream(None)
+
+        return {"completed": completed,
+                "processed": processed,
+                "result": result,
+                "output": buffer.getvalue(),
+                "duration_s": time.monotonic() - start_time}
+
+    # get index of the stage a session is waiting for (None if the session doesn't wait for any of the stages after the given stage)
+    def get_next_stage_index(self, session_id, after_index):
+
+        db = self._context.get_db()
+        if db == -1:
+            return None
+
+        # the stage is updated by a trigger when the worker commits its changes (see "mri_session_stage_expression")
+        stages = db.get_mri_session_stages(ids=(session_id,), exclude_skipped=True)
+        if (stages == -1) or (not session_id in stages):
+            return None
+
+        for index in range(after_index+1, len(self._stages)):
+            if self._stages[index]["db_stage"] == stages[session_id]:
+                return index
+
+        return None
+
+    # run all stages
+    # returns False if there were errors in any stage
+    def run(self):
+
+        db = self._context.get_db()
+        if db == -1:
+            return False
+
+        # the output of each thread is redirected separately (see "pipeline_context.thread_output")
+        original_stdout = sys.stdout
+        output = pipeline_context.thread_output(original_stdout)
+        sys.stdout = output
+
+        success = True
+        try:
+            self.prepare_stages(output)
+
+            # queue sessions already waiting for one of the stages
+            stage_indices = {stage["db_stage"]: index for index, stage in enumerate(self._stages) if stage["queue_pending"]}
+            session_stages = db.get_mri_session_stages(stage=list(stage_indices.keys()), exclude_skipped=True)
+            if session_stages == -1:
+                session_stages = {}
+                success = False
+            for session_id, db_stage in session_stages.items():
+                self._stages[stage_indices[db_stage]]["pending"].append(session_id)
+
+            running = {}
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                while True:
+
+                    # start work items while workers are free
+                    # later stages are started first, so sessions that are further along are completed first
+                    for index in reversed(range(len(self._stages))):
+                        stage = self._stages[index]
+                        while (len(stage["pending"]) > 0) and (len(running) < self._max_workers):
+
+                            # skip sessions waiting for a disabled stage
+                            if not stage["enabled"]:
+                                stage["pending"].clear()
+                                break
+
+                            if stage["running"] >= stage["max_workers"]:
+                                break
+
+                            session_id = stage["pending"].pop(0)
+                            future = executor.submit(self.run_work_item, stage, session_id, output)
+                            running[future] = (index, session_id)
+                            stage["running"] = stage["running"]+1
+
+                    if len(running) == 0:
+                        break
+
+                    # wait for any work item to complete, then queue the next stage of its session
+                    done, _ = concurrent.futures.wait(running.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        index, session_id = running.pop(future)
+                        stage = self._stages[index]
+                        stage["running"] = stage["running"]-1
+
+                        item = future.result()
+                        stage["log_file"].write(item["output"])
+                        stage["log_file"].flush()
+                        stage["busy_s"] = stage["busy_s"]+item["duration_s"]
+
+                        if not item["completed"]:
+                            stage["n_failed"] = stage["n_failed"]+1
+                            continue
+                        if not item["processed"]:
+                            continue
+
+                        stage["n_completed"] = stage["n_completed"]+1
+                        stage["results"].append(item["result"])
+
+                        next_index = self.get_next_stage_index(session_id, index)
+                        if next_index != None:
+                            self._stages[next_index]["pending"].append(session_id)
+
+        finally:
+            sys.stdout = original_stdout
+
+            # close log files
+            for stage in self._stages:
+                if stage["log_file"] != None:
+                    stage["log_file"].write("\nProcessed " + str(stage["n_completed"]) + " session(s), " + str(stage["n_failed"]) + " error(s)\n")
+                    stage["log_file"].close()
+                    stage["log_file"] = None
+
+        # finish stages and report errors
+        for stage in self._stages:
+            if stage["enabled"] and (stage["finish"] != None):
+                try:
+                    stage["finish"](self._context, stage["state"], stage["results"])
+                except Exception:
+                    print("ERROR: Unexpected error while finishing '" + stage["script_name"] + "':")
+                    traceback.print_exc(file=sys.stdout)
+                    stage["n_failed"] = stage["n_failed"]+1
+
+            if stage["n_failed"] > 0:
+                success = False
+                self._context.send_error_notification(stage["script_name"], stage["log_file_name"])
+
+        return success
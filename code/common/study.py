@@ -1,23 +1,97 @@
 import random
 
+# allocator of deidentified IDs (prefix followed by a number with a fixed number of digits that doesn't start with zero)
+# the used IDs are kept in a set, so each allocation takes constant time on average:
+# while most IDs are free, random numbers are drawn until a free one is found. Once more than half of the IDs are used,
+# the remaining free IDs are shuffled into a pool and taken from there
+# a warning is printed when only few IDs are left, so the ID format can be changed before all IDs are used up
+class deidentified_id_allocator:
+
+    # class constructor
+    # used_ids: IDs that are already used (IDs with a different prefix or number of digits are ignored)
+    # low_fraction: print a warning once less than this fraction of all IDs is left
+    def __init__(self, used_ids=(), prefix="M", digits=3, low_fraction=0.1):
+
+        self._prefix = prefix
+        self._digits = digits
+        self._min_id = 10**(digits-1) # according to provided specs, ID should not start with zero
+        self._max_id = 10**digits -1
+        self._id_format = "{:0" + str(digits) + "d}"
+        self._low_fraction = low_fraction
+        self._pool = None
+
+        self._used_numbers = set()
+        for id in used_ids:
+            self.mark_used(id)
+
+    # number of IDs that can be allocated in total
+    def get_capacity(self):
+        return self._max_id - self._min_id + 1
+
+    # number of IDs that are still free
+    def get_n_free(self):
+        return self.get_capacity() - len(self._used_numbers)
+
+    # check if only few IDs are left
+    def is_running_low(self):
+        return self.get_n_free() < self._low_fraction*self.get_capacity()
+
+    # get number of an ID (None if the ID doesn't have the format of this allocator)
+    def get_number(self, id):
+
+        if (id == None) or (not isinstance(id, str)) or (not id.startswith(self._prefix)):
+            return None
+
+        number_str = id[len(self._prefix):]
+        if (len(number_str) != self._digits) or (not number_str.isdigit()):
+            return None
+
+        number = int(number_str)
+        if (number < self._min_id) or (number > self._max_id):
+            return None
+
+        return number
+
+    # mark ID as used (e.g. if it was entered by the user)
+    def mark_used(self, id):
+
+        number = self.get_number(id)
+        if number != None:
+            self._used_numbers.add(number)
+
+    # allocate a new ID (None if all IDs are used)
+    def allocate(self):
+
+        if self.get_n_free() < 1:
+            print("ERROR: All " + str(self.get_capacity()) + " deidentified IDs with prefix \"" + self._prefix + "\" and " + str(self._digits) + " digits are used.")
+            return None
+
+        # draw random numbers while most numbers are free (on average, less than two draws are needed)
+        if (self._pool == None) and (len(self._used_numbers) <= self.get_capacity()//2):
+            number = random.randrange(self._min_id, self._max_id+1)
+            while number in self._used_numbers:
+                number = random.randrange(self._min_id, self._max_id+1)
+        else:
+            # create pool of free numbers once (its size is at most the number of used IDs)
+            if self._pool == None:
+                self._pool = [number for number in range(self._min_id, self._max_id+1) if not number in self._used_numbers]
+                random.shuffle(self._pool)
+
+            # numbers may have been marked as used after the pool was created
+            number = self._pool.pop()
+            while number in self._used_numbers:
+                number = self._pool.pop()
+
+        self._used_numbers.add(number)
+
+        if self.is_running_low():
+            print("WARNING: Only " + str(self.get_n_free()) + " of " + str(self.get_capacity()) + " deidentified IDs with prefix \"" + self._prefix + "\" are left. Consider increasing the number of digits.")
+
+        return self._prefix + self._id_format.format(number)
+
 # generate deidentified ID that is different from already used IDs
-def generate_deidentified_id(used_ids=(), prefix="M", digits=3, max_attempts=100000):
-    
-    n_attempts=0
-    deidentified_id = None
-    
-    # get ID parameters
-    min_id = 10**(digits-1) # according to provided specs, ID should not start with zero
-    max_id = 10**digits -1
-    id_format = "{:0" + str(digits) + "d}"
-    
-    # search for new unique id
-    while (deidentified_id==None) or (deidentified_id in used_ids):
-        n_attempts = n_attempts+1
-        if n_attempts > max_attempts:
-            deidentified_id = None
-            break
-        
-        deidentified_id = prefix + id_format.format(random.randrange(min_id, max_id+1))
-        
-    return deidentified_id
\ No newline at end of file
+# returns None if all IDs are used (see "deidentified_id_allocator")
+def generate_deidentified_id(used_ids=(), prefix="M", digits=3):
+
+    allocator = deidentified_id_allocator(used_ids, prefix, digits)
+    return allocator.allocate()
@@ -0,0 +1,422 @@
+# This Python file uses the following encoding: utf-8
+# models used by the data viewer tables
+# the models only keep the records returned by the database. The text, colors and buttons of a cell are derived when the view
+# asks for them, so only the visible rows are ever materialized and no widget is created per row
+from datetime import datetime
+
+from PySide6.QtWidgets import QApplication, QStyledItemDelegate, QStyleOptionButton, QStyle
+from PySide6.QtGui import QColor
+from PySide6.QtCore import Qt, Signal, QEvent, QModelIndex, QSize, QAbstractTableModel, QSortFilterProxyModel
+
+# custom roles
+id_role = Qt.UserRole            # id of the record shown in a row
+button_role = Qt.UserRole+1      # text of the button drawn in a cell (None: no button)
+sort_role = Qt.UserRole+2        # value used to sort a column
+
+# colors used to highlight cells
+color_invalid = QColor(255,0,0)
+color_inactive = QColor(230,230,230)
+
+# table model showing one record (dict with an "id" key) per row
+class record_table_model(QAbstractTableModel):
+
+    _headers = ()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._records = []
+        self._rows = {}
+
+    # replace all records
+    def set_records(self, records):
+
+        self.beginResetModel()
+        self._records = list(records) if isinstance(records, list) else []
+        self._rows = {record["id"]: row for row, record in enumerate(self._records)}
+        self.endResetModel()
+
+    # replace a record with updated data (the record must already be shown)
+    def update_record(self, record):
+
+        if not record["id"] in self._rows:
+            return False
+
+        row = self._rows[record["id"]]
+        self._records[row] = record
+        self.dataChanged.emit(self.index(row, 0), self.index(row, self.columnCount()-1))
+
+        return True
+
+    # redraw rows of the given records (e.g. after data they depend on changed)
+    def refresh_records(self, ids):
+
+        for id in ids:
+            if id in self._rows:
+                row = self._rows[id]
+                self.dataChanged.emit(self.index(row, 0), self.index(row, self.columnCount()-1))
+
+    # get record by id (None if it is not shown)
+    def get_record(self, id):
+
+        if not id in self._rows:
+            return None
+        return self._records[self._rows[id]]
+
+    # get all records
+    def get_records(self):
+        return self._records
+
+    # get row of a record (-1 if it is not shown)
+    def get_row(self, id):
+        return self._rows.get(id, -1)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._records)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+
+        if (orientation == Qt.Horizontal) and (role == Qt.DisplayRole) and (section < len(self._headers)):
+            return self._headers[section]
+
+        return super().headerData(section, orientation, role)
+
+    def data(self, index, role=Qt.DisplayRole):
+
+        if (not index.isValid()) or (index.row() >= len(self._records)):
+            return None
+
+        record = self._records[index.row()]
+        column = index.column()
+
+        if role == Qt.DisplayRole:
+            return self.cell_text(record, column)
+        if role == Qt.BackgroundRole:
+            return self.cell_background(record, column)
+        if role == id_role:
+            return record["id"]
+        if role == button_role:
+            return self.cell_button(record, column)
+        if role == sort_role:
+            value = self.cell_sort_value(record, column)
+            return "" if value == None else value
+
+        return None
+
+    # text shown in a cell
+    def cell_text(self, record, column):
+        return None
+
+    # background color of a cell (None: default color)
+    def cell_background(self, record, column):
+        return None
+
+    # text of the button shown in a cell (None: no button)
+    def cell_button(self, record, column):
+        return None
+
+    # value used to sort a column (default: text of the cell)
+    def cell_sort_value(self, record, column):
+        return self.cell_text(record, column)
+
+# participants (Subject ID, De-identified ID, Group, "Edit" button)
+class participants_model(record_table_model):
+
+    _headers = ("Subject ID", "De-identified ID", "Group", "")
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._non_editable_participant_ids = set()
+
+    # set participants that can't be edited (have converted sessions)
+    # returns the ids of participants whose editability changed
+    def set_non_editable_participant_ids(self, non_editable_participant_ids):
+
+        changed_ids = set(non_editable_participant_ids) ^ self._non_editable_participant_ids
+        self._non_editable_participant_ids = set(non_editable_participant_ids)
+        self.refresh_records(changed_ids)
+
+        return changed_ids
+
+    def cell_text(self, record, column):
+
+        match column:
+            case 0: return record["study_id"]
+            case 1: return record["deidentified_id"]
+            case 2: return record["group_assignment"]
+
+        return None
+
+    def cell_button(self, record, column):
+
+        if (column == 3) and (not record["id"] in self._non_editable_participant_ids):
+            return "Edit"
+
+        return None
+
+    def cell_sort_value(self, record, column):
+
+        if column == 3:
+            return record["id"]
+
+        return self.cell_text(record, column)
+
+# mri sessions, together with their participant (see "get_mri_sessions_with_participants")
+# the last column contains the text shown in the session list of the series tab and is hidden in the sessions table
+# archived sessions (see "archive_mri_sessions" of the database) are marked with record["archived"] and shown in grey
+class mri_sessions_model(record_table_model):
+
+    _headers = ("Date", "Time", "Session Description", "Subject ID", "De-identified ID", "Session ID", "Data Valid" , "IDs Validated", "Skip", "Data Converted", "", "", "Session")
+
+    list_column = 12
+
+    # check if ID editing is allowed
+    def id_editing_allowed(self, record):
+        return record["data_converted_dt"] == None
+
+    # check if session is archived
+    def is_archived(self, record):
+        return record.get("archived", False)
+
+    # check if ID validation is required
+    def id_validation_required(self, record):
+        return self.id_editing_allowed(record) and ((record["study_id_validated_dt"] == None) or (record["session_id_validated_dt"] == None))
+
+    def cell_text(self, record, column):
+
+        participant = record["participant"]
+        match column:
+            case 0: return record["data_recorded_date"]
+            case 1: return record["data_recorded_time"]
+            case 2: return record["description"]
+            case 3: return None if participant == None else participant["study_id"]
+            case 4: return None if participant == None else participant["deidentified_id"]
+            case 5: return record["participant_session_id"]
+            case 6: return "" if (record["conversion_valid"] == None) else ("Y" if (record["conversion_valid"] == 1) else "N")
+            case 7: return "N" if self.id_validation_required(record) else "Y"
+            case 8: return "Y" if (record["skip_processing"] == 1) else "N"
+            case 9: return "N" if (record["data_converted_dt"] == None) else "Y"
+            case 12: return str(record["data_recorded_date"]) + " | " + str(record["description"]) + (" (archived)" if self.is_archived(record) else "")
+
+        return None
+
+    def cell_background(self, record, column):
+
+        if column >= 10:
+            return None
+
+        if self.is_archived(record):
+            return color_inactive
+
+        if self.id_validation_required(record):
+            return color_invalid
+
+        if (column == 6) and (record["conversion_valid"] != 1) and (record["skip_processing"] != 1):
+            return color_invalid
+        if (column == 8) and (record["skip_processing"] == 1):
+            return color_inactive
+        if (column == 9) and (record["data_converted_dt"] == None):
+            return color_inactive
+
+        return None
+
+    def cell_button(self, record, column):
+
+        # archived sessions can't be validated or edited (they are restored when they are reprocessed)
+        if (column == 10) and (not self.is_archived(record)):
+            if self.id_validation_required(record):
+                return "Validate"
+            if self.id_editing_allowed(record):
+                return "Edit"
+        if column == 11:
+            return "Reprocess"
+
+        return None
+
+    def cell_sort_value(self, record, column):
+
+        if column in (0, 1):
+            return record["data_recorded_dt"]
+
+        return self.cell_text(record, column)
+
+# mri series of a session
+class mri_series_model(record_table_model):
+
+    _headers = ("Series", "Date", "Time", "Series Description", "Files", "Files Valid", "dcm2bids Criteria Match", "Duplicates", "Skip", "Data Converted", "")
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._session_read_only = False
+
+    # replace all series
+    # session_read_only: series of converted or archived sessions can't be skipped or included
+    def set_series(self, series, session_read_only):
+
+        self._session_read_only = session_read_only
+        self.set_records(series)
+
+    def cell_text(self, record, column):
+
+        match column:
+            case 0: return "" if record["series_number"] == None else str(record["series_number"])
+            case 1: return None if record["series_recorded_dt"] == None else datetime.fromtimestamp(record["series_recorded_dt"]).strftime("%Y/%m/%d")
+            case 2: return None if record["series_recorded_dt"] == None else datetime.fromtimestamp(record["series_recorded_dt"]).strftime("%H:%M:%S.%f")
+            case 3: return record["description"]
+            case 4: return "" if record["number_files"] == None else str(record["number_files"])
+            case 5: return "Y" if record["files_valid"] == 1 else "N"
+            case 6: return "Y" if record["dcm2bids_criteria_in_config"] == 1 else "N"
+            case 7: return record["duplicate_series"]
+            case 8: return "Y" if record["skip_processing"] == 1 else "N"
+            case 9: return "N" if record["data_converted_dt"] == None else "Y"
+
+        return None
+
+    def cell_background(self, record, column):
+
+        if (column == 8) and (record["skip_processing"] == 1):
+            return color_inactive
+        if (column == 9) and (record["data_converted_dt"] == None):
+            return color_inactive
+
+        return None
+
+    def cell_button(self, record, column):
+
+        if (column == 10) and (not self._session_read_only) and (not record["data_converted_dt"]):
+            return "Include" if record["skip_processing"] == 1 else "Skip"
+
+        return None
+
+    def cell_sort_value(self, record, column):
+
+        if column == 0:
+            return record["series_number"]
+        if column in (1, 2):
+            return record["series_recorded_dt"]
+
+        return self.cell_text(record, column)
+
+# number of sessions in each processing stage (see "get_mri_session_stage_stats" of the database)
+class mri_session_stage_stats_model(record_table_model):
+
+    _headers = ("Stage", "Sessions", "Skipped", "Waiting Since", "Oldest Session")
+
+    # replace statistics of all stages
+    def set_stage_stats(self, stage_stats):
+
+        records = []
+        for stage, stats in stage_stats.items():
+            record = dict(stats)
+            record["id"] = stage
+            records.append(record)
+
+        self.set_records(records)
+
+    def cell_text(self, record, column):
+
+        match column:
+            case 0: return record["id"]
+            case 1: return str(record["n_sessions"])
+            case 2: return str(record["n_skipped"])
+            case 3: return None if record["oldest_waiting_since_dt"] == None else datetime.fromtimestamp(record["oldest_waiting_since_dt"]).strftime("%Y/%m/%d %H:%M")
+            case 4: return record["oldest_session_description"]
+
+        return None
+
+    def cell_background(self, record, column):
+
+        # sessions on hold need to be validated by the user
+        if (column == 1) and (record["id"] == "on_hold") and (record["n_sessions"] > 0):
+            return color_invalid
+
+        return None
+
+    def cell_sort_value(self, record, column):
+
+        match column:
+            case 1: return record["n_sessions"]
+            case 2: return record["n_skipped"]
+            case 3: return record["oldest_waiting_since_dt"]
+
+        return self.cell_text(record, column)
+
+# proxy model used to sort a table by clicking on its header without reading the data again
+# before the user sorts a column, the rows are shown in the order in which they were returned by the database
+# the rows can also be restricted to a set of records (e.g. the results of a search)
+class record_sort_proxy_model(QSortFilterProxyModel):
+
+    def __init__(self, source_model, parent=None):
+        super().__init__(parent)
+        self.setSourceModel(source_model)
+        self.setSortRole(sort_role)
+        self.setFilterKeyColumn(-1)
+        self.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        self._filter_ids = None
+
+    # only show the records with these ids (None: show all records)
+    def set_filter_ids(self, ids):
+
+        self._filter_ids = None if ids == None else set(ids)
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+
+        if self._filter_ids != None:
+            id = self.sourceModel().index(source_row, 0, source_parent).data(id_role)
+            if not id in self._filter_ids:
+                return False
+
+        return super().filterAcceptsRow(source_row, source_parent)
+
+    # values of different types (e.g. missing timestamps) are compared as text
+    def lessThan(self, left, right):
+
+        left_value = left.data(sort_role)
+        right_value = right.data(sort_role)
+        if type(left_value) != type(right_value):
+            return str(left_value) < str(right_value)
+
+        return left_value < right_value
+
+# delegate drawing a push button in every cell that has a button text (see "button_role")
+# clicks are reported through the "clicked" signal together with the index of the cell
+class button_delegate(QStyledItemDelegate):
+
+    clicked = Signal(QModelIndex)
+
+    def paint(self, painter, option, index):
+
+        text = index.data(button_role)
+        if text == None:
+            super().paint(painter, option, index)
+            return
+
+        button = QStyleOptionButton()
+        button.rect = option.rect.adjusted(1, 1, -1, -1)
+        button.text = text
+        button.state = QStyle.State_Enabled | QStyle.State_Raised
+        style = option.widget.style() if option.widget != None else QApplication.style()
+        style.drawControl(QStyle.CE_PushButton, button, painter, option.widget)
+
+    def sizeHint(self, option, index):
+
+        text = index.data(button_role)
+        if text == None:
+            return super().sizeHint(option, index)
+
+        return QSize(option.fontMetrics.horizontalAdvance(text) + 24, option.fontMetrics.height() + 10)
+
+    def editorEvent(self, event, model, option, index):
+
+        if index.data(button_role) == None:
+            return super().editorEvent(event, model, option, index)
+
+        if (event.type() == QEvent.MouseButtonRelease) and (event.button() == Qt.LeftButton) and option.rect.contains(event.position().toPoint()):
+            self.clicked.emit(index)
+            return True
+
+        # don't start editing or change the selection when a button is pressed
+        return event.type() in (QEvent.MouseButtonPress, QEvent.MouseButtonDblClick)
@@ -3,13 +3,10 @@ from pathlib import Path
 import shutil
 import sys
 import os
-from functools import partial
-from datetime import datetime
 import json
 
-from PySide6.QtWidgets import QApplication, QWidget, QTableWidgetItem, QPushButton, QMessageBox, QInputDialog, QLineEdit, QListWidgetItem
-from PySide6.QtGui import QColor
-from PySide6.QtCore import Qt
+from PySide6.QtWidgets import QApplication, QWidget, QMessageBox, QInputDialog, QLineEdit
+from PySide6.QtCore import Qt, QTimer
 
 currentdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.dirname(currentdir)
@@ -21,6 +18,8 @@ from common import study, study_settings
 from common import processing_settings
 
 import data_viewer_utils
+import data_viewer_models
+import data_viewer_worker
 
 # Important:
 # You need to run the following command to generate the ui_form.py file
@@ -40,15 +39,87 @@ class data_viewer_ui(QWidget):
     _all_study_ids = ()
     _all_deidentified_ids = ()
 
+    # models of the participant, session and series tables
+    _participants_model = None
+    _mri_sessions_model = None
+    _mri_series_model = None
+
+    # model of the status table (number of sessions in each processing stage)
+    _stage_stats_model = None
+
+    # proxy model of the session list in the series tab (shows the sessions of the session table that match the search)
+    _mri_session_list_model = None
+
+    # delay (in ms) after the last change of the search text before the search is run
+    _search_delay_ms = 300
+
+    # show archived sessions in the session table and the session list (read by the worker thread)
+    _show_archived = False
+
+    # cache of the series shown in the series table (by session), and the number of sessions it keeps
+    # the series of the most recent sessions are read together with the sessions
+    _series_cache = None
+    _series_cache_size = 100
+
+    # number of rows used to compute the width of the table columns
+    _resize_contents_precision = 200
+
+    # worker running the database queries in the background
+    _worker = None
+
+    # delay (in ms) before the busy indicator is shown
+    _busy_indicator_delay_ms = 300
+
+    # connection used to check for changes, data version and id of the last change seen by the last refresh
+    # (only used by the worker thread)
+    _db_watch = None
+    _data_version = None
+    _last_change_id = 0
+
+    # interval (in ms) at which the database is checked for changes
+    _refresh_interval_ms = 2000
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.ui = Ui_data_viewer_ui()
         self.ui.setupUi(self)
 
+        # set up table models. The session list of the series tab shows the sessions of the session table
+        self._participants_model = data_viewer_models.participants_model(self)
+        self._mri_sessions_model = data_viewer_models.mri_sessions_model(self)
+        self._mri_series_model = data_viewer_models.mri_series_model(self)
+        self.setup_table_view(self.ui.tableView_participants, self._participants_model, self.participant_button_clicked)
+        self.setup_table_view(self.ui.tableView_mri_sessions, self._mri_sessions_model, self.mri_session_button_clicked)
+        self.setup_table_view(self.ui.tableView_mri_series, self._mri_series_model, self.mri_series_button_clicked)
+        self._stage_stats_model = data_viewer_models.mri_session_stage_stats_model(self)
+        self.setup_table_view(self.ui.tableView_stage_stats, self._stage_stats_model)
+        self.ui.tableView_mri_sessions.setColumnHidden(self._mri_sessions_model.list_column, True)
+        self._mri_session_list_model = data_viewer_models.record_sort_proxy_model(self._mri_sessions_model, self)
+        self.ui.listView_mri_session_series.setModel(self._mri_session_list_model)
+        self.ui.listView_mri_session_series.setModelColumn(self._mri_sessions_model.list_column)
+
+        # search once the user stopped typing
+        self._search_timer = QTimer(self)
+        self._search_timer.setSingleShot(True)
+        self._search_timer.timeout.connect(self.search_sessions)
+
+        # series are cached, so selecting a session doesn't require a query in most cases
+        self._series_cache = data_viewer_utils.session_series_cache(self._series_cache_size)
+
+        # run database queries in the background. The busy indicator is only shown if a query takes a while
+        self._worker = data_viewer_worker.db_worker(self)
+        self._worker.busy_changed.connect(self.worker_busy_changed)
+        self.ui.progressBar_busy.setVisible(False)
+        self._busy_indicator_timer = QTimer(self)
+        self._busy_indicator_timer.setSingleShot(True)
+        self._busy_indicator_timer.timeout.connect(lambda: self.ui.progressBar_busy.setVisible(True))
+
         # define connections to signals
         self.ui.pushButton_new_participant.clicked.connect(self.pushButton_new_participant_clicked)
         self.ui.pushButton_reload_db.clicked.connect(self.load_db)
-        self.ui.listWidget_mri_session_series.currentItemChanged.connect(self.update_session_series_table)
+        self.ui.lineEdit_search.textChanged.connect(lambda text: self._search_timer.start(self._search_delay_ms))
+        self.ui.checkBox_show_archived.toggled.connect(self.checkBox_show_archived_toggled)
+        self.ui.listView_mri_session_series.selectionModel().currentChanged.connect(self.update_session_series_table)
 
         # get database settings from file
         db_settings_file = os.path.join(rootdir,"settings","database_settings.json")
@@ -56,6 +127,9 @@ class data_viewer_ui(QWidget):
         if self._settings_db == -1:
             res = QMessageBox.critical(self, "Data Viewer", "Unable to load database settings from \"" + db_settings_file + "\".")
             self._settings_db = None
+        else:
+            # log database statements, if requested
+            database.enable_statement_log(self._settings_db, os.path.join(rootdir,"log","data_viewer_log.txt"))
 
         # get study settings from file
         study_settings_file = os.path.join(rootdir,"settings","study_settings.json")
@@ -74,168 +148,426 @@ class data_viewer_ui(QWidget):
         # load data from db and populate tables
         self.load_db()
 
+        # check database for changes periodically
+        self._refresh_timer = QTimer(self)
+        self._refresh_timer.timeout.connect(self.refresh_db)
+        self._refresh_timer.start(self._refresh_interval_ms)
+
+    # show model in table view
+    # the rows can be sorted by clicking on the column headers (through a proxy model, without reading the data again) and
+    # the buttons are drawn by a delegate, so no widgets need to be created for the rows
+    def setup_table_view(self, table_view, model, button_clicked=None):
+
+        proxy_model = data_viewer_models.record_sort_proxy_model(model, table_view)
+        table_view.setModel(proxy_model)
+        table_view.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        table_view.setSortingEnabled(True)
+
+        # only a limited number of rows is used to compute the column widths
+        table_view.horizontalHeader().setResizeContentsPrecision(self._resize_contents_precision)
+
+        if button_clicked != None:
+            delegate = data_viewer_models.button_delegate(table_view)
+            delegate.clicked.connect(button_clicked)
+            table_view.setItemDelegate(delegate)
+
     def closeEvent(self, event):
 
+        # stop checking for changes and close connection used to check for changes
+        self._refresh_timer.stop()
+        self._worker.run("close", self.close_watch_db, coalesce=False)
+        self._worker.wait()
+
         # quit
         app.quit()
 
+    # show busy indicator while the worker is running queries
+    def worker_busy_changed(self, busy):
+
+        if busy:
+            self._busy_indicator_timer.start(self._busy_indicator_delay_ms)
+        else:
+            self._busy_indicator_timer.stop()
+            self.ui.progressBar_busy.setVisible(False)
+
     def load_db(self):
 
         if (self._settings_db == None) or (self._settings_db == -1):
             return
 
-        # connect to database
-        db = database.db(self._settings_db["db_path"])
-        db.n_default_query_attempts = self._settings_db["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
+        # a waiting refresh is not needed anymore
+        self._worker.cancel_queued("refresh")
+        self._worker.run("load", self.read_all_data, callback=self.all_data_read)
+
+    # read all participants and sessions (runs in the worker thread)
+    def read_all_data(self):
+
+        # get data version and last change before reading the data (changes made in the meantime are applied again by the next refresh)
+        db_watch = self.get_watch_db()
+        self._data_version = db_watch.get_data_version()
+        self._last_change_id = db_watch.get_last_change_id()
+
+        # connect to database (read-only)
+        db = database.connect(self._settings_db, read_only=True)
 
         # get paricipants
         participants = db.get_all_participant_data(sort_column="id", sort_dir="descending")
+
+        # get mri sessions (together with the data of their participants)
+        mri_sessions = db.get_mri_sessions_with_participants(sort_column="data_recorded_dt", sort_dir="descending")
+
+        # get archived sessions, if requested, and sort them in with the other sessions (sessions without recording time last)
+        if self._show_archived and isinstance(mri_sessions, list):
+            archived_sessions = db.get_mri_sessions_with_participants(sort_column="data_recorded_dt", sort_dir="descending", archived=True)
+            if archived_sessions == -1:
+                mri_sessions = -1
+            else:
+                for session in archived_sessions:
+                    session["archived"] = True
+                mri_sessions = sorted(mri_sessions + archived_sessions, key=lambda session: (session["data_recorded_dt"] != None, session["data_recorded_dt"] or 0), reverse=True)
+
+        # get series of the most recent sessions
+        series = None
+        if isinstance(mri_sessions, list):
+            series = db.get_mri_series_of_sessions([session["id"] for session in mri_sessions[:self._series_cache_size]], sort_column="series_recorded_dt", sort_dir="ascending", include_archived=self._show_archived)
+
+        # get number of sessions of each participant and of each processing stage
+        participant_stats = db.get_participant_stats()
+        stage_stats = db.get_mri_session_stage_stats()
+
+        # close connection to database
+        db.close()
+
+        return {"participants": participants, "mri_sessions": mri_sessions, "series": series, "participant_stats": participant_stats, "stage_stats": stage_stats}
+
+    # populate tables with the data read by "read_all_data"
+    def all_data_read(self, data):
+
+        if data == -1:
+            res = QMessageBox.critical(self, "Data Viewer", "Unable to read data from database.")
+            return
+
+        participants = data["participants"]
         if participants == -1:
             res = QMessageBox.critical(self, "Data Viewer", "Unable to get all participant data.")
 
+        mri_sessions = data["mri_sessions"]
+        if mri_sessions == -1:
+            res = QMessageBox.critical(self, "Data Viewer", "Unable to get all MRI session data data.")
+            mri_sessions = None
+
+        # remember selected session
+        selected_session_id = self.get_selected_session_id()
+
         # get all study IDs and deidentified IDs
         all_study_ids, all_deidentified_ids = data_viewer_utils.get_all_ids(participants)
         self._all_study_ids = all_study_ids
         self._all_deidentified_ids = all_deidentified_ids
 
-        # get mri sessions
-        mri_sessions = db.get_all_mri_session_data(sort_column="data_recorded_dt", sort_dir="descending")
-        if mri_sessions == -1:
-            res = QMessageBox.critical(self, "Data Viewer", "Unable to get all MRI session data data.")
-
-        # get mri series
-        mri_series = db.get_all_mri_series_data()
-        if mri_series == -1:
-            res = QMessageBox.critical(self, "Data Viewer", "Unable to get all MRI series data.")
+        # fill series cache (most recent session last, so it is removed last)
+        self._series_cache.clear()
+        if isinstance(data["series"], dict):
+            for session_id, series in reversed(data["series"].items()):
+                self._series_cache.put(session_id, series)
 
         # populate participant table
-        self.ui.tableWidget_participants.clear()
-        self.ui.tableWidget_participants.setColumnCount(4)
-        self.ui.tableWidget_participants.setHorizontalHeaderLabels(("Subject ID", "De-identified ID", "Group", ""))
+        # participants that can't be edited (have converted sessions) don't get an "Edit" button
+        if data["participant_stats"] == -1:
+            res = QMessageBox.critical(self, "Data Viewer", "Unable to get participant statistics.")
+        self._participants_model.set_non_editable_participant_ids(data_viewer_utils.get_non_editable_participant_ids(data["participant_stats"]))
+        self._participants_model.set_records(participants)
+        self.ui.tableView_participants.resizeColumnsToContents()
 
-        if isinstance(participants,list):
-            self.ui.tableWidget_participants.setRowCount(len(participants))
-            row_ind = -1
-            for participant in participants:
+        # populate status table
+        self.show_stage_stats(data["stage_stats"])
 
-                # parse participant data
-                record_id = participant["id"]
-                study_id = participant["study_id"]
-                deidentified_id = participant["deidentified_id"]
-                group_assignment = participant["group_assignment"]
-                row_ind = row_ind+1
+        # populate mri session table and list
+        self.ui.listView_mri_session_series.selectionModel().blockSignals(True)
+        self._mri_sessions_model.set_records(mri_sessions)
+        self.ui.tableView_mri_sessions.resizeColumnsToContents()
 
-                # check if participant can be edited (has no converted sessions)
-                participant_is_editable = data_viewer_utils.get_participant_editable(self, db, record_id)
+        # restore session selection
+        row = self._mri_sessions_model.get_row(selected_session_id)
+        if (row == -1) and (self._mri_sessions_model.rowCount() > 0):
+            row = 0
+        if row != -1:
+            self.ui.listView_mri_session_series.setCurrentIndex(self._mri_session_list_model.mapFromSource(self._mri_sessions_model.index(row, self._mri_sessions_model.list_column)))
 
-                # populate table
-                self.ui.tableWidget_participants.setItem(row_ind,0,QTableWidgetItem(study_id))
-                self.ui.tableWidget_participants.setItem(row_ind,1,QTableWidgetItem(deidentified_id))
-                self.ui.tableWidget_participants.setItem(row_ind,2,QTableWidgetItem(group_assignment))
+        # re-activate session list
+        self.ui.listView_mri_session_series.selectionModel().blockSignals(False)
 
-                if participant_is_editable:
-                    bt = QPushButton("Edit")
-                    bt.clicked.connect(partial(self.edit_participant_button_pressed,self.ui.tableWidget_participants, row_ind, record_id, study_id))
-                    self.ui.tableWidget_participants.setCellWidget(row_ind,3,bt)
+        # update series table
+        self.update_session_series_table()
 
-            self.ui.tableWidget_participants.resizeColumnsToContents()
+        # sessions may have been added, so search again
+        if self.get_search_text() != "":
+            self.search_sessions()
 
+    # get connection used to check the database for changes (only used in the worker thread)
+    # the connection is kept open, since the data version can only be compared to values returned by the same connection
+    def get_watch_db(self):
 
-        # populate mri session table and list
-        self.ui.tableWidget_mri_sessions.clear()
-        self.ui.tableWidget_mri_sessions.setColumnCount(12)
-        self.ui.tableWidget_mri_sessions.setHorizontalHeaderLabels(("Date", "Time", "Session Description", "Subject ID", "De-identified ID", "Session ID", "Data Valid" , "IDs Validated", "Skip", "Data Converted", "", ""))
+        if self._db_watch == None:
+            self._db_watch = database.connect(self._settings_db, read_only=True)
 
-        self.ui.listWidget_mri_session_series.blockSignals(True)
-        self.ui.listWidget_mri_session_series.clear()
-        self.ui.listWidget_mri_session_series.setEnabled(False)
-        
-        if isinstance(mri_sessions,list):
-            self.ui.tableWidget_mri_sessions.setRowCount(len(mri_sessions))
-            row_ind = -1
-            for session in mri_sessions:
-
-                # parse session data
-                record_id = session["id"]
-                participant_id = session["participant_id"]
-                participant_session_id = session["participant_session_id"]
-                description = session["description"]
-                data_recorded_date = session["data_recorded_date"]
-                data_recorded_time = session["data_recorded_time"]
-                data_recorded_dt = session["data_recorded_dt"]
-                conversion_validated_dt = session["conversion_validated_dt"]
-                conversion_validated_with_summary_dt = session["conversion_validated_with_summary_dt"]
-                conversion_valid = session["conversion_valid"]
-                study_id_validated_dt = session["study_id_validated_dt"]
-                session_id_validated_dt = session["session_id_validated_dt"]
-                skip_processing = session["skip_processing"]
-                data_converted_dt = session["data_converted_dt"]
-                row_ind = row_ind+1
-
-                # get participant data
-                study_id, deidentified_id, group_assignment = data_viewer_utils.get_participant_data_for_session(self, db, participant_id)
-
-                # check if ID editing is allowed
-                id_editing_allowed = data_converted_dt == None
-
-                # check if ID validation is required
-                id_validation_required = id_editing_allowed and ((study_id_validated_dt == None) or (session_id_validated_dt == None))
-
-                # populate table
-                self.ui.tableWidget_mri_sessions.setItem(row_ind,0,QTableWidgetItem(data_recorded_date))
-                self.ui.tableWidget_mri_sessions.setItem(row_ind,1,QTableWidgetItem(data_recorded_time))
-                self.ui.tableWidget_mri_sessions.setItem(row_ind,2,QTableWidgetItem(description))
-                self.ui.tableWidget_mri_sessions.setItem(row_ind,3,QTableWidgetItem(study_id))
-                self.ui.tableWidget_mri_sessions.setItem(row_ind,4,QTableWidgetItem(deidentified_id))
-                self.ui.tableWidget_mri_sessions.setItem(row_ind,5,QTableWidgetItem(participant_session_id))
-                self.ui.tableWidget_mri_sessions.setItem(row_ind,6,QTableWidgetItem("" if (conversion_valid == None) else ("Y" if (conversion_valid == 1) else "N")))
-                self.ui.tableWidget_mri_sessions.setItem(row_ind,7,QTableWidgetItem("N" if id_validation_required else "Y"))
-                self.ui.tableWidget_mri_sessions.setItem(row_ind,8,QTableWidgetItem("Y" if (skip_processing == 1) else "N"))
-                self.ui.tableWidget_mri_sessions.setItem(row_ind,9,QTableWidgetItem("N" if (data_converted_dt == None) else "Y"))
-
-                if conversion_valid!=1 and skip_processing!=1:
-                    self.ui.tableWidget_mri_sessions.item(row_ind,6).setBackground(QColor(255,0,0))
-
-                if skip_processing==1:
-                    self.ui.tableWidget_mri_sessions.item(row_ind,8).setBackground(QColor(230,230,230))
-
-                if data_converted_dt == None:
-                    self.ui.tableWidget_mri_sessions.item(row_ind,9).setBackground(QColor(230,230,230))
-
-                if id_validation_required:
-                    bt = QPushButton("Validate")
-                    bt.clicked.connect(partial(self.validate_mri_session_button_pressed,self.ui.tableWidget_mri_sessions, row_ind, record_id, description))
-                    self.ui.tableWidget_mri_sessions.setCellWidget(row_ind,10,bt)
-
-                    for j in range(self.ui.tableWidget_mri_sessions.columnCount()-2):
-                        self.ui.tableWidget_mri_sessions.item(row_ind,j).setBackground(QColor(255,0,0))
-
-                elif id_editing_allowed:
-                    bt = QPushButton("Edit")
-                    bt.clicked.connect(partial(self.edit_mri_session_button_pressed,self.ui.tableWidget_mri_sessions, row_ind, record_id, description))
-                    self.ui.tableWidget_mri_sessions.setCellWidget(row_ind,10,bt)
-
-                bt = QPushButton("Reprocess")
-                bt.clicked.connect(partial(self.reprocess_mri_session_button_pressed,self.ui.tableWidget_mri_sessions, row_ind, record_id, description))
-                self.ui.tableWidget_mri_sessions.setCellWidget(row_ind,11,bt)
-
-                # add item to session list
-                session_item = QListWidgetItem(data_recorded_date + " | " + description)
-                session_item.setData(Qt.UserRole, record_id)
-                self.ui.listWidget_mri_session_series.addItem(session_item)
-                self.ui.listWidget_mri_session_series.setEnabled(True)
-                self.ui.listWidget_mri_session_series.setCurrentRow(0)
-
-            self.ui.tableWidget_mri_sessions.resizeColumnsToContents()
+        return self._db_watch
+
+    # close connection used to check the database for changes (runs in the worker thread)
+    def close_watch_db(self):
+
+        if self._db_watch != None:
+            self._db_watch.close()
+            self._db_watch = None
+
+    # get id of the session selected in the session list of the series tab (None if no session is selected)
+    def get_selected_session_id(self):
+
+        index = self.ui.listView_mri_session_series.currentIndex()
+        if not index.isValid():
+            return None
+
+        return index.data(data_viewer_models.id_role)
+
+    # refresh only the rows that changed since the last refresh
+    # a full reload is only needed if participants or sessions were added or removed, or if the order of the sessions changed
+    def refresh_db(self):
+
+        if (self._settings_db == None) or (self._settings_db == -1):
+            return
+
+        # a pending full reload already includes all changes
+        if self._worker.is_pending("load"):
+            return
+
+        # every refresh continues where the previous one stopped, so no result may be dropped
+        self._worker.run("refresh", self.read_changes, callback=self.changes_read, drop_stale=False)
+
+    # read rows that changed since the last refresh (runs in the worker thread)
+    # returns None if nothing changed, and all data (see "read_all_data") if the tables need to be reloaded
+    def read_changes(self):
+
+        # check if other connections committed changes since the last refresh (cheap, no data is read)
+        db_watch = self.get_watch_db()
+        data_version = db_watch.get_data_version()
+        if (data_version == -1) or (data_version == self._data_version):
+            return None
+        self._data_version = data_version
+
+        # get changes since the last refresh
+        changes = db_watch.get_changes(self._last_change_id)
+        if changes == -1:
+            return {"all_data": self.read_all_data()}
+        if len(changes) < 1:
+            return None
+
+        # reload everything if changes were removed from the change log before they could be applied (ids are never reused)
+        if changes[0]["id"] != self._last_change_id+1:
+            return {"all_data": self.read_all_data()}
+        self._last_change_id = changes[-1]["id"]
+
+        # get changed rows
+        participant_ids = set()
+        session_ids = set()
+        series_session_ids = set()
+        for change in changes:
+            if (change["table_name"] in ("participants", "mri_sessions")) and (change["operation"] != "update"):
+                return {"all_data": self.read_all_data()}
+
+            if change["table_name"] == "participants":
+                participant_ids.add(change["row_id"])
+            elif change["table_name"] == "mri_sessions":
+                session_ids.add(change["row_id"])
+            elif change["table_name"] == "mri_series":
+                series_session_ids.add(change["parent_id"])
+
+        # get data of changed rows
+        participants = []
+        mri_sessions = {}
+        series = {}
+        participant_stats = None
+        stage_stats = None
+        if (len(participant_ids) > 0) or (len(session_ids) > 0) or (len(series_session_ids) > 0):
+            db = database.connect(self._settings_db, read_only=True)
+            for participant_id in participant_ids:
+                participant = db.get_participant_data(id=participant_id, return_only_first=True)
+                if (participant != None) and (participant != -1):
+                    participants.append(participant)
+
+            # sessions also show the IDs of their participant (archived sessions don't change, but their participant may)
+            filters = [{"ids": list(session_ids)}, {"participant_ids": list(participant_ids)}]
+            if self._show_archived:
+                filters.append({"participant_ids": list(participant_ids), "archived": True})
+            for filter in filters:
+                sessions = db.get_mri_sessions_with_participants(**filter)
+                if sessions == -1:
+                    break
+                for session in sessions:
+                    if "archived" in filter:
+                        session["archived"] = True
+                    mri_sessions[session["id"]] = session
+
+            # get changed series
+            if len(series_session_ids) > 0:
+                series = db.get_mri_series_of_sessions(series_session_ids, sort_column="series_recorded_dt", sort_dir="ascending")
+
+            # changed sessions may change the number of sessions of their participant and of each processing stage
+            if len(session_ids) > 0:
+                participant_stats = db.get_participant_stats()
+                stage_stats = db.get_mri_session_stage_stats()
+            db.close()
+
+            if (sessions == -1) or (series == -1) or (participant_stats == -1) or (stage_stats == -1) or (len(participants) != len(participant_ids)) or (not session_ids.issubset(mri_sessions.keys())):
+                return {"all_data": self.read_all_data()}
+
+        return {"participants": participants, "mri_sessions": list(mri_sessions.values()), "series": series, "participant_stats": participant_stats, "stage_stats": stage_stats}
+
+    # update rows read by "read_changes"
+    def changes_read(self, changes):
+
+        if (changes == None) or (changes == -1):
+            return
+
+        if "all_data" in changes:
+            self.all_data_read(changes["all_data"])
+            return
+
+        # a changed recording time changes the order of the sessions
+        for session in changes["mri_sessions"]:
+            shown_session = self._mri_sessions_model.get_record(session["id"])
+            if (shown_session == None) or (session["data_recorded_dt"] != shown_session["data_recorded_dt"]):
+                self.load_db()
+                return
+
+        # update participants
+        for participant in changes["participants"]:
+            self._participants_model.update_record(participant)
+
+        all_study_ids, all_deidentified_ids = data_viewer_utils.get_all_ids(self._participants_model.get_records())
+        self._all_study_ids = all_study_ids
+        self._all_deidentified_ids = all_deidentified_ids
+
+        # update sessions
+        for session in changes["mri_sessions"]:
+            self._mri_sessions_model.update_record(session)
+
+        # participants can't be edited once one of their sessions was converted
+        if changes["participant_stats"] != None:
+            self._participants_model.set_non_editable_participant_ids(data_viewer_utils.get_non_editable_participant_ids(changes["participant_stats"]))
+
+        # update status table
+        if changes["stage_stats"] != None:
+            self.show_stage_stats(changes["stage_stats"])
+
+        # update cached series (series of other sessions are read when the session is selected)
+        selected_session_id = self.get_selected_session_id()
+        for session_id, series in changes["series"].items():
+            if (session_id == selected_session_id) or self._series_cache.contains(session_id):
+                self._series_cache.put(session_id, series)
+
+        # update series table if the selected session changed
+        if (selected_session_id in [session["id"] for session in changes["mri_sessions"]]) or (selected_session_id in changes["series"]):
+            self.update_session_series_table()
+
+        # the changed sessions and series may now (or no longer) match the search
+        if (self.get_search_text() != "") and ((len(changes["participants"]) > 0) or (len(changes["mri_sessions"]) > 0) or (len(changes["series"]) > 0)):
+            self.search_sessions()
+
+    # show number of sessions in each processing stage in the status table
+    def show_stage_stats(self, stage_stats):
+
+        if stage_stats == -1:
+            res = QMessageBox.critical(self, "Data Viewer", "Unable to get MRI session stage statistics.")
+            return
+
+        self._stage_stats_model.set_stage_stats(stage_stats)
+        self.ui.tableView_stage_stats.resizeColumnsToContents()
+
+    # get search text (without leading and trailing spaces)
+    def get_search_text(self):
+        return self.ui.lineEdit_search.text().strip()
+
+    # only show the sessions matching the search text in the session table and the session list
+    def search_sessions(self):
+
+        if (self._settings_db == None) or (self._settings_db == -1):
+            return
+
+        # show all sessions if the search text was cleared
+        text = self.get_search_text()
+        if text == "":
+            self._worker.cancel("search")
+            self.search_results_read(None)
+            return
+
+        # only the results of the most recent search are shown
+        self._worker.run("search", self.read_search_results, (text, self._show_archived), self.search_results_read)
+
+    # search sessions (runs in the worker thread)
+    def read_search_results(self, text, include_archived):
+
+        # connect to database (read-only)
+        db = database.connect(self._settings_db, read_only=True)
+
+        # get ids of matching sessions
+        session_ids = db.search(text, include_archived)
 
-        # re-activate session list
-        self.ui.listWidget_mri_session_series.blockSignals(False)
-        
         # close connection to database
         db.close()
 
-        # update series table
-        self.update_session_series_table()
+        return session_ids
+
+    # filter session table and list with the session ids found by "read_search_results" (None: show all sessions)
+    def search_results_read(self, session_ids):
+
+        if session_ids == -1:
+            res = QMessageBox.critical(self, "Data Viewer", "Could not search sessions.")
+            return
+
+        self.ui.tableView_mri_sessions.model().set_filter_ids(session_ids)
+        self._mri_session_list_model.set_filter_ids(session_ids)
+
+    # show or hide archived sessions
+    def checkBox_show_archived_toggled(self, checked):
+
+        self._show_archived = checked
+        self.load_db()
+
+    # handle buttons of participant table
+    def participant_button_clicked(self, index):
+
+        participant = self._participants_model.get_record(index.data(data_viewer_models.id_role))
+        if participant == None:
+            return
+
+        self.edit_participant_button_pressed(id=participant["id"], study_id=participant["study_id"])
+
+    # handle buttons of mri session table
+    def mri_session_button_clicked(self, index):
+
+        session = self._mri_sessions_model.get_record(index.data(data_viewer_models.id_role))
+        if session == None:
+            return
+
+        match index.data(data_viewer_models.button_role):
+            case "Validate":
+                self.validate_mri_session_button_pressed(id=session["id"], description=session["description"])
+            case "Edit":
+                self.edit_mri_session_button_pressed(id=session["id"], description=session["description"])
+            case "Reprocess":
+                self.reprocess_mri_session_button_pressed(id=session["id"], description=session["description"])
+
+    # handle buttons of mri series table
+    def mri_series_button_clicked(self, index):
+
+        series = self._mri_series_model.get_record(index.data(data_viewer_models.id_role))
+        if series == None:
+            return
+
+        match index.data(data_viewer_models.button_role):
+            case "Skip":
+                self.skip_include_mri_series_button_pressed(session_id=series["session_id"], series_number=series["series_number"], skip=True)
+            case "Include":
+                self.skip_include_mri_series_button_pressed(session_id=series["session_id"], series_number=series["series_number"], skip=False)
 
     def validate_mri_session_button_pressed(self,table=None, row=-1, id=None, description=""):
 
@@ -245,9 +577,9 @@ class data_viewer_ui(QWidget):
 
         if validate_dialog.session_went_from_skipped_to_notskipped:
             self.reprocess_mri_session(id=id, description=description, action=1)
-        
-        # reload db
-        self.load_db()
+
+        # refresh changed rows
+        self.refresh_db()
 
     def edit_mri_session_button_pressed(self,table=None, row=-1, id=None, description=""):
 
@@ -257,23 +589,31 @@ class data_viewer_ui(QWidget):
 
         if edit_dialog.session_went_from_skipped_to_notskipped:
             self.reprocess_mri_session(id=id, description=description, action=1)
-        
-        # reload db
-        self.load_db()
+
+        # refresh changed rows
+        self.refresh_db()
 
     def reprocess_mri_session(self, id=None, description="", action=None):
 
         # get session data
-        # connect to database
-        db = database.db(self._settings_db["db_path"])
-        db.n_default_query_attempts = self._settings_db["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
+        self._worker.run("reprocess", self.read_mri_session, (id,), lambda session: self.reprocess_mri_session_read(session, description, action), drop_stale=False, coalesce=False)
+
+    # read session data (runs in the worker thread)
+    def read_mri_session(self, id):
+
+        db = database.connect(self._settings_db, read_only=True)
+        session = db.get_mri_session_data(id=id, return_only_first=True, include_archived=True)
+        db.close()
+
+        return session
+
+    # ask user how to reprocess a session, once its data was read
+    def reprocess_mri_session_read(self, session, description, action):
 
-        session = db.get_mri_session_data(id=id, return_only_first=True)
         if (session == None) or (session == -1):
             res = QMessageBox.critical(self, "Data Viewer", "Unable to get MRI session data.")
-            db.close()
             return
-        
+
         # get action
         if action==None:
             # check if session data has already been converted
@@ -284,34 +624,54 @@ class data_viewer_ui(QWidget):
                 reprocess_dialog = reprocess_session_dialog(self, session_description=description)
                 res = reprocess_dialog.exec()
                 if res==0:
-                    db.close()
                     return
-                
+
                 action = reprocess_dialog.result_id
             ask_user_to_confirm = True
         else:
             ask_user_to_confirm = False
 
+        # confirm selected action
+        if ask_user_to_confirm:
+            match action:
+                case 0: # rerun data validation
+                    res = QMessageBox.question(self,"Data Viewer","Validation scripts will be rerun for session " + description + " and all its series. Previous validation results will be discarded.\nPlease confirm")
+                case 1: # rerun data download and processing
+                    res = QMessageBox.question(self,"Data Viewer","Data of session " + description + " will be downloaded and processed again. Previously downloaded and processed data will be removed from the work directory.\nPlease confirm")
+            if res != QMessageBox.Yes:
+                return
+
+        # run selected action
+        self._worker.run("reprocess", self.write_reprocess_mri_session, (session, action), lambda error: self.mri_series_written(error, session["id"]), drop_stale=False, coalesce=False)
+
+    # clear results of a session, so it is processed again (runs in the worker thread)
+    # returns None if successful, otherwise the error message
+    def write_reprocess_mri_session(self, session, action):
+
+        # connect to database
+        db = database.connect(self._settings_db)
+
+        # move archived session back to the other sessions, so it can be processed again
+        if db.is_mri_session_archived(session["id"]):
+            if db.restore_mri_session(session["id"]) == -1:
+                db.rollback()
+                db.close()
+                return "Could not restore archived session."
+
+        # get all series for this session
+        session_series = db.get_mri_series_data(session_id=session["id"])
+        if session_series == -1:
+            db.close()
+            return "Could not get series for selected session."
+
         # run selected action
         match action:
             case 0: # rerun data validation
-                if ask_user_to_confirm:
-                    res = QMessageBox.question(self,"Data Viewer","Validation scripts will be rerun for session " + description + " and all its series. Previous validation results will be discarded.\nPlease confirm")
-                    if res != QMessageBox.Yes:
-                        db.close()
-                        return
-                
-                # get all series for this session
-                session_series = db.get_mri_series_data(session_id=session["id"])
-                if session_series == -1:
-                    res = QMessageBox.critical(self,"Data Viewer","Could not get series for selected session.")
-                    db.close()
-                    return
-                
+
                 # clear validation results from series
                 if (session_series!=None) and (len(session_series)>0):
                     for series in session_series:
-                        db.clear_values_from_mri_series(series["id"], 
+                        db.clear_values_from_mri_series(series["id"],
                                                         series_recorded_dt = True,
                                                         number_files = True,
                                                         files_validated_dt = True,
@@ -321,28 +681,16 @@ class data_viewer_ui(QWidget):
                                                         dcm2bids_criteria_in_config = True,
                                                         duplicate_series = True,
                                                         skip_processing = True)
-                        
+
                 # clear validation results from session
                 db.clear_values_from_mri_session(session["id"],
                                                  conversion_validated_dt = True,
                                                  conversion_validated_with_summary_dt = True,
                                                  conversion_valid = True)
-                
+
                 db.commit()
 
             case 1: # rerun data download and processing
-                if ask_user_to_confirm:
-                    res = QMessageBox.question(self,"Data Viewer","Data of session " + description + " will be downloaded and processed again. Previously downloaded and processed data will be removed from the work directory.\nPlease confirm")
-                    if res != QMessageBox.Yes:
-                        db.close()
-                        return
-                
-                # get all series for this session
-                session_series = db.get_mri_series_data(session_id=session["id"])
-                if session_series == -1:
-                    res = QMessageBox.critical(self,"Data Viewer","Could not get series for selected session.")
-                    db.close()
-                    return
 
                 # delete session data folder
                 session_name = Path(session["data_file"]).stem
@@ -354,7 +702,7 @@ class data_viewer_ui(QWidget):
                 if (session_series!=None) and (len(session_series)>0):
                     for series in session_series:
                         db.remove_mri_series(series["id"])
-                        
+
                 # clear results from session
                 db.clear_values_from_mri_session(session["id"],
                                                  summary_file = True,
@@ -367,14 +715,27 @@ class data_viewer_ui(QWidget):
                                                  conversion_valid = True,
                                                  data_converted_dt = True,
                                                  data_uploaded_dt = True)
-                
-                db.commit()                
+
+                db.commit()
 
         # close db
         db.close()
 
-        # reload db
-        self.load_db()
+        return None
+
+    # show error (if any) once a session or its series were changed, and refresh changed rows
+    def mri_series_written(self, error, session_id):
+
+        if error == -1:
+            error = "Could not write changes to database."
+        if error != None:
+            res = QMessageBox.critical(self,"Data Viewer",error)
+
+        # cached series of the session are outdated
+        self._series_cache.invalidate(session_id)
+
+        # refresh changed rows
+        self.refresh_db()
 
     def reprocess_mri_session_button_pressed(self,table=None, row=-1, id=None, description=""):
         self.reprocess_mri_session(id=id, description=description)
@@ -384,9 +745,9 @@ class data_viewer_ui(QWidget):
         # run editing dialog
         edit_dialog = edit_participant_dialog(self, participant_row_id=id, settings_database=self._settings_db, settings_study=self._settings_study, subject_id=study_id)
         edit_dialog.exec()
-        
-        # reload db
-        self.load_db()
+
+        # refresh changed rows
+        self.refresh_db()
 
     def pushButton_new_participant_clicked(self):
         
@@ -450,131 +811,106 @@ class data_viewer_ui(QWidget):
                                                                  prefix=self._settings_study["deidentified_subject_identifier_format"]["desired_prefix"]+self._settings_study["deidentified_subject_identifier_format"]["desired_start_str"],
                                                                  digits=self._settings_study["deidentified_subject_identifier_format"]["desired_digits"])
 
+        # all deidentified IDs may already be used
+        if new_deidentified_id == None:
+            res = QMessageBox.critical(self,"Data Viewer","Could not generate a new deidentified ID, since all deidentified IDs are used. Please increase the number of digits of deidentified IDs in the study settings.")
+            return
+
         # add participant to database
 
         # check db settings
         if (self._settings_db == None) or (self._settings_db == -1):
             return
 
+        self._worker.run("add_participant", self.write_new_participant, (new_subject_id, new_deidentified_id), self.new_participant_written, drop_stale=False, coalesce=False)
+
+    # add participant to database (runs in the worker thread)
+    def write_new_participant(self, study_id, deidentified_id):
+
         # connect to database
-        db = database.db(self._settings_db["db_path"])
-        db.n_default_query_attempts = self._settings_db["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
+        db = database.connect(self._settings_db)
 
-        participant_id = db.add_participant(study_id=new_subject_id, 
-                                                deidentified_id=new_deidentified_id,
+        participant_id = db.add_participant(study_id=study_id,
+                                                deidentified_id=deidentified_id,
                                                 group_assignment="patient")
-        if participant_id == -1:
-            res = QMessageBox.critical(self,"Data Viewer","Could not add new participant to database.")
 
         db.commit()
 
         # close connection to database
         db.close()
 
-        # reload db
-        self.load_db()
+        return participant_id
+
+    # show error (if any) once the participant was added, and refresh changed rows
+    def new_participant_written(self, participant_id):
+
+        if participant_id == -1:
+            res = QMessageBox.critical(self,"Data Viewer","Could not add new participant to database.")
+
+        # refresh changed rows
+        self.refresh_db()
 
     def update_session_series_table(self):
 
-        # clear table
-        self.ui.tableWidget_mri_series.clear()
-        self.ui.tableWidget_mri_series.setColumnCount(0)
-        self.ui.tableWidget_mri_series.setRowCount(0)
+        # get selected session
+        selected_session_id = self.get_selected_session_id()
+        if selected_session_id == None:
+            self._worker.cancel("series")
+            self._mri_series_model.set_series([], False)
+            return
 
-        # skip if session list is disabled
-        if not self.ui.listWidget_mri_session_series.isEnabled():
+        # show cached series
+        series = self._series_cache.get(selected_session_id)
+        if series != None:
+            self._worker.cancel("series")
+            self.show_session_series(selected_session_id, series)
             return
-        
-        # get selected session
-        selected_session_description = self.ui.listWidget_mri_session_series.currentItem().text()
-        selected_session_id = self.ui.listWidget_mri_session_series.currentItem().data(Qt.UserRole)
-        
-        # connect to database
-        db = database.db(self._settings_db["db_path"])
-        db.n_default_query_attempts = self._settings_db["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
 
-        # get session information
-        session = db.get_mri_session_data(id=selected_session_id, return_only_first=True)
+        # clear table until the series of the selected session are read
+        self._mri_series_model.set_series([], False)
+
+        # read series (when the user quickly selects several sessions, only the series of the last one are shown)
+        self._worker.run("series", self.read_session_series, (selected_session_id,), self.session_series_read)
+
+    # read series of a session (runs in the worker thread)
+    def read_session_series(self, session_id):
+
+        # connect to database (read-only)
+        db = database.connect(self._settings_db, read_only=True)
+
+        # get series for this session (the session may be archived)
+        series = db.get_mri_series_of_sessions([session_id], sort_column="series_recorded_dt", sort_dir="ascending", include_archived=True)
 
-        # get series for this session
-        session_series = db.get_mri_series_data(session_id=selected_session_id, sort_column="series_recorded_dt", sort_dir="ascending")
-        
         # close database
         db.close()
 
-        if (session == None) or (session == -1):
-            res = QMessageBox.critical(self,"Data Viewer","Could not get data for selected session.")
-            return
+        if series == -1:
+            return -1
+        
+        return {"session_id": session_id, "series": series[session_id]}
 
-        if session_series == -1:
+    # cache and show series read by "read_session_series"
+    def session_series_read(self, data):
+
+        if data == -1:
             res = QMessageBox.critical(self,"Data Viewer","Could not get series for selected session.")
             return
-        if (session_series==None) or (len(session_series)<1):
-            return
-        
-        # check if session data was already converted
-        session_data_converted = session["data_converted_dt"] != None
-        
-        # set column names
-        self.ui.tableWidget_mri_series.setColumnCount(11)
-        self.ui.tableWidget_mri_series.setHorizontalHeaderLabels(("Series", "Date", "Time", "Series Description", "Files", "Files Valid", "dcm2bids Criteria Match", "Duplicates", "Skip", "Data Converted", ""))
-
-        # populate series table
-        self.ui.tableWidget_mri_series.setRowCount(len(session_series))
-        row_ind = -1
-        for series in session_series:
-
-            series_number = series["series_number"]
-            series_recorded_dt = series["series_recorded_dt"]
-            description = series["description"]
-            number_files = series["number_files"]
-            files_valid = series["files_valid"]
-            dcm2bids_criteria_in_config = series["dcm2bids_criteria_in_config"]
-            duplicate_series = series["duplicate_series"]
-            skip_processing = series["skip_processing"]
-            data_converted_dt = series["data_converted_dt"]
-
-            row_ind = row_ind+1
-
-            # get date and time
-            if series_recorded_dt != None:
-                session_recorded_date = datetime.fromtimestamp(series_recorded_dt).strftime("%Y/%m/%d")
-                session_recorded_time = datetime.fromtimestamp(series_recorded_dt).strftime("%H:%M:%S.%f")
-            else:
-                session_recorded_date = None
-                session_recorded_time = None
-
-
-            # add row
-            self.ui.tableWidget_mri_series.setItem(row_ind,0,QTableWidgetItem("" if series_number== None else str(series_number)))
-            self.ui.tableWidget_mri_series.setItem(row_ind,1,QTableWidgetItem(session_recorded_date))
-            self.ui.tableWidget_mri_series.setItem(row_ind,2,QTableWidgetItem(session_recorded_time))
-            self.ui.tableWidget_mri_series.setItem(row_ind,3,QTableWidgetItem(description))
-            self.ui.tableWidget_mri_series.setItem(row_ind,4,QTableWidgetItem("" if number_files== None else str(number_files)))
-            self.ui.tableWidget_mri_series.setItem(row_ind,5,QTableWidgetItem("Y" if files_valid==1 else "N"))
-            self.ui.tableWidget_mri_series.setItem(row_ind,6,QTableWidgetItem("Y" if dcm2bids_criteria_in_config==1 else "N"))
-            self.ui.tableWidget_mri_series.setItem(row_ind,7,QTableWidgetItem(duplicate_series))
-            self.ui.tableWidget_mri_series.setItem(row_ind,8,QTableWidgetItem("Y" if skip_processing==1 else "N"))
-            self.ui.tableWidget_mri_series.setItem(row_ind,9,QTableWidgetItem("N" if data_converted_dt==None else "Y"))
-
-            # add skip and include buttons
-            if (not session_data_converted) and (not data_converted_dt):
-                if skip_processing==1:
-                    bt = QPushButton("Include")
-                    bt.clicked.connect(partial(self.skip_include_mri_series_button_pressed,self.ui.tableWidget_mri_series, row_ind, selected_session_id, series_number, False))
-                    self.ui.tableWidget_mri_series.setCellWidget(row_ind,10,bt)
-                else:
-                    bt = QPushButton("Skip")
-                    bt.clicked.connect(partial(self.skip_include_mri_series_button_pressed,self.ui.tableWidget_mri_series, row_ind, selected_session_id, series_number, True))
-                    self.ui.tableWidget_mri_series.setCellWidget(row_ind,10,bt)
 
-            # add color coding to show skipped and converted series
-            if skip_processing==1:
-                self.ui.tableWidget_mri_series.item(row_ind,8).setBackground(QColor(230,230,230))
-            if data_converted_dt == None:
-                self.ui.tableWidget_mri_series.item(row_ind,9).setBackground(QColor(230,230,230))
+        self._series_cache.put(data["session_id"], data["series"])
+        self.show_session_series(data["session_id"], data["series"])
+
+    # populate series table
+    def show_session_series(self, session_id, series):
+
+        session = self._mri_sessions_model.get_record(session_id)
+        if session == None:
+            self._mri_series_model.set_series([], False)
+            res = QMessageBox.critical(self,"Data Viewer","Could not get data for selected session.")
+            return
 
-        self.ui.tableWidget_mri_series.resizeColumnsToContents()
+        # series of sessions whose data was already converted, and of archived sessions, can't be skipped or included
+        self._mri_series_model.set_series(series, (session["data_converted_dt"] != None) or self._mri_sessions_model.is_archived(session))
+        self.ui.tableView_mri_series.resizeColumnsToContents()
 
     def skip_include_mri_series_button_pressed(self, table=None, row=-1, session_id=None, series_number=None, skip=False):
 
@@ -585,18 +921,26 @@ class data_viewer_ui(QWidget):
             res = QMessageBox.question(self,"Data Viewer","Series " + str(series_number) + " will be included.\nPlease confirm")
         if res != QMessageBox.Yes:
             return
-        
-        # connect to database
-        db = database.db(self._settings_db["db_path"])
-        db.n_default_query_attempts = self._settings_db["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
 
         # get series information
+        self._worker.run("skip_include", self.read_mri_series, (session_id, series_number), lambda series: self.skip_include_mri_series_read(series, session_id, series_number, skip), drop_stale=False, coalesce=False)
+
+    # read series data (runs in the worker thread)
+    def read_mri_series(self, session_id, series_number):
+
+        db = database.connect(self._settings_db, read_only=True)
         series = db.get_mri_series_data(session_id=session_id, series_number=series_number, return_only_first=True)
+        db.close()
+
+        return series
+
+    # run additional checks once the series data was read, and skip or include series
+    def skip_include_mri_series_read(self, series, session_id, series_number, skip):
+
         if (series == None) or (series == -1):
             res = QMessageBox.critical(self,"Data Viewer","Could not get series information.")
-            db.close()
             return
-        
+
         # run some additional checks if this series should be included
         duplicate_series_to_skip = []
         if not skip:
@@ -604,10 +948,9 @@ class data_viewer_ui(QWidget):
             dcm2bids_criteria_in_config = series["dcm2bids_criteria_in_config"] == 1
             if not dcm2bids_criteria_in_config:
                 res = QMessageBox.critical(self,"Data Viewer","Could not include series " + str(series_number) + " as there are no matching criteria in dcm2bids config. Please update the config file and validate this session again.")
-                db.close()
                 return
 
-        
+
             # check if series has duplicates
             duplicate_series = []
             if (series["duplicate_series"] != None) and (series["duplicate_series"] != ""):
@@ -624,37 +967,35 @@ class data_viewer_ui(QWidget):
             if len(duplicate_series_to_skip)>0:
                 res = QMessageBox.question(self,"Data Viewer","Series " + str(series_number) + " has one or more duplicates with matching dcm2bids criteria. By including this series, the following series will be skipped: " + duplicate_series_to_skip_str + "\nPlease confirm")
                 if res != QMessageBox.Yes:
-                    db.close()
                     return
-            
+
+        self._worker.run("skip_include", self.write_skip_include_mri_series, (series, session_id, skip, duplicate_series_to_skip), lambda error: self.mri_series_written(error, session_id), drop_stale=False, coalesce=False)
+
+    # skip or include series, and skip its duplicates (runs in the worker thread)
+    # returns None if successful, otherwise the error message
+    def write_skip_include_mri_series(self, series, session_id, skip, duplicate_series_to_skip):
+
+        # connect to database
+        db = database.connect(self._settings_db)
 
         # update series
         db.update_mri_series(series["id"], skip_processing=skip)
-        
+
         # skip any additional series (duplicates)
         for series_number_to_skip in duplicate_series_to_skip:
             series_to_skip = db.get_mri_series_data(session_id=session_id, series_number=series_number_to_skip, return_only_first=True)
             if (series_to_skip == None) or (series_to_skip == -1):
-                res = QMessageBox.critical(self,"Data Viewer","Could not get information for series " + str(series_number_to_skip) + ".")
                 db.close()
-                return
+                return "Could not get information for series " + str(series_number_to_skip) + "."
             db.update_mri_series(series_to_skip["id"], skip_processing=True)
 
         # commit changes and close database
         db.commit()
-        db.close()        
-        
-        # reload db
-        self.load_db()
+        db.close()
+
+        return None
 
-        # reset session selection
-        for index in range(self.ui.listWidget_mri_session_series.count()):
-            item = self.ui.listWidget_mri_session_series.item(index)
-            if item.data(Qt.UserRole)==session_id:
-                self.ui.listWidget_mri_session_series.setCurrentItem(item)
-                break
 
-        
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
@@ -1,6 +1,7 @@
 import sys
 import os
 import re
+from collections import OrderedDict
 
 currentdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.dirname(currentdir)
@@ -51,25 +52,53 @@ def get_all_ids(participants):
 # check if participant is editable (has no converted sessions)
 def get_participant_editable(parent, db, participant_id):
     if participant_id != None:
-        participant_sessions = db.get_mri_session_data(participant_id=participant_id)
-        if participant_sessions==-1:
+        participant_stats = db.get_participant_stats(participant_ids=(participant_id,))
+        if participant_stats==-1:
             res = QMessageBox.critical(parent, "Data Viewer", "Could not get participant sessions.")
-            participant_sessions = None
+            participant_stats = None
 
         participant_is_editable = True
-        if participant_sessions != None:
-            for participant_session in participant_sessions:
-                data_converted_dt = participant_session["data_converted_dt"]
-                if data_converted_dt != None:
-                    participant_is_editable = False
-                    break
+        if (participant_stats != None) and (participant_id in participant_stats):
+            participant_is_editable = participant_stats[participant_id]["n_converted_sessions"] == 0
 
     else:
-        participant_sessions = None
         participant_is_editable = True
 
     return participant_is_editable
 
+# get deidentified id and group assignment of a participant, and check if it can be edited (has no converted sessions)
+# used while the database is locked for writing, so errors are not shown here (the caller shows them once the lock was released)
+# returns -1 if the data could not be read
+def get_participant_data_for_update(db, participant_id):
+
+    participant = db.get_participant_data(id=participant_id, return_only_first=True)
+    if (participant == None) or (participant == -1):
+        return -1
+
+    participant_stats = db.get_participant_stats(participant_ids=(participant_id,))
+    if participant_stats == -1:
+        return -1
+
+    participant_is_editable = True
+    if participant_id in participant_stats:
+        participant_is_editable = participant_stats[participant_id]["n_converted_sessions"] == 0
+
+    return participant["deidentified_id"], participant["group_assignment"], participant_is_editable
+
+# get IDs of all participants that can't be edited (have converted sessions)
+# participant_stats: statistics of all participants (see "get_participant_stats" of the database)
+def get_non_editable_participant_ids(participant_stats):
+    non_editable_participant_ids = set()
+
+    if (participant_stats == None) or (participant_stats == -1):
+        return non_editable_participant_ids
+    
+    for participant_id, stats in participant_stats.items():
+        if stats["n_converted_sessions"] > 0:
+            non_editable_participant_ids.add(participant_id)
+
+    return non_editable_participant_ids
+
 # validate ID and provide potential alternative
 def validate_id(id, desired_prefix, desired_start_str, desired_digits):
     
@@ -128,4 +157,153 @@ def validate_id(id, desired_prefix, desired_start_str, desired_digits):
 
 def get_session_id_from_number(id_number, prefix, digits):
     id_format = prefix + "{:0" + str(digits) + "d}"
-    return id_format.format(id_number)
\ No newline at end of file
+    return id_format.format(id_number)
+
+# snapshot of the participants and the IDs used by the editing dialogs to validate IDs without querying the database
+# the snapshot contains all participants and whether they can be edited, and the session edited by the dialog (if any).
+# The session IDs of a participant are read when they are needed for the first time and cached. Since other processes
+# may change the IDs in the meantime, uniqueness needs to be checked again when the changes are written
+class id_snapshot:
+
+    # class constructor
+    # settings_db: database settings used to read the session IDs of participants
+    def __init__(self, settings_db=None):
+        self.all_study_ids = ()
+        self.all_deidentified_ids = ()
+        self._settings_db = settings_db
+        self._participants = {}
+        self._participant_ids_by_study_id = {}
+        self._non_editable_participant_ids = set()
+        self._session = None
+        self._participant_session_ids = {}
+
+    # read snapshot from database
+    # session_row_id: id of the session edited by the dialog (None if no session is edited)
+    def read(self, db, session_row_id=None):
+
+        participants = db.get_all_participant_data()
+        if participants == -1:
+            return -1
+        
+        participant_stats = db.get_participant_stats()
+        if participant_stats == -1:
+            return -1
+
+        # the edited session may be archived
+        session = None
+        if session_row_id != None:
+            session = db.get_mri_session_data(id=session_row_id, return_only_first=True, include_archived=True)
+            if session == -1:
+                return -1
+        
+        self.all_study_ids, self.all_deidentified_ids = get_all_ids(participants)
+
+        self._participants = {}
+        self._participant_ids_by_study_id = {}
+        for participant in (participants if participants != None else []):
+            self._participants[participant["id"]] = participant
+            if participant["study_id"] != None:
+                self._participant_ids_by_study_id[participant["study_id"]] = participant["id"]
+
+        self._non_editable_participant_ids = get_non_editable_participant_ids(participant_stats)
+        self._session = session
+        self._participant_session_ids = {}
+
+        # the session IDs of the participant of the edited session are needed in any case
+        if session != None:
+            if self.read_participant_session_ids(db, session["participant_id"]) == -1:
+                return -1
+
+        return 1
+
+    # read and cache session IDs used by the sessions of a participant (archived sessions still use their session IDs)
+    def read_participant_session_ids(self, db, participant_id):
+
+        sessions = db.get_mri_session_data(participant_id=participant_id, include_archived=True)
+        if sessions == -1:
+            return -1
+        
+        all_participant_session_ids = []
+        for session in (sessions if sessions != None else []):
+            id = session["participant_session_id"]
+            if (id != None) and (id != ""):
+                all_participant_session_ids.append(id)
+
+        self._participant_session_ids[participant_id] = all_participant_session_ids
+
+        return 1
+    
+    # get participant data (None if the participant does not exist)
+    def get_participant(self, participant_id):
+        return self._participants.get(participant_id)
+    
+    # get id of participant with the given study id (None if there is no such participant)
+    def get_participant_id(self, study_id):
+        return self._participant_ids_by_study_id.get(study_id)
+    
+    # get data of the edited session (None if the session does not exist)
+    def get_session(self, session_row_id):
+
+        if (self._session == None) or (self._session["id"] != session_row_id):
+            return None
+
+        return self._session
+
+    # check if participant is editable (has no converted sessions)
+    def participant_is_editable(self, participant_id):
+        return not participant_id in self._non_editable_participant_ids
+    
+    # get session IDs used by the sessions of a participant (read from the database when they are needed for the first time)
+    # returns -1 if the session IDs could not be read
+    def get_participant_session_ids(self, participant_id):
+
+        if participant_id == None:
+            return []
+
+        if not participant_id in self._participant_session_ids:
+
+            # connect to database (read-only)
+            db = database.connect(self._settings_db, read_only=True)
+            res = self.read_participant_session_ids(db, participant_id)
+            db.close()
+
+            if res == -1:
+                return -1
+
+        return self._participant_session_ids[participant_id]
+
+# cache of the series of MRI sessions (by session id)
+# when the cache is full, the series of the least recently used session are removed
+class session_series_cache:
+
+    def __init__(self, max_sessions=100):
+        self._max_sessions = max_sessions
+        self._series = OrderedDict()
+
+    # get series of a session (None if they are not cached)
+    def get(self, session_id):
+        if not session_id in self._series:
+            return None
+        
+        self._series.move_to_end(session_id)
+        return self._series[session_id]
+    
+    # check if series of a session are cached
+    def contains(self, session_id):
+        return session_id in self._series
+
+    # add or replace series of a session
+    def put(self, session_id, series):
+        self._series[session_id] = series if isinstance(series, list) else []
+        self._series.move_to_end(session_id)
+
+        while len(self._series) > self._max_sessions:
+            self._series.popitem(last=False)
+
+    # remove series of a session (e.g. after they were changed)
+    def invalidate(self, session_id):
+        self._series.pop(session_id, None)
+
+    # remove all series
+    def clear(self):
+        self._series.clear()
@@ -0,0 +1,116 @@
+# This Python file uses the following encoding: utf-8
+# worker running the database queries of the data viewer in the background, so the user interface stays responsive while
+# another process (e.g. the pipeline) holds a lock on the database
+# results are delivered to the user interface thread through signals
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal
+
+# signals of a task (QRunnable can't emit signals itself)
+class db_task_signals(QObject):
+    finished = Signal(object, object)
+
+# task running a function in the worker thread
+class db_task(QRunnable):
+
+    def __init__(self, key, token, function, args, callback, drop_stale):
+        super().__init__()
+        self.setAutoDelete(False)
+
+        self.key = key
+        self.token = token
+        self.callback = callback
+        self.drop_stale = drop_stale
+        self.signals = db_task_signals()
+        self._function = function
+        self._args = args
+
+    def run(self):
+
+        try:
+            result = self._function(*self._args)
+        except Exception as e:
+            print("ERROR: Database task \"" + self.key + "\" failed:")
+            print(e)
+            result = -1
+
+        self.signals.finished.emit(self, result)
+
+# worker running database tasks one at a time, in the order in which they were submitted
+# the worker uses a single thread that is kept alive, since SQLite connections can only be used by the thread that opened them
+# (this allows tasks to keep a connection open for later tasks)
+class db_worker(QObject):
+
+    # emitted when the worker starts (True) or finishes (False) processing tasks
+    busy_changed = Signal(bool)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(1)
+        self._pool.setExpiryTimeout(-1)
+
+        self._tasks = set()
+        self._queued_tasks = {}
+        self._latest_tokens = {}
+        self._next_token = 0
+
+    # run function in the worker thread and pass its result to the callback (in the user interface thread)
+    # key: identifies the purpose of the task (e.g. "load")
+    # drop_stale: only deliver the result of the most recent task with the same key (e.g. when the user quickly selects several sessions)
+    # coalesce: replace a task with the same key that has not started yet. Must be False for tasks changing the database
+    def run(self, key, function, args=(), callback=None, drop_stale=True, coalesce=True):
+
+        # cancel task with the same key that is still waiting
+        if coalesce:
+            self.cancel_queued(key)
+
+        self._next_token = self._next_token+1
+        task = db_task(key, self._next_token, function, args, callback, drop_stale)
+        task.signals.finished.connect(self.task_finished)
+
+        self._tasks.add(task)
+        if coalesce:
+            self._queued_tasks[key] = task
+        self._latest_tokens[key] = task.token
+        if len(self._tasks) == 1:
+            self.busy_changed.emit(True)
+
+        self._pool.start(task)
+
+    # cancel task with the given key that has not started yet
+    def cancel_queued(self, key):
+
+        if (key in self._queued_tasks) and self._pool.tryTake(self._queued_tasks[key]):
+            self._tasks.discard(self._queued_tasks[key])
+            del self._queued_tasks[key]
+            if len(self._tasks) == 0:
+                self.busy_changed.emit(False)
+
+    # cancel all tasks with the given key. A task that is already running finishes, but its result is dropped
+    def cancel(self, key):
+
+        self.cancel_queued(key)
+        self._latest_tokens[key] = None
+
+    # check if a task with the given key is waiting or running
+    def is_pending(self, key):
+        return any(task.key == key for task in self._tasks)
+
+    # wait until all tasks are finished
+    def wait(self):
+        self._pool.waitForDone()
+
+    def task_finished(self, task, result):
+
+        self._tasks.discard(task)
+        if self._queued_tasks.get(task.key) is task:
+            del self._queued_tasks[task.key]
+        if len(self._tasks) == 0:
+            self.busy_changed.emit(False)
+
+        # drop outdated results
+        if task.drop_stale and (self._latest_tokens.get(task.key) != task.token):
+            return
+
+        if task.callback != None:
+            task.callback(result)
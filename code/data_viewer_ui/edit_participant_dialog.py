@@ -27,6 +27,9 @@ class edit_participant_dialog(QDialog):
     _all_deidentified_ids = ()
     _all_group_assignments = ()
 
+    # snapshot of all participant and session IDs, read when the dialog opens
+    _ids = None
+
     def __init__(self, parent=None, participant_row_id=None, settings_database=None, settings_study = None, subject_id=""):
 
         super().__init__(parent)
@@ -80,20 +83,8 @@ class edit_participant_dialog(QDialog):
         if (self._settings_db == None) or (self._settings_db == -1):
             return
 
-        # connect to database
-        db = database.db(self._settings_db["db_path"])
-        db.n_default_query_attempts = self._settings_db["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
-
-        # get all paricipants
-        participants = db.get_all_participant_data()
-        if participants == -1:
-            res = QMessageBox.critical(self, "Data Viewer", "Could not get all participant data.")
-            participants = None
-
-        # get all study IDs and deidentified IDs
-        all_study_ids, all_deidentified_ids = data_viewer_utils.get_all_ids(participants)
-        self._all_study_ids = all_study_ids
-        self._all_deidentified_ids = all_deidentified_ids
+        # get all participant IDs
+        self.read_ids()
 
         # define all possible group assignments
         all_group_assignments = ("patient", "control", "test")
@@ -101,8 +92,8 @@ class edit_participant_dialog(QDialog):
 
         # get data of selected participant, and check if participant can be edited
         if self._participant_row_id != None:
-            _, deidentified_id, group_assignment = data_viewer_utils.get_participant_data_for_session(self, db, self._participant_row_id)
-            participant_is_editable = data_viewer_utils.get_participant_editable(self, db, self._participant_row_id)
+            _, deidentified_id, group_assignment = self.get_participant_data()
+            participant_is_editable = self._ids.participant_is_editable(self._participant_row_id)
         else:
             deidentified_id = None
             group_assignment = None
@@ -128,9 +119,32 @@ class edit_participant_dialog(QDialog):
         self.ui.comboBox_group_assignment.setEnabled(participant_is_editable)
         self.ui.comboBox_group_assignment.blockSignals(False)
 
+    # read all participant IDs from the database (see "id_snapshot")
+    # the IDs entered in the dialog are validated against this snapshot, so no queries are needed while the user edits them
+    def read_ids(self):
+
+        # connect to database (read-only)
+        db = database.connect(self._settings_db, read_only=True)
+
+        self._ids = data_viewer_utils.id_snapshot(self._settings_db)
+        if self._ids.read(db) == -1:
+            res = QMessageBox.critical(self, "Data Viewer", "Could not get all participant data.")
+
         # close connection to database
         db.close()
 
+        # get all study IDs and deidentified IDs
+        self._all_study_ids = self._ids.all_study_ids
+        self._all_deidentified_ids = self._ids.all_deidentified_ids
+
+    # get study id, deidentified id and group assignment of the selected participant (from the snapshot)
+    def get_participant_data(self):
+
+        participant = self._ids.get_participant(self._participant_row_id)
+        if participant == None:
+            return None, None, None
+        
+        return participant["study_id"], participant["deidentified_id"], participant["group_assignment"]
 
 
     # save and exit
@@ -139,12 +153,23 @@ class edit_participant_dialog(QDialog):
         if (self._participant_row_id != None) and (self._settings_db != None) and (self._settings_db != -1):
             
             # connect to database
-            db = database.db(self._settings_db["db_path"])
-            db.n_default_query_attempts = self._settings_db["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
+            db = database.connect(self._settings_db)
+
+            # lock database, so no other process can change the IDs while they are checked and written
+            # errors are only shown once the lock was released again
+            if db.begin_write() == -1:
+                db.close()
+                res = QMessageBox.critical(self, "Data Viewer", "Could not write changes to database.")
+                return
 
             # get current data for selected participant, and check if participant can be edited
-            _, current_deidentified_id, current_group_assignment = data_viewer_utils.get_participant_data_for_session(self, db, self._participant_row_id)
-            participant_is_editable = data_viewer_utils.get_participant_editable(self, db, self._participant_row_id)
+            participant_data = data_viewer_utils.get_participant_data_for_update(db, self._participant_row_id)
+            if participant_data == -1:
+                db.rollback()
+                db.close()
+                res = QMessageBox.critical(self, "Data Viewer", "Unable to get participant data.")
+                return
+            current_deidentified_id, current_group_assignment, participant_is_editable = participant_data
 
             # get new deidentified id
             new_deidentified_id = self.ui.lineEdit_deidentified_id.text()
@@ -155,6 +180,18 @@ class edit_participant_dialog(QDialog):
             else:
                 new_group_assignment = None
 
+            # make sure the deidentified ID is still unique (it may have been assigned by another process since the dialog was opened)
+            if participant_is_editable and (new_deidentified_id != "") and (new_deidentified_id != current_deidentified_id):
+                participants_with_id = db.get_participant_data(deidentified_id=new_deidentified_id)
+                if (participants_with_id == -1) or ((participants_with_id != None) and any(participant["id"] != self._participant_row_id for participant in participants_with_id)):
+                    db.rollback()
+                    db.close()
+                    res = QMessageBox.warning(self, "Data Viewer", "The deidentified ID '" + new_deidentified_id + "' is already used by a different participant.\nPlease check the ID and try again.")
+
+                    # get current IDs
+                    self.read_ids()
+                    return
+
             # update participant
             if participant_is_editable:
 
@@ -164,8 +201,8 @@ class edit_participant_dialog(QDialog):
                 if (new_group_assignment != None) and (new_group_assignment != current_group_assignment):
                     db.update_participant(id=self._participant_row_id, group_assignment=new_group_assignment)
 
-                # commit changes
-                db.commit()
+            # commit changes (also ends the transaction if nothing was changed)
+            db.commit()
 
             # close connection to database
             db.close()
@@ -181,22 +218,15 @@ class edit_participant_dialog(QDialog):
         # get deidentified id and study id
         new_deidentified_id = self.ui.lineEdit_deidentified_id.text()
         
-        # check db settings
-        if (self._settings_db == None) or (self._settings_db == -1):
+        # check if IDs were read
+        if self._ids == None:
             return
 
-        # connect to database
-        db = database.db(self._settings_db["db_path"])
-        db.n_default_query_attempts = self._settings_db["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
-
         # get data of selected participant
-        _, current_deidentified_id, group_assignment = data_viewer_utils.get_participant_data_for_session(self, db, self._participant_row_id)
+        _, current_deidentified_id, group_assignment = self.get_participant_data()
 
         # check if participant can be edited (has no converted sessions)
-        participant_is_editable = data_viewer_utils.get_participant_editable(self, db, self._participant_row_id)
-
-        # close connection to database
-        db.close()
+        participant_is_editable = self._ids.participant_is_editable(self._participant_row_id)
 
         # make sure participant is editable (should always be the case)
         if not participant_is_editable:
@@ -280,6 +310,11 @@ class edit_participant_dialog(QDialog):
         new_deidentified_id = study.generate_deidentified_id(used_ids=self._all_deidentified_ids, 
                                                                  prefix=self._settings_study["deidentified_subject_identifier_format"]["desired_prefix"]+self._settings_study["deidentified_subject_identifier_format"]["desired_start_str"],
                                                                  digits=self._settings_study["deidentified_subject_identifier_format"]["desired_digits"])
+
+        # all deidentified IDs may already be used
+        if new_deidentified_id == None:
+            res = QMessageBox.critical(self,"Data Viewer","Could not generate a new deidentified ID, since all deidentified IDs are used. Please increase the number of digits of deidentified IDs in the study settings.")
+            return
         
         # set new id
         self.ui.lineEdit_deidentified_id.blockSignals(True)
@@ -5,6 +5,7 @@ import re
 from datetime import datetime
 
 from PySide6.QtWidgets import QWidget, QDialog, QMessageBox, QSpinBox, QInputDialog, QLineEdit
+from PySide6.QtCore import QTimer
 
 currentdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.dirname(currentdir)
@@ -31,6 +32,12 @@ class edit_session_dialog(QDialog):
 
     _session_id_spinbox = None
 
+    # snapshot of all participant and session IDs, read when the dialog opens
+    _ids = None
+
+    # delay (in ms) after the last change of the session ID before it is validated
+    _validation_delay_ms = 500
+
     session_went_from_skipped_to_notskipped = False
 
     def __init__(self, parent=None, session_row_id=None, mode="edit", settings_database=None, settings_study=None, session_description=""):
@@ -76,6 +83,11 @@ class edit_session_dialog(QDialog):
 
         self._session_id_spinbox.valueChanged.connect(self.spinBox_session_id_value_changed)
 
+        # the session ID is only validated once the user stopped changing it
+        self._session_id_validation_timer = QTimer(self)
+        self._session_id_validation_timer.setSingleShot(True)
+        self._session_id_validation_timer.timeout.connect(self.validate_session_id)
+
         self.ui.checkBox_skip_processing.stateChanged.connect(self.checkBox_skip_processing_state_changed)
 
         self._mode = None
@@ -119,20 +131,9 @@ class edit_session_dialog(QDialog):
         if (self._settings_db == None) or (self._settings_db == -1):
             return
 
-        # connect to database
-        db = database.db(self._settings_db["db_path"])
-        db.n_default_query_attempts = self._settings_db["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
-
-        # get all paricipants
-        participants = db.get_all_participant_data()
-        if participants == -1:
-            res = QMessageBox.critical(self, "Data Viewer", "Could not get all participant data.")
-            participants = None
-
-        # get all study IDs and deidentified IDs
-        all_study_ids, all_deidentified_ids = data_viewer_utils.get_all_ids(participants)
-        self._all_study_ids = all_study_ids
-        self._all_deidentified_ids = all_deidentified_ids
+        # get all participant and session IDs
+        self.read_ids()
+        all_study_ids = self._all_study_ids
 
         # define all possible group assignments
         all_group_assignments = ("patient", "control", "test")
@@ -141,10 +142,9 @@ class edit_session_dialog(QDialog):
         # get data of selected session
         session_data = None
         if self._session_row_id != None:
-            session_data = db.get_mri_session_data(id=self._session_row_id, return_only_first=True)
-            if session_data == -1:
+            session_data = self._ids.get_session(self._session_row_id)
+            if session_data == None:
                 res = QMessageBox.critical(self, "Data Viewer", "Could not get MRI session data.")
-                session_data = None
             
         if session_data != None:
             participant_id = session_data["participant_id"]
@@ -156,13 +156,13 @@ class edit_session_dialog(QDialog):
             skip_processing = False
 
         # get data of corresponding participant
-        study_id, deidentified_id, group_assignment = data_viewer_utils.get_participant_data_for_session(self, db, participant_id)
+        study_id, deidentified_id, group_assignment = self.get_participant_data(participant_id)
 
         # check if any participant is selected
         any_participant_selected = study_id != None
 
         # check if participant can be edited (has no converted sessions)
-        participant_is_editable = data_viewer_utils.get_participant_editable(self, db, participant_id)
+        participant_is_editable = self._ids.participant_is_editable(participant_id)
 
         # populate UI
         all_items = list(all_study_ids)
@@ -209,56 +209,51 @@ class edit_session_dialog(QDialog):
         self.ui.checkBox_skip_processing.setChecked(skip_processing)
         self.ui.checkBox_skip_processing.blockSignals(False)
 
+    # read participant IDs and the data of the edited session from the database (see "id_snapshot")
+    # the IDs entered in the dialog are validated against this snapshot, so (almost) no queries are needed while the user edits them
+    def read_ids(self):
+
+        # connect to database (read-only)
+        db = database.connect(self._settings_db, read_only=True)
+
+        self._ids = data_viewer_utils.id_snapshot(self._settings_db)
+        if self._ids.read(db, self._session_row_id) == -1:
+            res = QMessageBox.critical(self, "Data Viewer", "Could not get all participant data.")
+
         # close connection to database
         db.close()
 
+        # get all study IDs and deidentified IDs
+        self._all_study_ids = self._ids.all_study_ids
+        self._all_deidentified_ids = self._ids.all_deidentified_ids
+
+    # get study id, deidentified id and group assignment of a participant (from the snapshot)
+    def get_participant_data(self, participant_id):
+
+        participant = self._ids.get_participant(participant_id)
+        if participant == None:
+            return None, None, None
+        
+        return participant["study_id"], participant["deidentified_id"], participant["group_assignment"]
+
 
 
     # save and exit
     def pushButton_ok_clicked(self):
 
         if (self._session_row_id != None) and (self._settings_db != None) and (self._settings_db != -1):
-            
-            # connect to database
-            db = database.db(self._settings_db["db_path"])
-            db.n_default_query_attempts = self._settings_db["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
 
-            # get current data for session
-            current_session_data = db.get_mri_session_data(id=self._session_row_id, return_only_first=True)
-            if current_session_data == -1:
-                current_session_data = None
-            
-            if current_session_data != None:
-                current_participant_id = current_session_data["participant_id"]
-                current_session_id = current_session_data["participant_session_id"]
-                current_skip_processing = current_session_data["skip_processing"] == 1
-            else:
-                current_participant_id = None
-                current_session_id = None
-                current_skip_processing = False
+            # validate session ID, if the user just changed it
+            if self._session_id_validation_timer.isActive():
+                self._session_id_validation_timer.stop()
+                self.validate_session_id()
 
-            # get study id and participant id of selected participant
+            # get study id of selected participant
             if self.ui.comboBox_subject_id.currentIndex() != 0:
                 new_study_id = self.ui.comboBox_subject_id.currentText()
             else:
                 new_study_id = None
 
-            if new_study_id != None:
-                new_participant_id = db.get_participant_id(study_id=new_study_id)
-                if new_participant_id == -1:
-                    new_participant_id = None
-            else:
-                new_participant_id = None
-
-            # get current data for selected participant, and check if participant can be edited
-            if new_participant_id != None:
-                _, current_deidentified_id, current_group_assignment = data_viewer_utils.get_participant_data_for_session(self, db, new_participant_id)
-                participant_is_editable = data_viewer_utils.get_participant_editable(self, db, new_participant_id)
-            else:
-                current_deidentified_id = None
-                current_group_assignment = None
-                participant_is_editable = False
-
             # get new deidentified id
             new_deidentified_id = self.ui.lineEdit_deidentified_id.text()
 
@@ -280,6 +275,84 @@ class edit_session_dialog(QDialog):
             # get new skip processing flag
             new_skip_processing = self.ui.checkBox_skip_processing.isChecked()
 
+            # get session IDs of the selected participant the user was already asked about (see "validate_session_id")
+            # they are read before the database is locked, so no dialog is shown while the lock is held
+            known_session_ids = self._ids.get_participant_session_ids(self._ids.get_participant_id(new_study_id))
+            if known_session_ids == -1:
+                res = QMessageBox.critical(self, "Data Viewer", "Could not get participant sessions.")
+                return
+            
+            # connect to database
+            db = database.connect(self._settings_db)
+
+            # lock database, so no other process can change the IDs while they are checked and written
+            # errors are only shown once the lock was released again
+            if db.begin_write() == -1:
+                db.close()
+                res = QMessageBox.critical(self, "Data Viewer", "Could not write changes to database.")
+                return
+
+            # get current data for session
+            # (archived sessions are not returned, they can't be edited)
+            current_session_data = db.get_mri_session_data(id=self._session_row_id, return_only_first=True)
+            if (current_session_data == None) or (current_session_data == -1):
+                db.rollback()
+                db.close()
+                res = QMessageBox.critical(self, "Data Viewer", "Could not get MRI session data.")
+                return
+
+            current_participant_id = current_session_data["participant_id"]
+            current_session_id = current_session_data["participant_session_id"]
+            current_skip_processing = current_session_data["skip_processing"] == 1
+
+            # get participant id of selected participant
+            if new_study_id != None:
+                new_participant_id = db.get_participant_id(study_id=new_study_id)
+                if new_participant_id == -1:
+                    new_participant_id = None
+            else:
+                new_participant_id = None
+
+            # get current data for selected participant, and check if participant can be edited
+            if new_participant_id != None:
+                participant_data = data_viewer_utils.get_participant_data_for_update(db, new_participant_id)
+                if participant_data == -1:
+                    db.rollback()
+                    db.close()
+                    res = QMessageBox.critical(self, "Data Viewer", "Unable to get participant data.")
+                    return
+                current_deidentified_id, current_group_assignment, participant_is_editable = participant_data
+            else:
+                current_deidentified_id = None
+                current_group_assignment = None
+                participant_is_editable = False
+
+            # make sure the IDs are still unique (they may have been changed by another process since the dialog was opened)
+            id_error = None
+            if (new_participant_id != None) and participant_is_editable and (new_deidentified_id != "") and (new_deidentified_id != current_deidentified_id):
+                participants_with_id = db.get_participant_data(deidentified_id=new_deidentified_id)
+                if (participants_with_id == -1) or ((participants_with_id != None) and any(participant["id"] != new_participant_id for participant in participants_with_id)):
+                    id_error = "The deidentified ID '" + new_deidentified_id + "' is already used by a different participant."
+
+            if (new_participant_id != None) and (new_session_id != None) and ((new_participant_id != current_participant_id) or (new_session_id != current_session_id)):
+                participant_sessions = db.get_mri_session_data(participant_id=new_participant_id, include_archived=True)
+                if participant_sessions == -1:
+                    participant_sessions = None
+                used_session_ids = [session["participant_session_id"] for session in (participant_sessions if participant_sessions != None else []) if session["id"] != self._session_row_id]
+
+                # the user was already asked about session IDs that were in use when the dialog was opened
+                if (new_session_id in used_session_ids) and (not new_session_id in known_session_ids):
+                    id_error = "Session ID '" + new_session_id + "' was assigned to a different session in the meantime."
+
+            if id_error != None:
+                db.rollback()
+                db.close()
+                res = QMessageBox.warning(self, "Data Viewer", id_error + "\nPlease check the IDs and try again.")
+
+                # get current IDs
+                self.read_ids()
+                return
+
 
             # update participant
             if (new_participant_id != None) and participant_is_editable:
@@ -341,22 +414,14 @@ class edit_session_dialog(QDialog):
         # get study id
         study_id = self.ui.comboBox_subject_id.currentText()
 
-        # check db settings
-        if (self._settings_db == None) or (self._settings_db == -1):
-            return
-
-        # connect to database
-        db = database.db(self._settings_db["db_path"])
-        db.n_default_query_attempts = self._settings_db["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
-
         # get participant id and data
-        participant_id = db.get_participant_id(study_id=study_id)
+        participant_id = self._ids.get_participant_id(study_id)
 
         # get data of corresponding participant
-        _, deidentified_id, group_assignment = data_viewer_utils.get_participant_data_for_session(self, db, participant_id)
+        _, deidentified_id, group_assignment = self.get_participant_data(participant_id)
 
         # check if participant can be edited (has no converted sessions)
-        participant_is_editable = data_viewer_utils.get_participant_editable(self, db, participant_id)
+        participant_is_editable = self._ids.participant_is_editable(participant_id)
 
         # update other UI elements
         self.ui.lineEdit_deidentified_id.blockSignals(True)
@@ -373,11 +438,9 @@ class edit_session_dialog(QDialog):
         self.ui.comboBox_group_assignment.setEnabled(participant_is_editable)
         self.ui.comboBox_group_assignment.blockSignals(False)
 
-        # close connection to database
-        db.close()
-
-        # trigger session id spinbox callback, since it also validates the session id for this participant
-        self.spinBox_session_id_value_changed()
+        # validate session id for this participant
+        self._session_id_validation_timer.stop()
+        self.validate_session_id()
 
     def pushButton_new_subject_id_clicked(self):
         
@@ -437,6 +500,11 @@ class edit_session_dialog(QDialog):
                                                                  prefix=self._settings_study["deidentified_subject_identifier_format"]["desired_prefix"]+self._settings_study["deidentified_subject_identifier_format"]["desired_start_str"],
                                                                  digits=self._settings_study["deidentified_subject_identifier_format"]["desired_digits"])
 
+        # all deidentified IDs may already be used
+        if new_deidentified_id == None:
+            res = QMessageBox.critical(self,"Data Viewer","Could not generate a new deidentified ID, since all deidentified IDs are used. Please increase the number of digits of deidentified IDs in the study settings.")
+            return
+
         # add participant to database
 
         # check db settings
@@ -444,8 +512,7 @@ class edit_session_dialog(QDialog):
             return
 
         # connect to database
-        db = database.db(self._settings_db["db_path"])
-        db.n_default_query_attempts = self._settings_db["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
+        db = database.connect(self._settings_db)
 
         participant_id = db.add_participant(study_id=new_subject_id, 
                                                 deidentified_id=new_deidentified_id,
@@ -475,26 +542,15 @@ class edit_session_dialog(QDialog):
             study_id = self.ui.comboBox_subject_id.currentText()
         else:
             return
-        
-        # check db settings
-        if (self._settings_db == None) or (self._settings_db == -1):
-            return
-
-        # connect to database
-        db = database.db(self._settings_db["db_path"])
-        db.n_default_query_attempts = self._settings_db["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
 
         # get participant id and data
-        participant_id = db.get_participant_id(study_id=study_id)
+        participant_id = self._ids.get_participant_id(study_id)
 
         # get data of corresponding participant
-        _, current_deidentified_id, group_assignment = data_viewer_utils.get_participant_data_for_session(self, db, participant_id)
+        _, current_deidentified_id, group_assignment = self.get_participant_data(participant_id)
 
         # check if participant can be edited (has no converted sessions)
-        participant_is_editable = data_viewer_utils.get_participant_editable(self, db, participant_id)
-
-        # close connection to database
-        db.close()
+        participant_is_editable = self._ids.participant_is_editable(participant_id)
 
         # make sure participant is editable (should always be the case)
         if not participant_is_editable:
@@ -578,6 +634,11 @@ class edit_session_dialog(QDialog):
         new_deidentified_id = study.generate_deidentified_id(used_ids=self._all_deidentified_ids, 
                                                                  prefix=self._settings_study["deidentified_subject_identifier_format"]["desired_prefix"]+self._settings_study["deidentified_subject_identifier_format"]["desired_start_str"],
                                                                  digits=self._settings_study["deidentified_subject_identifier_format"]["desired_digits"])
+
+        # all deidentified IDs may already be used
+        if new_deidentified_id == None:
+            res = QMessageBox.critical(self,"Data Viewer","Could not generate a new deidentified ID, since all deidentified IDs are used. Please increase the number of digits of deidentified IDs in the study settings.")
+            return
         
         # set new id
         self.ui.lineEdit_deidentified_id.blockSignals(True)
@@ -591,9 +652,13 @@ class edit_session_dialog(QDialog):
 
     def spinBox_session_id_value_changed(self, value=None):
 
-        # get value if not provided
-        if value==None:
-            value = self._session_id_spinbox.value()
+        # validate once the user stopped changing the value
+        self._session_id_validation_timer.start(self._validation_delay_ms)
+
+    def validate_session_id(self):
+
+        # get value
+        value = self._session_id_spinbox.value()
 
         # make sure value is valid
         if value <= 0:
@@ -612,25 +677,14 @@ class edit_session_dialog(QDialog):
         new_session_id = data_viewer_utils.get_session_id_from_number(value, session_id_prefix, session_id_digits)
 
         # make sure session id is unique. If not, ask user what to do
-        # check db settings
-        if (self._settings_db == None) or (self._settings_db == -1):
-            return
-
-        # connect to database
-        db = database.db(self._settings_db["db_path"])
-        db.n_default_query_attempts = self._settings_db["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
 
         # get participant id
-        participant_id = db.get_participant_id(study_id=study_id)
-        if participant_id == -1:
-            participant_id = None
+        participant_id = self._ids.get_participant_id(study_id)
 
         # get data of selected session
         current_session_data = None
         if self._session_row_id != None:
-            current_session_data = db.get_mri_session_data(id=self._session_row_id, return_only_first=True)
-            if current_session_data == -1:
-                current_session_data = None
+            current_session_data = self._ids.get_session(self._session_row_id)
         
         current_session_id = None
         current_study_id = None
@@ -639,24 +693,13 @@ class edit_session_dialog(QDialog):
             current_session_id = current_session_data["participant_session_id"]
 
             # get data of corresponding participant
-            current_study_id, _, _ = data_viewer_utils.get_participant_data_for_session(self, db, current_participant_id)
-
-        # get all sessions for selected participant
-        if participant_id != None:
-            all_participant_sessions = db.get_mri_session_data(participant_id=participant_id)
-            if all_participant_sessions == -1:
-                all_participant_sessions = None
-
-        # get all session IDs
-        all_participant_session_ids = []
-        if all_participant_sessions != None:
-            for session in all_participant_sessions:
-                id = session["participant_session_id"]
-                if (id != None) and (id != ""):
-                    all_participant_session_ids.append(id)
+            current_study_id, _, _ = self.get_participant_data(current_participant_id)
 
-        # close connection to database
-        db.close()
+        # get all session IDs of selected participant
+        all_participant_session_ids = self._ids.get_participant_session_ids(participant_id)
+        if all_participant_session_ids == -1:
+            res = QMessageBox.critical(self, "Data Viewer", "Could not get participant sessions.")
+            return
 
         if ((study_id != current_study_id) or (new_session_id != current_session_id)) and (new_session_id in all_participant_session_ids):
             res = QMessageBox.question(self, "Data Viewer", "Session ID '" + new_session_id + "' is already assigned to a different session. Would you still like to use it?")
@@ -15,9 +15,10 @@ from PySide6.QtGui import (QBrush, QColor, QConicalGradient, QCursor,
     QFont, QFontDatabase, QGradient, QIcon,
     QImage, QKeySequence, QLinearGradient, QPainter,
     QPalette, QPixmap, QRadialGradient, QTransform)
-from PySide6.QtWidgets import (QApplication, QGridLayout, QHeaderView, QListWidget,
-    QListWidgetItem, QPushButton, QSizePolicy, QSpacerItem,
-    QTabWidget, QTableWidget, QTableWidgetItem, QWidget)
+from PySide6.QtWidgets import (QApplication, QCheckBox, QGridLayout, QHeaderView,
+    QLineEdit, QListView, QProgressBar, QPushButton,
+    QSizePolicy, QSpacerItem, QTabWidget, QTableView,
+    QWidget)
 
 class Ui_data_viewer_ui(object):
     def setupUi(self, data_viewer_ui):
@@ -35,6 +36,26 @@ class Ui_data_viewer_ui(object):
 
         self.gridLayout.addWidget(self.pushButton_reload_db, 1, 1, 1, 1)
 
+        self.lineEdit_search = QLineEdit(data_viewer_ui)
+        self.lineEdit_search.setObjectName(u"lineEdit_search")
+        self.lineEdit_search.setMaximumSize(QSize(300, 16777215))
+        self.lineEdit_search.setClearButtonEnabled(True)
+
+        self.gridLayout.addWidget(self.lineEdit_search, 1, 3, 1, 1)
+
+        self.checkBox_show_archived = QCheckBox(data_viewer_ui)
+        self.checkBox_show_archived.setObjectName(u"checkBox_show_archived")
+
+        self.gridLayout.addWidget(self.checkBox_show_archived, 1, 4, 1, 1)
+
+        self.progressBar_busy = QProgressBar(data_viewer_ui)
+        self.progressBar_busy.setObjectName(u"progressBar_busy")
+        self.progressBar_busy.setMaximumSize(QSize(150, 16777215))
+        self.progressBar_busy.setMaximum(0)
+        self.progressBar_busy.setTextVisible(False)
+
+        self.gridLayout.addWidget(self.progressBar_busy, 1, 5, 1, 1)
+
         self.tabWidget = QTabWidget(data_viewer_ui)
         self.tabWidget.setObjectName(u"tabWidget")
         self.tabWidget.setTabPosition(QTabWidget.West)
@@ -51,10 +72,10 @@ class Ui_data_viewer_ui(object):
 
         self.gridLayout_5.addWidget(self.pushButton_new_participant, 1, 0, 1, 1)
 
-        self.tableWidget_participants = QTableWidget(self.tab_participants)
-        self.tableWidget_participants.setObjectName(u"tableWidget_participants")
+        self.tableView_participants = QTableView(self.tab_participants)
+        self.tableView_participants.setObjectName(u"tableView_participants")
 
-        self.gridLayout_5.addWidget(self.tableWidget_participants, 0, 0, 1, 2)
+        self.gridLayout_5.addWidget(self.tableView_participants, 0, 0, 1, 2)
 
         self.tabWidget.addTab(self.tab_participants, "")
         self.tab_mri = QWidget()
@@ -67,25 +88,25 @@ class Ui_data_viewer_ui(object):
         self.tab_mri_sessions.setObjectName(u"tab_mri_sessions")
         self.gridLayout_4 = QGridLayout(self.tab_mri_sessions)
         self.gridLayout_4.setObjectName(u"gridLayout_4")
-        self.tableWidget_mri_sessions = QTableWidget(self.tab_mri_sessions)
-        self.tableWidget_mri_sessions.setObjectName(u"tableWidget_mri_sessions")
+        self.tableView_mri_sessions = QTableView(self.tab_mri_sessions)
+        self.tableView_mri_sessions.setObjectName(u"tableView_mri_sessions")
 
-        self.gridLayout_4.addWidget(self.tableWidget_mri_sessions, 0, 0, 1, 1)
+        self.gridLayout_4.addWidget(self.tableView_mri_sessions, 0, 0, 1, 1)
 
         self.tabWidget_2.addTab(self.tab_mri_sessions, "")
         self.tab_mri_series = QWidget()
         self.tab_mri_series.setObjectName(u"tab_mri_series")
         self.gridLayout_6 = QGridLayout(self.tab_mri_series)
         self.gridLayout_6.setObjectName(u"gridLayout_6")
-        self.tableWidget_mri_series = QTableWidget(self.tab_mri_series)
-        self.tableWidget_mri_series.setObjectName(u"tableWidget_mri_series")
+        self.tableView_mri_series = QTableView(self.tab_mri_series)
+        self.tableView_mri_series.setObjectName(u"tableView_mri_series")
 
-        self.gridLayout_6.addWidget(self.tableWidget_mri_series, 0, 1, 1, 1)
+        self.gridLayout_6.addWidget(self.tableView_mri_series, 0, 1, 1, 1)
 
-        self.listWidget_mri_session_series = QListWidget(self.tab_mri_series)
-        self.listWidget_mri_session_series.setObjectName(u"listWidget_mri_session_series")
+        self.listView_mri_session_series = QListView(self.tab_mri_series)
+        self.listView_mri_session_series.setObjectName(u"listView_mri_session_series")
 
-        self.gridLayout_6.addWidget(self.listWidget_mri_session_series, 0, 0, 1, 1)
+        self.gridLayout_6.addWidget(self.listView_mri_session_series, 0, 0, 1, 1)
 
         self.gridLayout_6.setColumnStretch(0, 1)
         self.gridLayout_6.setColumnStretch(1, 3)
@@ -94,8 +115,18 @@ class Ui_data_viewer_ui(object):
         self.gridLayout_3.addWidget(self.tabWidget_2, 0, 0, 1, 2)
 
         self.tabWidget.addTab(self.tab_mri, "")
+        self.tab_status = QWidget()
+        self.tab_status.setObjectName(u"tab_status")
+        self.gridLayout_7 = QGridLayout(self.tab_status)
+        self.gridLayout_7.setObjectName(u"gridLayout_7")
+        self.tableView_stage_stats = QTableView(self.tab_status)
+        self.tableView_stage_stats.setObjectName(u"tableView_stage_stats")
+
+        self.gridLayout_7.addWidget(self.tableView_stage_stats, 0, 0, 1, 1)
+
+        self.tabWidget.addTab(self.tab_status, "")
 
-        self.gridLayout.addWidget(self.tabWidget, 0, 1, 1, 2)
+        self.gridLayout.addWidget(self.tabWidget, 0, 1, 1, 5)
 
 
         self.retranslateUi(data_viewer_ui)
@@ -110,10 +141,13 @@ class Ui_data_viewer_ui(object):
     def retranslateUi(self, data_viewer_ui):
         data_viewer_ui.setWindowTitle(QCoreApplication.translate("data_viewer_ui", u"Data Viewer", None))
         self.pushButton_reload_db.setText(QCoreApplication.translate("data_viewer_ui", u"Reload DB", None))
+        self.lineEdit_search.setPlaceholderText(QCoreApplication.translate("data_viewer_ui", u"Search sessions and series", None))
+        self.checkBox_show_archived.setText(QCoreApplication.translate("data_viewer_ui", u"Show archived", None))
         self.pushButton_new_participant.setText(QCoreApplication.translate("data_viewer_ui", u"New Participant", None))
         self.tabWidget.setTabText(self.tabWidget.indexOf(self.tab_participants), QCoreApplication.translate("data_viewer_ui", u"Participants", None))
         self.tabWidget_2.setTabText(self.tabWidget_2.indexOf(self.tab_mri_sessions), QCoreApplication.translate("data_viewer_ui", u"Sessions", None))
         self.tabWidget_2.setTabText(self.tabWidget_2.indexOf(self.tab_mri_series), QCoreApplication.translate("data_viewer_ui", u"Series", None))
         self.tabWidget.setTabText(self.tabWidget.indexOf(self.tab_mri), QCoreApplication.translate("data_viewer_ui", u"MRI", None))
+        self.tabWidget.setTabText(self.tabWidget.indexOf(self.tab_status), QCoreApplication.translate("data_viewer_ui", u"Status", None))
     # retranslateUi
 
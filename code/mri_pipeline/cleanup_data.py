@@ -1,6 +1,7 @@
 from pathlib import Path
 import os
 import sys
+import time
 from datetime import datetime
 import shutil
 
@@ -9,106 +10,40 @@ parentdir = os.path.dirname(currentdir)
 rootdir = os.path.dirname(parentdir)
 
 sys.path.insert(0, parentdir) 
-from common import processing_settings
-from common import database, database_settings
-from common import notifications, notification_settings
-from common import study, study_settings
-from common import mri_proc_utils
+from common import pipeline_context
 
 # global variables
 log_file_name = os.path.join(rootdir,"log","cleanup_data_log.txt")
-log_file = None
-original_stdout = None
+log_title = ("------ CLEANUP DATA ------", )
 
-# define open log file function
-def open_log_file():
+# prepare data cleanup with the given pipeline context (see "pipeline_context")
+# returns the state shared by all sessions (see "process_session")
+def prepare(context):
 
-    global log_file
-    global original_stdout
+    # get notification settings from file (used to report errors)
+    if context.get_settings("notification") == -1: context.terminate_after_error()
 
-    # open log file
-    log_file = open(log_file_name, "w")
-    original_stdout = sys.stdout
-    sys.stdout = log_file
-    print("--------------------------")
-    print("------ CLEANUP DATA ------")
-    print(datetime.now())
-    print("--------------------------")
+    # get study settings from file
+    settings_study = context.get_settings("study")
+    if settings_study == -1: context.terminate_after_error()
 
-# define close log file function
-def close_log_file():
+    # get processing settings from file
+    settings_processing = context.get_settings("processing")
+    if settings_processing == -1: context.terminate_after_error()
 
-    # close log file
-    sys.stdout = original_stdout
-    log_file.close()
+    # get database settings from file
+    db_settings = context.get_settings("database")
+    if db_settings == -1: context.terminate_after_error()
 
-# define exit after error function
-def terminate_after_error():
+    return {"settings_processing": settings_processing,
+            "db_settings": db_settings}
 
-    print("\nTerminating script.")
+# remove data of one session from the work directory
+# session: session data (see "find_mri_sessions_ready_for_cleanup")
+def process_session(context, state, session):
 
-    # close log file
-    close_log_file()
-
-    # send notification
-    if mail_settings["errors"]["send_notification"]:
-        notifications.send_email(mail_settings["errors"]["subject"],
-                         "Attention: Errors were encountered during the execution of 'cleanup_data.py'\nPlease check the attached log file for further information.", 
-                         mail_settings["errors"]["recipients"],
-                         mail_settings["mail_server"]["address"],
-                         mail_settings["mail_server"]["port"],
-                         mail_settings["mail_server"]["user"],
-                         mail_settings["mail_server"]["password"],
-                         (log_file_name, ))
-
-    sys.exit()
-
-# open log file
-open_log_file()
-
-# get notification settings from file
-mail_settings_file = os.path.join(rootdir,"settings","notification_settings.json")
-mail_settings = notification_settings.load_from_file(mail_settings_file)
-if mail_settings == -1:
-    print("ERROR: Unable to load notification settings from \"" + mail_settings_file + "\".")
-    terminate_after_error()
-
-# get study settings from file
-study_settings_file = os.path.join(rootdir,"settings","study_settings.json")
-settings_study = study_settings.load_from_file(study_settings_file)
-if settings_study == -1:
-    print("ERROR: Unable to load study settings from \"" + study_settings_file + "\".")
-    terminate_after_error()
-
-# get processing settings from file
-processing_settings_file = os.path.join(rootdir,"settings","processing_settings.json")
-settings_processing = processing_settings.load_from_file(processing_settings_file)
-if settings_processing == -1:
-    print("ERROR: Unable to load processing settings from \"" + processing_settings_file + "\".")
-    terminate_after_error()
-
-
-# get database settings from file
-db_settings_file = os.path.join(rootdir,"settings","database_settings.json")
-db_settings = database_settings.load_from_file(db_settings_file)
-if db_settings == -1:
-    print("ERROR: Unable to load database settings from \"" + db_settings_file + "\".")
-    terminate_after_error()
-
-# connect to database
-db = database.db(db_settings["db_path"])
-db.n_default_query_attempts = db_settings["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
-
-# find sessions for which data is available but not yet converted to BIDS format
-sessions_requiring_cleanup = db.find_mri_sessions_ready_for_cleanup()
-if sessions_requiring_cleanup == -1: terminate_after_error()
-
-
-for session in sessions_requiring_cleanup:
-    session_id = session["id"]
-    participant_id = session["participant_id"]
+    settings_processing = state["settings_processing"]
     data_file = session["data_file"]
-    participant_session_id = session["participant_session_id"]
 
     # get folder for session
     session_name = Path(data_file).stem
@@ -117,11 +52,44 @@ for session in sessions_requiring_cleanup:
         shutil.rmtree(session_dir)
         print("Removed " + str(session_dir))
 
-# close connection to database
-db.close()
+# run data cleanup with the given pipeline context (see "pipeline_context")
+def run(context):
+
+    # open log file
+    context.open_log_file(log_file_name, *log_title)
+
+    state = prepare(context)
+    db_settings = state["db_settings"]
 
-# close log file
-print("Cleanup data complete")
-close_log_file()
+    # connect to database
+    db = context.get_db()
+    if db == -1: context.terminate_after_error()
 
+    # find sessions for which data was uploaded or that should be skipped
+    sessions_requiring_cleanup = db.find_mri_sessions_ready_for_cleanup()
+    if sessions_requiring_cleanup == -1: context.terminate_after_error()
+
+    for session in sessions_requiring_cleanup:
+        process_session(context, state, session)
+
+    # move sessions that were uploaded a while ago to the archive tables, so the tables used for processing stay small
+    if db_settings["archive_after_days"] >= 0:
+        n_archived = db.archive_mri_sessions(time.time() - db_settings["archive_after_days"]*24*3600)
+        if n_archived == -1: context.terminate_after_error()
+        if n_archived > 0:
+            print("Archived " + str(n_archived) + " MRI session(s)")
+        db.commit()
+
+    # remove old entries from the change log (only needed by the data viewer to refresh recently changed rows)
+    if db.remove_old_changes(db_settings["change_log_retention_days"]) == -1: context.terminate_after_error()
+    db.commit()
+
+    # make sure deidentified IDs are unique (only needed if participants shared a deidentified ID when the database was upgraded)
+    if db.check_unique_deidentified_id_index() == -1: context.terminate_after_error()
+
+    # close log file
+    print("Cleanup data complete")
+    context.close_log_file()
 
+if __name__ == "__main__":
+    pipeline_context.run_script("cleanup_data.py", run)
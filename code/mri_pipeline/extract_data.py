@@ -6,129 +6,60 @@ import zipfile
 import subprocess
 import shutil
 import json
+import io
+import contextlib
+import concurrent.futures
 
 currentdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.dirname(currentdir)
 rootdir = os.path.dirname(parentdir)
 
 sys.path.insert(0, parentdir) 
-from common import processing_settings
-from common import database, database_settings
-from common import notifications, notification_settings
-from common import study, study_settings
+from common import pipeline_context
 from common import mri_proc_utils
 
 # global variables
 log_file_name = os.path.join(rootdir,"log","extract_data_log.txt")
-log_file = None
-original_stdout = None
+log_title = ("------ EXTRACT DATA ------", )
 
-# define open log file function
-def open_log_file():
+# prepare data extraction with the given pipeline context (see "pipeline_context")
+# returns the state shared by all sessions (see "process_session")
+def prepare(context):
 
-    global log_file
-    global original_stdout
+    # get notification settings from file (used to report errors)
+    if context.get_settings("notification") == -1: context.terminate_after_error()
 
-    # open log file
-    log_file = open(log_file_name, "w")
-    original_stdout = sys.stdout
-    sys.stdout = log_file
-    print("--------------------------")
-    print("------ EXTRACT DATA ------")
-    print(datetime.now())
-    print("--------------------------")
+    # get study settings from file
+    settings_study = context.get_settings("study")
+    if settings_study == -1: context.terminate_after_error()
 
-# define close log file function
-def close_log_file():
+    # get processing settings from file
+    settings_processing = context.get_settings("processing")
+    if settings_processing == -1: context.terminate_after_error()
 
-    # close log file
-    sys.stdout = original_stdout
-    log_file.close()
+    # connect to database
+    db = context.get_db()
+    if db == -1: context.terminate_after_error()
 
-# define exit after error function
-def terminate_after_error():
+    # check if current study is in database
+    current_study = context.get_current_study()
+    if current_study == -1: context.terminate_after_error()
 
-    print("\nTerminating script.")
+    return {"settings_processing": settings_processing,
+            "current_study": current_study}
 
-    # close log file
-    close_log_file()
-
-    # send notification
-    if mail_settings["errors"]["send_notification"]:
-        notifications.send_email(mail_settings["errors"]["subject"],
-                         "Attention: Errors were encountered during the execution of 'extract_data.py'\nPlease check the attached log file for further information.", 
-                         mail_settings["errors"]["recipients"],
-                         mail_settings["mail_server"]["address"],
-                         mail_settings["mail_server"]["port"],
-                         mail_settings["mail_server"]["user"],
-                         mail_settings["mail_server"]["password"],
-                         (log_file_name, ))
-
-    sys.exit()
-
-# open log file
-open_log_file()
-
-# get notification settings from file
-mail_settings_file = os.path.join(rootdir,"settings","notification_settings.json")
-mail_settings = notification_settings.load_from_file(mail_settings_file)
-if mail_settings == -1:
-    print("ERROR: Unable to load notification settings from \"" + mail_settings_file + "\".")
-    terminate_after_error()
-
-# get study settings from file
-study_settings_file = os.path.join(rootdir,"settings","study_settings.json")
-settings_study = study_settings.load_from_file(study_settings_file)
-if settings_study == -1:
-    print("ERROR: Unable to load study settings from \"" + study_settings_file + "\".")
-    terminate_after_error()
-
-# get processing settings from file
-processing_settings_file = os.path.join(rootdir,"settings","processing_settings.json")
-settings_processing = processing_settings.load_from_file(processing_settings_file)
-if settings_processing == -1:
-    print("ERROR: Unable to load processing settings from \"" + processing_settings_file + "\".")
-    terminate_after_error()
-
-# get database settings from file
-db_settings_file = os.path.join(rootdir,"settings","database_settings.json")
-db_settings = database_settings.load_from_file(db_settings_file)
-if db_settings == -1:
-    print("ERROR: Unable to load database settings from \"" + db_settings_file + "\".")
-    terminate_after_error()
-
-# connect to database
-db = database.db(db_settings["db_path"])
-db.n_default_query_attempts = db_settings["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
-
-# check if current study is in database
-current_study = None
-if (settings_study["title"] != None) and (isinstance(settings_study["title"], str)) and (settings_study["title"] != ""):
-    res = db.get_study(title=settings_study["title"])
-    if res == -1: terminate_after_error()
-    if res is not None:
-        current_study = res
-    else:
-        res = db.add_study(title=settings_study["title"], description=settings_study["description"])
-        if res == -1: terminate_after_error()
-        current_study = res
-
-# find sessions for which data is available but not yet extracted and converted to nifti
-# skip sessions that should be skipped
-sessions_requiring_conversion = db.find_mri_sessions_requiring_conversion_to_nifti(exclude_skipped=True)
-if sessions_requiring_conversion == -1: terminate_after_error()
-
-for session in sessions_requiring_conversion:
-    session_id = session["id"]
-    participant_id = session["participant_id"]
-    data_file = session["data_file"]
+# extract data of one session and convert it to nifti (the database is not accessed, so this can run in another process)
+# threads_per_worker: number of threads dcm2niix and pigz should use (0 for no limit). This is only a hint: dcm2niix has no option
+#                     to limit its threads, so the limit is passed through the environment and only applies to programs reading it
+# returns the numbers and descriptions of the converted series, or -1 if the data could not be found
+def convert_session(settings_processing, data_file, threads_per_worker=0):
 
     # get folder for session
     session_name = Path(data_file).stem
     session_dir = Path(settings_processing["mri"]["workdir"]).joinpath(session_name)
     if not session_dir.exists():
         print("ERROR: Unable to find data folder for \"" + data_file + "\".")
-        terminate_after_error()
+        return -1
 
     # extract zipped file
     zipped_file_path = session_dir.joinpath(data_file)
@@ -149,7 +80,7 @@ for session in sessions_requiring_conversion:
     dicom_folder_src = session_dir.joinpath(session_name).joinpath("dicom")
     if not dicom_folder_src.exists():
         print("ERROR: Unable to find unzipped dicom data folder for session \"" + session_name + "\".")
-        terminate_after_error()
+        return -1
 
     dicom_folder = session_dir.joinpath("dicom")
     if dicom_folder.exists():
@@ -173,17 +104,25 @@ for session in sessions_requiring_conversion:
     if not log_folder.exists():
         os.mkdir(log_folder)
 
+    # limit the number of threads used by dcm2niix, if requested
+    # the images are compressed by pigz, which reads default options from the "PIGZ" variable (pigz 2.4 or later)
+    env = None
+    if threads_per_worker > 0:
+        env = dict(os.environ)
+        env["OMP_NUM_THREADS"] = str(threads_per_worker)
+        env["PIGZ"] = "-p " + str(threads_per_worker)
+
     # convert all data to NIfTI and log output
     dcm2niix_log_file = log_folder.joinpath("dcm2niix_log.txt")
     with open(dcm2niix_log_file, "w") as logfile:
-        subprocess.run(["dcm2niix", "-u"], stdout=logfile) # check for updates
+        subprocess.run(["dcm2niix", "-u"], stdout=logfile, env=env) # check for updates
         subprocess.run(["dcm2niix", "-b", "y", 
                         "-ba", "y", 
                         "-z", "y", 
                         "-f", "%3s_%p", 
                         "-o",str(nifti_folder), 
                         str(dicom_folder)], 
-                        stdout=logfile) # run conversion
+                        stdout=logfile, env=env) # run conversion
 
     # move all converted files to respective series folder and collect series info
     all_converted_files = mri_proc_utils.list_converted_files(nifti_folder)
@@ -211,22 +150,99 @@ for session in sessions_requiring_conversion:
 
         shutil.move(nifti_folder.joinpath(file), series_folder.joinpath(file))
 
-    # add each series to the database
-    for index, series_number in enumerate(all_series_numbers):
+    return {"series_numbers": all_series_numbers,
+            "series_descriptions": all_series_descriptions}
+
+# convert session in a worker process of the process pool (see "run")
+# the output is collected and returned together with the result, so it can be written to the log file in the order of the sessions
+def convert_session_in_worker(settings_processing, data_file, threads_per_worker):
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = convert_session(settings_processing, data_file, threads_per_worker)
+
+    return result, output.getvalue()
+
+# add the converted series of a session to the database and mark the session as converted
+# result: result of "convert_session"
+def store_session_result(context, state, session, result):
 
-        series_description = all_series_descriptions[index]
+    current_study = state["current_study"]
 
-        db.add_mri_series(study=current_study,participant_id=participant_id, session_id=session_id, series_number=series_number, description=series_description)
+    # connect to database
+    db = context.get_db()
+    if db == -1: context.terminate_after_error()
+
+    if result == -1: context.terminate_after_error()
+
+    session_id = session["id"]
+    participant_id = session["participant_id"]
+    all_series_numbers = result["series_numbers"]
+    all_series_descriptions = result["series_descriptions"]
+
+    # add all series to the database at once
+    new_series = []
+    for index, series_number in enumerate(all_series_numbers):
+        new_series.append({"study": current_study,
+                           "participant_id": participant_id,
+                           "session_id": session_id,
+                           "series_number": series_number,
+                           "description": all_series_descriptions[index]})
+
+    res = db.add_mri_series_many(new_series)
+    if res == -1: context.terminate_after_error()
 
     # update session
     db.update_mri_session(session_id, converted_to_nifti_dt=datetime.now().timestamp())
 
     db.commit()
 
+# extract data of one session, convert it to nifti and add the converted series to the database
+# session: session data (see "find_mri_sessions_requiring_conversion_to_nifti")
+def process_session(context, state, session):
 
-# close connection to database
-db.close()
+    settings_processing = state["settings_processing"]
+    result = convert_session(settings_processing, session["data_file"], settings_processing["mri"]["extraction"]["threads_per_worker"])
+    store_session_result(context, state, session, result)
+
+# run data extraction with the given pipeline context (see "pipeline_context")
+def run(context):
+
+    # open log file
+    context.open_log_file(log_file_name, *log_title)
+
+    state = prepare(context)
+    db = context.get_db()
+
+    # find sessions for which data is available but not yet extracted and converted to nifti
+    # skip sessions that should be skipped
+    sessions_requiring_conversion = db.find_mri_sessions_requiring_conversion_to_nifti(exclude_skipped=True)
+    if sessions_requiring_conversion == -1: context.terminate_after_error()
+
+    # extract and convert several sessions at once in a process pool, if requested
+    # the database is only updated by this process, in the order of the sessions, so the results are the same as in serial mode
+    settings_extraction = state["settings_processing"]["mri"]["extraction"]
+    if (settings_extraction["max_workers"] > 1) and (len(sessions_requiring_conversion) > 1):
+        print("Converting up to " + str(settings_extraction["max_workers"]) + " sessions at once")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=settings_extraction["max_workers"]) as executor:
+            futures = [executor.submit(convert_session_in_worker, state["settings_processing"], session["data_file"], settings_extraction["threads_per_worker"])
+                       for session in sessions_requiring_conversion]
+            try:
+                for session, future in zip(sessions_requiring_conversion, futures):
+                    result, output = future.result()
+                    print(output, end="")
+                    store_session_result(context, state, session, result)
+            finally:
+                # don't start the conversion of the remaining sessions if the extraction was terminated after an error
+                for future in futures:
+                    future.cancel()
+    else:
+        for session in sessions_requiring_conversion:
+            process_session(context, state, session)
+
+    # close log file
+    print("Extract data complete")
+    context.close_log_file()
 
-# close log file
-print("Extract data complete")
-close_log_file()
\ No newline at end of file
+if __name__ == "__main__":
+    pipeline_context.run_script("extract_data.py", run)
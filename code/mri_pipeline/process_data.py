@@ -6,165 +6,219 @@ import zipfile
 import subprocess
 import shutil
 import json
+import concurrent.futures
 
 currentdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.dirname(currentdir)
 rootdir = os.path.dirname(parentdir)
 
 sys.path.insert(0, parentdir) 
-from common import processing_settings
-from common import database, database_settings
-from common import notifications, notification_settings
-from common import study, study_settings
+from common import pipeline_context
 from common import mri_proc_utils
+from common import defacing_queue
 
 # global variables
 log_file_name = os.path.join(rootdir,"log","process_data_log.txt")
-log_file = None
-original_stdout = None
+log_title = ("------ PROCESS DATA ------", )
+
+# prepare data processing with the given pipeline context (see "pipeline_context")
+# returns the state shared by all sessions (see "process_session")
+def prepare(context):
+
+    # get notification settings from file (used to report errors)
+    if context.get_settings("notification") == -1: context.terminate_after_error()
+
+    # get study settings from file
+    settings_study = context.get_settings("study")
+    if settings_study == -1: context.terminate_after_error()
+
+    # get processing settings from file
+    settings_processing = context.get_settings("processing")
+    if settings_processing == -1: context.terminate_after_error()
+
+    # get dcm2bids config from file
+    dcm2bids_config_file = os.path.join(rootdir,"settings","dcm2bids_config.json")
+    config_dcm2bids = mri_proc_utils.parse_dcm2bids_config(dcm2bids_config_file)
+    if config_dcm2bids == -1:
+        print("ERROR: Unable to load dcm2bids configuration from \"" + dcm2bids_config_file + "\".")
+        context.terminate_after_error()
+
+    # create queue defacing the anatomical images of all sessions
+    settings_defacing = settings_processing["mri"]["defacing"]
+    queue = defacing_queue.defacing_queue(max_workers=settings_defacing["max_workers"],
+                                          memory_limit_gb=settings_defacing["memory_limit_gb"],
+                                          memory_per_job_gb=settings_defacing["memory_per_job_gb"])
+
+    return {"settings_study": settings_study,
+            "settings_processing": settings_processing,
+            "dcm2bids_config_file": dcm2bids_config_file,
+            "defacing_queue": queue}
+
+# run dcm2bids to convert series to BIDS format (the series were already converted to NIfTI, see "extract_data.py")
+# series_folders: folders of the series to convert (all series are converted by the same dcm2bids call)
+# logfile: file the output of dcm2bids is written to
+# returns the return code of dcm2bids
+def run_dcm2bids(series_folders, participant_study_id, participant_session_id, dcm2bids_config_file, bids_folder, logfile):
+
+    logfile.flush()
+    result = subprocess.run(["dcm2bids", "-d"] + [str(series_folder) for series_folder in series_folders] + [
+                    "-p", participant_study_id, 
+                    "-s", participant_session_id, 
+                    "-c", dcm2bids_config_file, 
+                    "-o",str(bids_folder), 
+                    "--skip_dcm2niix", "--clobber", "--force_dcm2bids"], 
+                    stdout=logfile) # run BIDS conversion
+
+    return result.returncode
+
+# convert series to BIDS format with several dcm2bids calls running at once
+# each series is converted into its own temporary folder. Once all series are converted, the temporary folders and
+# their logs are merged into the BIDS folder and the log file in the order of the series, so files of later series replace
+# those of earlier series (as if the series were converted one after the other)
+# max_workers: maximum number of dcm2bids calls running at once
+# returns the time the conversion of each series completed (None for series dcm2bids failed to convert), or -1 if the converted files could not be merged
+def convert_series_concurrently(series_folders, participant_study_id, participant_session_id, dcm2bids_config_file, bids_folder, tmp_folder, logfile, max_workers):
+
+    # get temporary folder - make sure previous conversion results are removed
+    if tmp_folder.exists():
+        shutil.rmtree(tmp_folder)
+    os.mkdir(tmp_folder)
+
+    # convert series into its own output folder and log file
+    def convert_series(index):
+        output_folder = tmp_folder.joinpath(str(index))
+        os.mkdir(output_folder)
+        with open(tmp_folder.joinpath(str(index) + "_log.txt"), "w") as series_logfile:
+            returncode = run_dcm2bids((series_folders[index], ), participant_study_id, participant_session_id, dcm2bids_config_file, output_folder, series_logfile)
+        if returncode != 0:
+            return None
+        return datetime.now().timestamp()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        converted_dts = list(executor.map(convert_series, range(len(series_folders))))
+
+    # merge converted files and logs
+    for index in range(len(series_folders)):
+        with open(tmp_folder.joinpath(str(index) + "_log.txt"), "r") as series_logfile:
+            logfile.write(series_logfile.read())
+        if mri_proc_utils.merge_folders(tmp_folder.joinpath(str(index)), bids_folder) == -1:
+            print("ERROR: Unable to merge BIDS data of series folder \"" + str(series_folders[index]) + "\".")
+            return -1
+    logfile.flush()
+
+    shutil.rmtree(tmp_folder)
+
+    return converted_dts
+
+# copy the source data and the identified BIDS data of a session to the data folders
+# participant_data_folder: folder with the BIDS data of the participant (see "process_session")
+def copy_identified_data(settings_processing, session, session_dir, participant_data_folder):
 
-# define open log file function
-def open_log_file():
+    data_file = session["data_file"]
+    participant_study_id = session["participant"]["study_id"]
+    participant_session_id = session["participant_session_id"]
 
-    global log_file
-    global original_stdout
+    # copy sourcedata (folders may be created by several sessions at once, see "stage_scheduler")
+    sourcedata_dir = Path(settings_processing["mri"]["sourcedata_dir"])
+    os.makedirs(sourcedata_dir, exist_ok=True)
 
-    # open log file
-    log_file = open(log_file_name, "w")
-    original_stdout = sys.stdout
-    sys.stdout = log_file
-    print("--------------------------")
-    print("------ PROCESS DATA ------")
-    print(datetime.now())
-    print("--------------------------")
+    subject_dstdir = sourcedata_dir.joinpath(participant_study_id)
+    os.makedirs(subject_dstdir, exist_ok=True)
 
-# define close log file function
-def close_log_file():
+    session_dstdir = subject_dstdir.joinpath(participant_session_id)
+    os.makedirs(session_dstdir, exist_ok=True)
 
-    # close log file
-    sys.stdout = original_stdout
-    log_file.close()
+    data_file_srcpath = session_dir.joinpath(data_file)
+    summary_file_srcpath = session_dir.joinpath(session["summary_file"])
+
+    if data_file_srcpath.exists():
+        data_file_dstpath = session_dstdir.joinpath(data_file)
+        shutil.copyfile(str(data_file_srcpath), str(data_file_dstpath))
 
-# define exit after error function
-def terminate_after_error():
+    if summary_file_srcpath.exists():
+        summary_file_dstpath = session_dstdir.joinpath(session["summary_file"])
+        shutil.copyfile(str(summary_file_srcpath), str(summary_file_dstpath))
 
-    print("\nTerminating script.")
+    # copy BIDS data
+    data_dir = Path(settings_processing["mri"]["data_dir"])
+    os.makedirs(data_dir, exist_ok=True)
+
+    subject_dstdir = data_dir.joinpath(participant_study_id)
+    os.makedirs(subject_dstdir, exist_ok=True)
+
+    session_dstdir = subject_dstdir.joinpath(participant_session_id)
+    if session_dstdir.exists():
+        shutil.rmtree(session_dstdir)
+
+    session_srcdir = participant_data_folder.joinpath(participant_session_id)
+    if session_srcdir.exists():
+        shutil.copytree(session_srcdir, session_dstdir)
+
+# wait for defacing jobs of a session to complete (see "defacing_queue")
+# defacing_jobs: defaced file, log file and future of each job
+def wait_for_defacing(defacing_jobs):
+
+    for file_path, pydeface_log_file, future in defacing_jobs:
+        returncode = future.result()
+        if returncode != 0:
+            print("WARNING: pydeface failed for \"" + str(file_path) + "\" (see \"" + str(pydeface_log_file) + "\").")
+
+# convert data of one session to BIDS format, deidentify it and copy it to the data folders
+# session: session data with participant and series data (see "get_mri_sessions_with_participants")
+def process_session(context, state, session):
+
+    settings_study = state["settings_study"]
+    settings_processing = state["settings_processing"]
+    dcm2bids_config_file = state["dcm2bids_config_file"]
+
+    # connect to database
+    db = context.get_db()
+    if db == -1: context.terminate_after_error()
 
-    # close log file
-    close_log_file()
-
-    # send notification
-    if mail_settings["errors"]["send_notification"]:
-        notifications.send_email(mail_settings["errors"]["subject"],
-                         "Attention: Errors were encountered during the execution of 'process_data.py'\nPlease check the attached log file for further information.", 
-                         mail_settings["errors"]["recipients"],
-                         mail_settings["mail_server"]["address"],
-                         mail_settings["mail_server"]["port"],
-                         mail_settings["mail_server"]["user"],
-                         mail_settings["mail_server"]["password"],
-                         (log_file_name, ))
-
-    sys.exit()
-
-# open log file
-open_log_file()
-
-# get notification settings from file
-mail_settings_file = os.path.join(rootdir,"settings","notification_settings.json")
-mail_settings = notification_settings.load_from_file(mail_settings_file)
-if mail_settings == -1:
-    print("ERROR: Unable to load notification settings from \"" + mail_settings_file + "\".")
-    terminate_after_error()
-
-# get study settings from file
-study_settings_file = os.path.join(rootdir,"settings","study_settings.json")
-settings_study = study_settings.load_from_file(study_settings_file)
-if settings_study == -1:
-    print("ERROR: Unable to load study settings from \"" + study_settings_file + "\".")
-    terminate_after_error()
-
-# get processing settings from file
-processing_settings_file = os.path.join(rootdir,"settings","processing_settings.json")
-settings_processing = processing_settings.load_from_file(processing_settings_file)
-if settings_processing == -1:
-    print("ERROR: Unable to load processing settings from \"" + processing_settings_file + "\".")
-    terminate_after_error()
-
-# get dcm2bids config from file
-dcm2bids_config_file = os.path.join(rootdir,"settings","dcm2bids_config.json")
-config_dcm2bids = mri_proc_utils.parse_dcm2bids_config(dcm2bids_config_file)
-if config_dcm2bids == -1:
-    print("ERROR: Unable to load dcm2bids configuration from \"" + dcm2bids_config_file + "\".")
-    terminate_after_error()
-
-# get database settings from file
-db_settings_file = os.path.join(rootdir,"settings","database_settings.json")
-db_settings = database_settings.load_from_file(db_settings_file)
-if db_settings == -1:
-    print("ERROR: Unable to load database settings from \"" + db_settings_file + "\".")
-    terminate_after_error()
-
-# connect to database
-db = database.db(db_settings["db_path"])
-db.n_default_query_attempts = db_settings["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
-
-# find sessions for which data is available but not yet converted to BIDS format
-sessions_requiring_conversion = db.find_mri_sessions_requiring_conversion_to_bids(exclude_skipped=True)
-if sessions_requiring_conversion == -1: terminate_after_error()
-
-for session in sessions_requiring_conversion:
     session_id = session["id"]
     participant_id = session["participant_id"]
     data_file = session["data_file"]
     participant_session_id = session["participant_session_id"]
 
     # get participant data
-    participant = db.get_participant_data(id=participant_id, return_only_first=True)
-    if participant == -1:
-        print("ERROR: Unable to get participant data for \"" + data_file + "\".")
-        terminate_after_error()
-
+    participant = session["participant"]
     if participant==None:
         print("WARNING: No participant selected for \"" + data_file + "\".")
-        continue
+        return
 
     # check participant and session ID
     participant_study_id = participant["study_id"]
     if (participant_study_id == None) or (participant_study_id == ""):
         print("WARNING: Invalid participant ID for \"" + data_file + "\".")
-        continue
+        return
     if (participant_session_id == None) or (participant_session_id == ""):
         print("WARNING: Invalid session ID for \"" + data_file + "\".")
-        continue
+        return
 
     # get series in session
-    session_series = db.get_mri_series_data(session_id=session["id"])
-    if session_series == -1:
-        print("ERROR: Unable to get series information for \"" + data_file + "\".")
-        terminate_after_error()
-    
+    session_series = session["series"]
     if len(session_series)<1:
         print("WARNING: No series found for \"" + data_file + "\".")
-        continue
+        return
 
     # get folder for session
     session_name = Path(data_file).stem
     session_dir = Path(settings_processing["mri"]["workdir"]).joinpath(session_name)
     if not session_dir.exists():
         print("WARNING: Unable to find data folder for \"" + data_file + "\".")
-        continue
+        return
 
     # get conversion folder
     convert_folder = session_dir.joinpath("convert")
     if not convert_folder.exists():
         print("WARNING: Unable to find converted data folder for \"" + data_file + "\".")
-        continue
+        return
 
     # get nifti folder
     nifti_folder = convert_folder.joinpath("nifti")
     if not nifti_folder.exists():
         print("WARNING: Unable to find NIfTI data folder for \"" + data_file + "\".")
-        continue
+        return
 
     # get BIDS folder - make sure previous conversion results are removed
     bids_folder = convert_folder.joinpath("bids")
@@ -181,7 +235,8 @@ for session in sessions_requiring_conversion:
     with open(dcm2bids_log_file, "w") as logfile:
         subprocess.run(["dcm2bids", "-v"], stdout=logfile) # report version
 
-        # convert each series
+        # get series that still need to be converted
+        series_to_convert = []
         for series in session_series:
 
             # get series folder
@@ -198,102 +253,94 @@ for session in sessions_requiring_conversion:
             if series["data_converted_dt"] != None:
                 continue
 
-            # convert all data to NIfTI and log output
-            subprocess.run(["dcm2bids", "-d", str(series_folder), 
-                            "-p", participant_study_id, 
-                            "-s", participant_session_id, 
-                            "-c", dcm2bids_config_file, 
-                            "-o",str(bids_folder), 
-                            "--skip_dcm2niix", "--clobber", "--force_dcm2bids"], 
-                            stdout=logfile) # run BIDS conversion
-                
-            # update series
-            db.update_mri_series(series["id"], data_converted_dt=datetime.now().timestamp())
+            series_to_convert.append((series, series_folder))
+
+        # convert all series to BIDS format and log output
+        settings_bids_conversion = settings_processing["mri"]["bids_conversion"]
+        series_folders = [series_folder for series, series_folder in series_to_convert]
+        if (settings_bids_conversion["mode"] == "batched") and (len(series_to_convert) > 0):
+
+            # convert all series with a single dcm2bids call, then mark them as converted at once
+            # (if dcm2bids failed, no series is marked as converted and the session is not processed further, so it is converted again in the next run)
+            returncode = run_dcm2bids(series_folders, participant_study_id, participant_session_id, dcm2bids_config_file, bids_folder, logfile)
+            if returncode != 0:
+                print("WARNING: dcm2bids failed for \"" + data_file + "\" (return code " + str(returncode) + ").")
+                return
+
+            converted_dt = datetime.now().timestamp()
+            db.update_mri_series_many([{"id": series["id"], "data_converted_dt": converted_dt} for series, series_folder in series_to_convert])
+            db.commit()
+
+        elif (settings_bids_conversion["mode"] == "concurrent") and (len(series_to_convert) > 1):
+
+            # convert series concurrently, then mark each series as converted at the time its conversion completed
+            # (if dcm2bids failed for any series, no series is marked as converted and the session is not processed further, so it is converted again in the next run)
+            converted_dts = convert_series_concurrently(series_folders, participant_study_id, participant_session_id, dcm2bids_config_file,
+                                                        bids_folder, convert_folder.joinpath("bids_tmp"), logfile,
+                                                        settings_bids_conversion["max_workers"])
+            if converted_dts == -1: context.terminate_after_error()
+            if None in converted_dts:
+                failed_series_numbers = [str(series["series_number"]) for index, (series, series_folder) in enumerate(series_to_convert) if converted_dts[index] == None]
+                print("WARNING: dcm2bids failed for series " + ", ".join(failed_series_numbers) + " of \"" + data_file + "\".")
+                return
+
+            db.update_mri_series_many([{"id": series["id"], "data_converted_dt": converted_dts[index]} for index, (series, series_folder) in enumerate(series_to_convert)])
             db.commit()
 
+        else:
+            for series, series_folder in series_to_convert:
+
+                # if dcm2bids failed, the series is not marked as converted and the session is not processed further
+                returncode = run_dcm2bids((series_folder, ), participant_study_id, participant_session_id, dcm2bids_config_file, bids_folder, logfile)
+                if returncode != 0:
+                    print("WARNING: dcm2bids failed for series " + str(series["series_number"]) + " of \"" + data_file + "\" (return code " + str(returncode) + ").")
+                    return
+
+                # update series
+                db.update_mri_series(series["id"], data_converted_dt=datetime.now().timestamp())
+                db.commit()
+
     # get converted data folder for this participant
     participant_data_folder = bids_folder.joinpath(participant_study_id)
     if not participant_data_folder.exists():
         print("WARNING: Unable to find converted BIDS data folder for \"" + data_file + "\".")
-        continue
+        return
 
     # deidentify data (if possible)
+    defacing_jobs = []
     participant_deidentified_id = participant["deidentified_id"]
     participant_deidentified_data_folder = bids_folder.joinpath(participant_deidentified_id)
     if settings_study["deidentify_data"] and (participant_deidentified_id != None) and (participant_deidentified_id != ""):
-        
+
         # rename files and folders
         mri_proc_utils.deidentify_files_and_folders(str(participant_data_folder),
                                              str(participant_deidentified_data_folder), 
                                              participant_study_id, 
                                              participant_deidentified_id)
-        
-        # deface T1 and T2 images
+
+        # queue jobs defacing T1 and T2 images, each with its own log file (the images are defaced while the
+        # identified data is copied, see "wait_for_defacing")
         anat_folder = participant_deidentified_data_folder.joinpath(participant_session_id).joinpath("anat")
         if anat_folder.exists():
-            pydeface_log_file = log_folder.joinpath("pydeface_log.txt")
             files = mri_proc_utils.list_converted_files(str(anat_folder))
-            with open(pydeface_log_file, "w") as logfile:
-                for file in files:
-                    if file.endswith(".nii.gz"):
-                        file_path = str(anat_folder.joinpath(file))
-                        subprocess.run(["pydeface",
-                                        file_path,
-                                        "--outfile", file_path,
-                                        "--force"],
-                                        stdout=logfile)
-                                                        
-
-    # copy sourcedata
-    sourcedata_dir = Path(settings_processing["mri"]["sourcedata_dir"])
-    if not sourcedata_dir.exists():
-        os.mkdir(sourcedata_dir)
-    
-    subject_dstdir = sourcedata_dir.joinpath(participant_study_id)
-    if not subject_dstdir.exists():
-        os.mkdir(subject_dstdir)
-
-    session_dstdir = subject_dstdir.joinpath(participant_session_id)
-    if not session_dstdir.exists():
-        os.mkdir(session_dstdir)
-
-    data_file_srcpath = session_dir.joinpath(data_file)
-    summary_file_srcpath = session_dir.joinpath(session["summary_file"])
-
-    if data_file_srcpath.exists():
-        data_file_dstpath = session_dstdir.joinpath(data_file)
-        shutil.copyfile(str(data_file_srcpath), str(data_file_dstpath))
-
-    if summary_file_srcpath.exists():
-        summary_file_dstpath = session_dstdir.joinpath(session["summary_file"])
-        shutil.copyfile(str(summary_file_srcpath), str(summary_file_dstpath))
-
-    # copy BIDS data
-    data_dir = Path(settings_processing["mri"]["data_dir"])
-    if not data_dir.exists():
-        os.mkdir(data_dir)
-    
-    subject_dstdir = data_dir.joinpath(participant_study_id)
-    if not subject_dstdir.exists():
-        os.mkdir(subject_dstdir)
-
-    session_dstdir = subject_dstdir.joinpath(participant_session_id)
-    if session_dstdir.exists():
-        shutil.rmtree(session_dstdir)
+            for file in files:
+                if file.endswith(".nii.gz"):
+                    file_path = anat_folder.joinpath(file)
+                    pydeface_log_file = log_folder.joinpath("pydeface_" + file.removesuffix(".nii.gz") + "_log.txt")
+                    defacing_jobs.append((file_path, pydeface_log_file, state["defacing_queue"].submit(file_path, pydeface_log_file)))
 
-    session_srcdir = participant_data_folder.joinpath(participant_session_id)
-    if session_srcdir.exists():
-        shutil.copytree(session_srcdir, session_dstdir)
+    try:
+        copy_identified_data(settings_processing, session, session_dir, participant_data_folder)
+    finally:
+        wait_for_defacing(defacing_jobs)
 
     # copy deidentified BIDS data
     if settings_study["deidentify_data"] and (participant_deidentified_id != None) and (participant_deidentified_id != ""):
         data_dir = Path(settings_processing["mri"]["deidentified_data_dir"])
-        if not data_dir.exists():
-            os.mkdir(data_dir)
-        
+        os.makedirs(data_dir, exist_ok=True)
+
         subject_dstdir = data_dir.joinpath(participant_deidentified_id)
-        if not subject_dstdir.exists():
-            os.mkdir(subject_dstdir)
+        os.makedirs(subject_dstdir, exist_ok=True)
 
         session_dstdir = subject_dstdir.joinpath(participant_session_id)
         if session_dstdir.exists():
@@ -308,12 +355,37 @@ for session in sessions_requiring_conversion:
 
     db.commit()
 
+# stop the worker threads of the defacing queue (called after all sessions were processed)
+# results: values returned by "process_session" for each session
+def finish(context, state, results):
+    state["defacing_queue"].shutdown()
+
+# run data processing with the given pipeline context (see "pipeline_context")
+def run(context):
 
-# close connection to database
-db.close()
+    # open log file
+    context.open_log_file(log_file_name, *log_title)
+
+    state = prepare(context)
+
+    # connect to database
+    db = context.get_db()
+    if db == -1: context.terminate_after_error()
 
-# close log file
-print("Process data complete")
-close_log_file()
+    # find sessions for which data is available but not yet converted to BIDS format
+    # participant and series data are retrieved together with the sessions
+    sessions_requiring_conversion = db.get_mri_sessions_with_participants(stage="conversion_to_bids", exclude_skipped=True, include_series=True)
+    if sessions_requiring_conversion == -1: context.terminate_after_error()
 
+    try:
+        for session in sessions_requiring_conversion:
+            process_session(context, state, session)
+    finally:
+        state["defacing_queue"].shutdown()
+
+    # close log file
+    print("Process data complete")
+    context.close_log_file()
 
+if __name__ == "__main__":
+    pipeline_context.run_script("process_data.py", run)
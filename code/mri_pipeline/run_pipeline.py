@@ -0,0 +1,129 @@
+import os
+import sys
+import time
+
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+rootdir = os.path.dirname(parentdir)
+
+sys.path.insert(0, currentdir)
+sys.path.insert(0, parentdir)
+from common import pipeline_context
+from common import stage_scheduler
+import cbi_sync
+import local_sync
+import extract_data
+import validate_data
+import send_validation_notifications
+import validate_data_with_summary
+import process_data
+import upload_data
+import cleanup_data
+import backup_application
+
+# stages of the pipeline in the order they are run: script name, description and stage module
+stages = (("cbi_sync.py", "CBI SYNC", cbi_sync),
+          ("local_sync.py", "local sync", local_sync),
+          ("extract_data.py", "data extraction", extract_data),
+          ("validate_data.py", "data validation", validate_data),
+          ("send_validation_notifications.py", "notification", send_validation_notifications),
+          ("validate_data_with_summary.py", "data validation with summary", validate_data_with_summary),
+          ("process_data.py", "data conversion", process_data),
+          ("upload_data.py", "data upload", upload_data),
+          ("cleanup_data.py", "data cleanup", cleanup_data),
+          ("backup_application.py", "app backup", backup_application))
+
+# stages processing one session at a time, run by the stage scheduler if it is enabled in the processing settings (see "stage_scheduler"):
+# script name, name of the stage in the processing settings, value of the "stage" column of sessions waiting for the stage
+# and whether the series of each session are needed. Sessions that were uploaded in earlier runs were already cleaned up,
+# so only sessions uploaded during this run are cleaned up by the scheduler.
+# The stages are run in two groups, so the validation notifications are sent right after the data validation (like when the
+# stages are run one after the other), and not only once all sessions were converted and uploaded
+session_stage_groups = ((("extract_data.py", "conversion_to_nifti", "conversion_to_nifti", False),
+                         ("validate_data.py", "data_validation", "data_validation", False)),
+                        (("validate_data_with_summary.py", "data_validation_with_summary", "data_validation_with_summary", False),
+                         ("process_data.py", "conversion_to_bids", "conversion_to_bids", True),
+                         ("upload_data.py", "upload", "upload", True),
+                         ("cleanup_data.py", "cleanup", "complete", False)))
+
+# run stage script and print the time spent in it
+def run_stage(script_name, description, stage):
+
+    print("")
+    print("Running " + description + " script ...")
+    start_time = time.monotonic()
+    completed = context.run_stage(script_name, stage.run)
+    duration = time.monotonic() - start_time
+    stage_times.append((script_name, duration, completed))
+    if completed:
+        print("Done ({:.1f} s)".format(duration))
+    else:
+        print("Terminated after error ({:.1f} s)".format(duration))
+
+# run a group of per-session stages with the stage scheduler and print the time spent in them
+# session_stages: stages of the group (see "session_stage_groups")
+def run_scheduler(settings_scheduler, session_stages):
+
+    print("")
+    print("Running " + ", ".join(session_stage[0] for session_stage in session_stages) + " with the stage scheduler (at most " + str(settings_scheduler["max_workers"]) + " sessions at once) ...")
+
+    scheduler = stage_scheduler.stage_scheduler(context, max_workers=settings_scheduler["max_workers"])
+    for script_name, name, db_stage, include_series in session_stages:
+        stage = stage_modules[script_name]
+        scheduler.add_stage(name, db_stage, script_name, stage.log_file_name, stage.log_title,
+                            stage.prepare, stage.process_session, getattr(stage, "finish", None),
+                            max_workers=settings_scheduler["max_workers_per_stage"].get(name, 1),
+                            include_series=include_series,
+                            queue_pending=(name != "cleanup"))
+
+    start_time = time.monotonic()
+    completed = scheduler.run()
+    duration = time.monotonic() - start_time
+    stage_times.append(("stage scheduler (" + session_stages[0][0] + " - " + session_stages[-1][0] + ")", duration, completed))
+    if completed:
+        print("Done ({:.1f} s)".format(duration))
+    else:
+        print("Completed with errors ({:.1f} s)".format(duration))
+
+    for stage in scheduler.get_stages():
+        print("  {:<36s}{:>5d} session(s), {:.1f} s".format(stage["script_name"], stage["n_completed"], stage["busy_s"])
+              + ("" if stage["n_failed"] == 0 else ", " + str(stage["n_failed"]) + " error(s)"))
+
+# run all stages in this process with one shared context, so the settings are loaded and the connections
+# to the database, CBI Home and Box are opened only once. An error in one stage only stops that stage
+context = pipeline_context.pipeline_context()
+context.statement_log_file_name = os.path.join(rootdir,"log","run_pipeline_log.txt")
+stage_modules = {script_name: stage for script_name, _, stage in stages}
+stage_times = []
+
+print("Started automated MRI pipeline")
+
+# check if the stage scheduler is enabled (if the processing settings can't be loaded, the stages report the error)
+settings_processing = context.get_settings("processing")
+use_scheduler = (settings_processing != -1) and settings_processing["scheduler"]["enabled"]
+
+for script_name, description, stage in stages:
+
+    # the per-session stages of each group are run by the scheduler when the first stage of the group is reached
+    session_stage_group = next((group for group in session_stage_groups if script_name in [session_stage[0] for session_stage in group]), None)
+    if use_scheduler and (session_stage_group != None):
+        if script_name == session_stage_group[0][0]:
+            run_scheduler(settings_processing["scheduler"], session_stage_group)
+
+        # data cleanup also removes data of skipped sessions and archives old sessions, so the script is run in any case
+        if script_name != "cleanup_data.py":
+            continue
+
+    run_stage(script_name, description, stage)
+
+context.close()
+
+# print summary of the time spent in each stage
+print("")
+print("Stage durations:")
+for script_name, duration, completed in stage_times:
+    print("  {:<36s}{:>9.1f} s{}".format(script_name, duration, "" if completed else "  (terminated after error)"))
+print("  {:<36s}{:>9.1f} s".format("total", sum(duration for _, duration, _ in stage_times)))
+
+print("")
+print("MRI pipeline completed")
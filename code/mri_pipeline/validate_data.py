@@ -12,111 +12,54 @@ parentdir = os.path.dirname(currentdir)
 rootdir = os.path.dirname(parentdir)
 
 sys.path.insert(0, parentdir) 
-from common import processing_settings
-from common import database, database_settings
-from common import notifications, notification_settings
-from common import study, study_settings
+from common import pipeline_context
+from common import notifications
 from common import mri_proc_utils
 
 # global variables
 log_file_name = os.path.join(rootdir,"log","validate_data_log.txt")
-log_file = None
-original_stdout = None
+log_title = ("----- VALIDATE DATA ------", )
 
-# define open log file function
-def open_log_file():
+# prepare data validation with the given pipeline context (see "pipeline_context")
+# returns the state shared by all sessions (see "process_session")
+def prepare(context):
 
-    global log_file
-    global original_stdout
+    # get notification settings from file
+    mail_settings = context.get_settings("notification")
+    if mail_settings == -1: context.terminate_after_error()
 
-    # open log file
-    log_file = open(log_file_name, "w")
-    original_stdout = sys.stdout
-    sys.stdout = log_file
-    print("--------------------------")
-    print("----- VALIDATE DATA ------")
-    print(datetime.now())
-    print("--------------------------")
+    # get study settings from file
+    settings_study = context.get_settings("study")
+    if settings_study == -1: context.terminate_after_error()
 
-# define close log file function
-def close_log_file():
+    # get processing settings from file
+    settings_processing = context.get_settings("processing")
+    if settings_processing == -1: context.terminate_after_error()
 
-    # close log file
-    sys.stdout = original_stdout
-    log_file.close()
+    # get dcm2bids config from file
+    dcm2bids_config_file = os.path.join(rootdir,"settings","dcm2bids_config.json")
+    config_dcm2bids = mri_proc_utils.parse_dcm2bids_config(dcm2bids_config_file)
+    if config_dcm2bids == -1:
+        print("ERROR: Unable to load dcm2bids configuration from \"" + dcm2bids_config_file + "\".")
+        context.terminate_after_error()
 
-# define exit after error function
-def terminate_after_error():
+    return {"mail_settings": mail_settings,
+            "settings_processing": settings_processing,
+            "config_dcm2bids": config_dcm2bids}
 
-    print("\nTerminating script.")
+# validate converted data of one session
+# session: session data (see "find_mri_sessions_requiring_data_validation")
+# returns the validation errors that should be included in the error notification ("" if there were no errors)
+def process_session(context, state, session):
+
+    settings_processing = state["settings_processing"]
+    config_dcm2bids = state["config_dcm2bids"]
+    notification = ""
+
+    # connect to database
+    db = context.get_db()
+    if db == -1: context.terminate_after_error()
 
-    # close log file
-    close_log_file()
-
-    # send notification
-    if mail_settings["errors"]["send_notification"]:
-        notifications.send_email(mail_settings["errors"]["subject"],
-                         "Attention: Errors were encountered during the execution of 'validate_data.py'\nPlease check the attached log file for further information.", 
-                         mail_settings["errors"]["recipients"],
-                         mail_settings["mail_server"]["address"],
-                         mail_settings["mail_server"]["port"],
-                         mail_settings["mail_server"]["user"],
-                         mail_settings["mail_server"]["password"],
-                         (log_file_name, ))
-
-    sys.exit()
-
-# open log file
-open_log_file()
-
-# get notification settings from file
-mail_settings_file = os.path.join(rootdir,"settings","notification_settings.json")
-mail_settings = notification_settings.load_from_file(mail_settings_file)
-if mail_settings == -1:
-    print("ERROR: Unable to load notification settings from \"" + mail_settings_file + "\".")
-    terminate_after_error()
-
-# get study settings from file
-study_settings_file = os.path.join(rootdir,"settings","study_settings.json")
-settings_study = study_settings.load_from_file(study_settings_file)
-if settings_study == -1:
-    print("ERROR: Unable to load study settings from \"" + study_settings_file + "\".")
-    terminate_after_error()
-
-# get processing settings from file
-processing_settings_file = os.path.join(rootdir,"settings","processing_settings.json")
-settings_processing = processing_settings.load_from_file(processing_settings_file)
-if settings_processing == -1:
-    print("ERROR: Unable to load processing settings from \"" + processing_settings_file + "\".")
-    terminate_after_error()
-
-# get dcm2bids config from file
-dcm2bids_config_file = os.path.join(rootdir,"settings","dcm2bids_config.json")
-config_dcm2bids = mri_proc_utils.parse_dcm2bids_config(dcm2bids_config_file)
-if config_dcm2bids == -1:
-    print("ERROR: Unable to load dcm2bids configuration from \"" + dcm2bids_config_file + "\".")
-    terminate_after_error()
-
-# get database settings from file
-db_settings_file = os.path.join(rootdir,"settings","database_settings.json")
-db_settings = database_settings.load_from_file(db_settings_file)
-if db_settings == -1:
-    print("ERROR: Unable to load database settings from \"" + db_settings_file + "\".")
-    terminate_after_error()
-
-# connect to database
-db = database.db(db_settings["db_path"])
-db.n_default_query_attempts = db_settings["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
-
-# find sessions for which data is available and extracted but not yet validated
-# skip sessions that should be skipped
-sessions_requiring_validation = db.find_mri_sessions_requiring_data_validation(exclude_skipped=True)
-if sessions_requiring_validation == -1: terminate_after_error()
-
-send_validation_error_notification = False
-validation_error_notification = "Attention: Errors were encountered while validating the downloaded session data.\nPlease check the attached log file for further details.\n\n"
-
-for session in sessions_requiring_validation:
     session_id = session["id"]
     participant_id = session["participant_id"]
     data_file = session["data_file"]
@@ -125,44 +68,50 @@ for session in sessions_requiring_validation:
     session_series = db.get_mri_series_data(session_id=session_id)
     if len(session_series) < 1:
         print("ERROR: No series found in database for \"" + data_file + "\".")
-        terminate_after_error()
+        context.terminate_after_error()
 
     # get folder for session
     session_name = Path(data_file).stem
     session_dir = Path(settings_processing["mri"]["workdir"]).joinpath(session_name)
     if not session_dir.exists():
         print("ERROR: Unable to find data folder for \"" + data_file + "\".")
-        terminate_after_error()
+        context.terminate_after_error()
 
     # get conversion folder
     convert_folder = session_dir.joinpath("convert")
     if not convert_folder.exists():
         print("ERROR: Unable to find converted data folder for \"" + data_file + "\".")
-        terminate_after_error()
+        context.terminate_after_error()
 
     # get nifti folder - make sure previous conversion results are removed
     nifti_folder = convert_folder.joinpath("nifti")
     if not convert_folder.exists():
         print("ERROR: Unable to find nifti data folder for \"" + data_file + "\".")
-        terminate_after_error()
+        context.terminate_after_error()
 
     # get log folder
     log_folder = convert_folder.joinpath("log")
     if not log_folder.exists():
         print("ERROR: Unable to find conversion log folder for \"" + data_file + "\".")
-        terminate_after_error()
+        context.terminate_after_error()
 
     # get conversion log file
     dcm2niix_log_file = log_folder.joinpath("dcm2niix_log.txt")
     if not dcm2niix_log_file.exists():
         print("ERROR: Unable to find dcm2niix log file for \"" + data_file + "\".")
-        terminate_after_error()
+        context.terminate_after_error()
 
     # parse dcm2niix log file
     conversion_summary = mri_proc_utils.parse_dcm2niix_log(str(dcm2niix_log_file))
     if conversion_summary==-1:
         print("ERROR: Unable to parse dcm2niix log file for \"" + data_file + "\".")
-        terminate_after_error()
+        context.terminate_after_error()
+
+    # index series by series number (if a series number appears more than once, the first series is used)
+    session_series_by_number = {}
+    for series in session_series:
+        if not series["series_number"] in session_series_by_number:
+            session_series_by_number[series["series_number"]] = series
 
     # validate converted files
     converted_series = []
@@ -175,7 +124,7 @@ for session in sessions_requiring_validation:
 
         # find matches
         matching_conversion_info = list(filter(lambda conversion_info:conversion_info["series_number"]==series_number, conversion_summary))
-        matching_series = db.get_mri_series_data(session_id=session_id, series_number=series_number, return_only_first=True)
+        matching_series = session_series_by_number.get(series_number)
 
         # sort conversion info by file name (in series with multiple converted files, they are sometimes out of order after conversion)
         matching_conversion_info = sorted(matching_conversion_info, key=lambda x: x['file'])
@@ -214,7 +163,7 @@ for session in sessions_requiring_validation:
                 print(nifti_file)
                 print(sidecar_file)
                 all_files_found = False
-        
+
         if not all_files_found:
             errors.append({"series_number": series_number,
                         "message": "Could not find all converted files."})
@@ -236,19 +185,17 @@ for session in sessions_requiring_validation:
 
     # check for errors
     if len(errors)>0:
-        send_validation_error_notification = True
         print("WARNING: Errors found when matching recorded files to converted files for session\"" + session_name + "\":")
-        validation_error_notification = validation_error_notification + "Errors found when matching recorded files to converted files for session\"" + session_name + "\":\n"
+        notification = notification + "Errors found when matching recorded files to converted files for session\"" + session_name + "\":\n"
         for error in errors:
             print(" - series " + str(error["series_number"]) + ": " + error["message"])
-            validation_error_notification = validation_error_notification + " - series " + str(error["series_number"]) + ": " + error["message"] + "\n"
-        validation_error_notification = validation_error_notification + "\n\n"
+            notification = notification + " - series " + str(error["series_number"]) + ": " + error["message"] + "\n"
+        notification = notification + "\n\n"
 
     # make sure all series have a match
     if len(converted_series) != max_series:
-        send_validation_error_notification = True
         print("WARNING: Could not find matching files for some series in session \"" + session_name + "\".")
-        validation_error_notification = validation_error_notification + "Could not find matching files for some series in session \"" + session_name + "\".\n\n"
+        notification = notification + "Could not find matching files for some series in session \"" + session_name + "\".\n\n"
 
     # parse sidecar files and extract dcm2bids search criteria
     all_dcm2bids_search_criteria_values = []
@@ -275,14 +222,14 @@ for session in sessions_requiring_validation:
 
             series_number = conversion_info["series_number"]
             sidecar_file = nifti_folder.joinpath(str(series_number).zfill(3)).joinpath(conversion_info["file"] + ".json")
-            
+
             try:
                 with open(str(sidecar_file), 'r') as f:
                     info = json.load(f)
             except Exception as e:
                 print("ERROR: Unable to read sidecar file \"" + str(sidecar_file) + "\":\n")
                 print(e)
-                terminate_after_error()
+                context.terminate_after_error()
 
             for key in config_dcm2bids["search_criteria"]["keys"]:
                 if key in info:
@@ -334,6 +281,7 @@ for session in sessions_requiring_validation:
     # write to database
     all_converted_files_valid = True
     any_converted_files_valid = False
+    series_updates = []
     for series in converted_series:
 
         # convert some fields to json strings
@@ -345,38 +293,80 @@ for session in sessions_requiring_validation:
         if (series["duplicate_series"] != None) and (len(series["duplicate_series"]) > 0):
             duplicate_series = json.dumps(series["duplicate_series"])
 
-        db.update_mri_series(id = series["series_id"],
-                             description = series["series_description"],
-                             number_files = series["number_files"],
-                             files_validated_dt = datetime.now().timestamp(),
-                             files_valid = series["validated_files"],
-                             dcm2bids_criteria = dcm2bids_criteria,
-                             dcm2bids_criteria_in_config = series["dcm2bids_criteria_in_config"],
-                             duplicate_series = duplicate_series,
-                             skip_processing = series["skip_series"])
-        
+        series_updates.append({"id": series["series_id"],
+                               "description": series["series_description"],
+                               "number_files": series["number_files"],
+                               "files_validated_dt": datetime.now().timestamp(),
+                               "files_valid": series["validated_files"],
+                               "dcm2bids_criteria": dcm2bids_criteria,
+                               "dcm2bids_criteria_in_config": series["dcm2bids_criteria_in_config"],
+                               "duplicate_series": duplicate_series,
+                               "skip_processing": series["skip_series"]})
+
         all_converted_files_valid = all_converted_files_valid and series["validated_files"]
         any_converted_files_valid = any_converted_files_valid or series["validated_files"]
-        
+
+    db.update_mri_series_many(series_updates)
+
     db.update_mri_session(id=session_id, 
                           conversion_validated_dt=datetime.now().timestamp(),
                           conversion_valid=all_converted_files_valid)
     db.commit()
 
-# close connection to database
-db.close()
-
-# close log file
-print("Validate data complete")
-close_log_file()
-
-# send error notification
-if mail_settings["errors"]["send_notification"] and send_validation_error_notification:
-        notifications.send_email(mail_settings["errors"]["subject"],
-                         validation_error_notification, 
-                         mail_settings["errors"]["recipients"],
-                         mail_settings["mail_server"]["address"],
-                         mail_settings["mail_server"]["port"],
-                         mail_settings["mail_server"]["user"],
-                         mail_settings["mail_server"]["password"],
-                         (log_file_name, ))
\ No newline at end of file
+    return notification
+
+# send notification with the validation errors of all sessions (called after the log file was closed)
+# results: validation errors returned by "process_session" for each session
+def finish(context, state, results):
+
+    mail_settings = state["mail_settings"]
+
+    # collect validation errors
+    validation_error_notification = "Attention: Errors were encountered while validating the downloaded session data.\nPlease check the attached log file for further details.\n\n"
+    send_validation_error_notification = False
+    for notification in results:
+        if notification != "":
+            send_validation_error_notification = True
+            validation_error_notification = validation_error_notification + notification
+
+    # send error notification
+    if mail_settings["errors"]["send_notification"] and send_validation_error_notification:
+            notifications.send_email(mail_settings["errors"]["subject"],
+                             validation_error_notification, 
+                             mail_settings["errors"]["recipients"],
+                             mail_settings["mail_server"]["address"],
+                             mail_settings["mail_server"]["port"],
+                             mail_settings["mail_server"]["user"],
+                             mail_settings["mail_server"]["password"],
+                             (log_file_name, ))
+
+# run data validation with the given pipeline context (see "pipeline_context")
+def run(context):
+
+    # open log file
+    context.open_log_file(log_file_name, *log_title)
+
+    state = prepare(context)
+
+    # connect to database
+    db = context.get_db()
+    if db == -1: context.terminate_after_error()
+
+    # find sessions for which data is available and extracted but not yet validated
+    # skip sessions that should be skipped
+    sessions_requiring_validation = db.find_mri_sessions_requiring_data_validation(exclude_skipped=True)
+    if sessions_requiring_validation == -1: context.terminate_after_error()
+
+    results = []
+    for session in sessions_requiring_validation:
+        results.append(process_session(context, state, session))
+
+    # close log file
+    print("Validate data complete")
+    context.close_log_file()
+
+    # send error notification
+    finish(context, state, results)
+
+if __name__ == "__main__":
+    pipeline_context.run_script("validate_data.py", run)
@@ -12,105 +12,45 @@ parentdir = os.path.dirname(currentdir)
 rootdir = os.path.dirname(parentdir)
 
 sys.path.insert(0, parentdir) 
-from common import processing_settings
-from common import database, database_settings
-from common import notifications, notification_settings
-from common import study, study_settings
+from common import pipeline_context
+from common import notifications
 from common import mri_proc_utils
 
 # global variables
 log_file_name = os.path.join(rootdir,"log","validate_data_with_summary_log.txt")
-log_file = None
-original_stdout = None
+log_title = ("----- VALIDATE DATA ------", "------ WITH SUMMARY ------")
 
-# define open log file function
-def open_log_file():
+# prepare data validation with summary with the given pipeline context (see "pipeline_context")
+# returns the state shared by all sessions (see "process_session")
+def prepare(context):
 
-    global log_file
-    global original_stdout
+    # get notification settings from file
+    mail_settings = context.get_settings("notification")
+    if mail_settings == -1: context.terminate_after_error()
 
-    # open log file
-    log_file = open(log_file_name, "w")
-    original_stdout = sys.stdout
-    sys.stdout = log_file
-    print("--------------------------")
-    print("----- VALIDATE DATA ------")
-    print("------ WITH SUMMARY ------")
-    print(datetime.now())
-    print("--------------------------")
-
-# define close log file function
-def close_log_file():
+    # get study settings from file
+    settings_study = context.get_settings("study")
+    if settings_study == -1: context.terminate_after_error()
 
-    # close log file
-    sys.stdout = original_stdout
-    log_file.close()
+    # get processing settings from file
+    settings_processing = context.get_settings("processing")
+    if settings_processing == -1: context.terminate_after_error()
 
-# define exit after error function
-def terminate_after_error():
+    return {"mail_settings": mail_settings,
+            "settings_processing": settings_processing}
 
-    print("\nTerminating script.")
+# validate converted data of one session with the session summary file
+# session: session data (see "find_mri_sessions_requiring_data_validation_with_summary")
+# returns the validation errors that should be included in the error notification ("" if there were no errors)
+def process_session(context, state, session):
+
+    settings_processing = state["settings_processing"]
+    notification = ""
+
+    # connect to database
+    db = context.get_db()
+    if db == -1: context.terminate_after_error()
 
-    # close log file
-    close_log_file()
-
-    # send notification
-    if mail_settings["errors"]["send_notification"]:
-        notifications.send_email(mail_settings["errors"]["subject"],
-                         "Attention: Errors were encountered during the execution of 'validate_data_with_summary.py'\nPlease check the attached log file for further information.", 
-                         mail_settings["errors"]["recipients"],
-                         mail_settings["mail_server"]["address"],
-                         mail_settings["mail_server"]["port"],
-                         mail_settings["mail_server"]["user"],
-                         mail_settings["mail_server"]["password"],
-                         (log_file_name, ))
-
-    sys.exit()
-
-# open log file
-open_log_file()
-
-# get notification settings from file
-mail_settings_file = os.path.join(rootdir,"settings","notification_settings.json")
-mail_settings = notification_settings.load_from_file(mail_settings_file)
-if mail_settings == -1:
-    print("ERROR: Unable to load notification settings from \"" + mail_settings_file + "\".")
-    terminate_after_error()
-
-# get study settings from file
-study_settings_file = os.path.join(rootdir,"settings","study_settings.json")
-settings_study = study_settings.load_from_file(study_settings_file)
-if settings_study == -1:
-    print("ERROR: Unable to load study settings from \"" + study_settings_file + "\".")
-    terminate_after_error()
-
-# get processing settings from file
-processing_settings_file = os.path.join(rootdir,"settings","processing_settings.json")
-settings_processing = processing_settings.load_from_file(processing_settings_file)
-if settings_processing == -1:
-    print("ERROR: Unable to load processing settings from \"" + processing_settings_file + "\".")
-    terminate_after_error()
-
-# get database settings from file
-db_settings_file = os.path.join(rootdir,"settings","database_settings.json")
-db_settings = database_settings.load_from_file(db_settings_file)
-if db_settings == -1:
-    print("ERROR: Unable to load database settings from \"" + db_settings_file + "\".")
-    terminate_after_error()
-
-# connect to database
-db = database.db(db_settings["db_path"])
-db.n_default_query_attempts = db_settings["n_default_query_attempts"] # default number of attempts before a query fails (e.g. transactions could be blocked by another process writing to the database)
-
-# find sessions for which data is available and extracted and validated, but not validated with summary
-# skip sessions that should be skipped
-sessions_requiring_validation = db.find_mri_sessions_requiring_data_validation_with_summary(exclude_skipped=True)
-if sessions_requiring_validation == -1: terminate_after_error()
-
-send_validation_error_notification = False
-validation_error_notification = "Attention: Errors were encountered while validating the downloaded session data.\nPlease check the attached log file for further details.\n\n"
-
-for session in sessions_requiring_validation:
     session_id = session["id"]
     participant_id = session["participant_id"]
     data_file = session["data_file"]
@@ -123,14 +63,14 @@ for session in sessions_requiring_validation:
     session_series = db.get_mri_series_data(session_id=session_id)
     if len(session_series) < 1:
         print("ERROR: No series found in database for \"" + data_file + "\".")
-        terminate_after_error()
+        context.terminate_after_error()
 
     # get folder for session
     session_name = Path(data_file).stem
     session_dir = Path(settings_processing["mri"]["workdir"]).joinpath(session_name)
     if not session_dir.exists():
         print("ERROR: Unable to find data folder for \"" + data_file + "\".")
-        terminate_after_error()
+        context.terminate_after_error()
 
     # check if summary file was downloaded
     if (summary_downloaded_dt == None) or (summary_file == None) or (summary_file == ""):
@@ -140,7 +80,7 @@ for session in sessions_requiring_validation:
         delta_hours = delta.total_seconds() / 3600
 
         if delta_hours > settings_processing["mri"]["summary_file_wait_timeout_h"]:
-            
+
             # stop waiting and mark this session as validated
             db.update_mri_session(id = session_id, 
                                   conversion_validated_with_summary_dt = datetime.now().timestamp())
@@ -148,23 +88,22 @@ for session in sessions_requiring_validation:
 
             # queue notification
             if settings_processing["mri"]["summary_file_wait_timeout_h"]>0:
-                send_validation_error_notification = True
                 print("WARNING: Waited for more than " + str(settings_processing["mri"]["summary_file_wait_timeout_h"]) + " hours for summary file of session \"" + session_name + "\".\nThis session will be marked as validated and will be processed without the summary file.\n\n")
-                validation_error_notification = validation_error_notification + "Waited for more than " + str(settings_processing["mri"]["summary_file_wait_timeout_h"]) + " hours for summary file of session \"" + session_name + "\".\nThis session will be marked as validated and will be processed without the summary file.\n\n"
+                notification = notification + "Waited for more than " + str(settings_processing["mri"]["summary_file_wait_timeout_h"]) + " hours for summary file of session \"" + session_name + "\".\nThis session will be marked as validated and will be processed without the summary file.\n\n"
 
-        continue
+        return notification
 
     # get summary file path
     summary_file_path = session_dir.joinpath(summary_file)
     if not summary_file_path.exists():
         print("ERROR: Unable to find summary file for \"" + data_file + "\".")
-        terminate_after_error()
+        context.terminate_after_error()
 
     # parse session summary
     session_summary = mri_proc_utils.parse_summary_file(str(session_dir.joinpath(summary_file)))
     if session_summary==-1:
         print("ERROR: Unable to parse summary file for \"" + data_file + "\".")
-        terminate_after_error()
+        context.terminate_after_error()
 
     # validate each series by looking at summary file and database entries
     converted_series = []
@@ -172,21 +111,26 @@ for session in sessions_requiring_validation:
     max_series_in_summary = max(session_summary["series_info"], key=lambda series_info:series_info["series_number"])["series_number"]
     max_series_in_db = max(session_series, key=lambda series_info:series_info["series_number"])["series_number"]
     max_series = max(max_series_in_summary, max_series_in_db)
-    
+
     number_files_in_db_total = 0
     all_series_valid = True
     any_series_valid = False
 
+    # index series by series number (if a series number appears more than once, the first series is used)
+    session_series_by_number = {}
+    for series in session_series:
+        if not series["series_number"] in session_series_by_number:
+            session_series_by_number[series["series_number"]] = series
+
+    # collect series updates, so they can be written to the database at once
+    series_updates = []
+
     for series_number in range(1,max_series+1):
 
         # find matches
         matching_series_info = list(filter(lambda series_info:series_info["series_number"]==series_number, session_summary["series_info"]))
-        
-        matching_series = db.get_mri_series_data(session_id=session_id, series_number=series_number, return_only_first=True)
-        if matching_series==-1:
-            errors.append({"series_number": series_number,
-                        "message": "Could not query database for matching series."})
-            continue
+
+        matching_series = session_series_by_number.get(series_number)
 
         # check if there is neither a matching series info nor a matching series (sometimes series numbers are skipped)
         if ((matching_series)==None) and (len(matching_series_info)<1):
@@ -247,28 +191,27 @@ for session in sessions_requiring_validation:
         any_series_valid = any_series_valid or validated_series_files
 
         # update series in db
-        db.update_mri_series(id = matching_series["id"],
-                             series_recorded_dt=series_recorded_dt,
-                             files_validated_with_summary_dt = datetime.now().timestamp(),
-                             files_valid = files_valid,
-                             skip_processing = skip_processing)
-        db.commit()
+        series_updates.append({"id": matching_series["id"],
+                               "series_recorded_dt": series_recorded_dt,
+                               "files_validated_with_summary_dt": datetime.now().timestamp(),
+                               "files_valid": files_valid,
+                               "skip_processing": skip_processing})
+
+    db.update_mri_series_many(series_updates)
 
     # check for errors
     if len(errors)>0:
-        send_validation_error_notification = True
         print("WARNING: Errors found when validating session\"" + session_name + "\" with session summary file:")
-        validation_error_notification = validation_error_notification + " Errors found when validating session\"" + session_name + "\" with session summary file:\n"
+        notification = notification + " Errors found when validating session\"" + session_name + "\" with session summary file:\n"
         for error in errors:
             print(" - series " + str(error["series_number"]) + ": " + error["message"])
-            validation_error_notification = validation_error_notification + " - series " + str(error["series_number"]) + ": " + error["message"] + "\n"
-        validation_error_notification = validation_error_notification + "\n\n"
+            notification = notification + " - series " + str(error["series_number"]) + ": " + error["message"] + "\n"
+        notification = notification + "\n\n"
 
     # compare total number of files
     if session_summary["session_info"]["total_files"] != number_files_in_db_total:
         print("WARNING: Total number of files in session summary does not match number of converted DICOM files for session \"" + session_name + "\"")
-        send_validation_error_notification = True
-        validation_error_notification = validation_error_notification + "Total number of files in session summary does not match number of converted DICOM files for session \"" + session_name + "\".\n\n"
+        notification = notification + "Total number of files in session summary does not match number of converted DICOM files for session \"" + session_name + "\".\n\n"
 
     # update conversion valid flag for session
     if not all_series_valid:
@@ -280,20 +223,60 @@ for session in sessions_requiring_validation:
                           conversion_valid=conversion_valid)
     db.commit()
 
-# close connection to database
-db.close()
-
-# close log file
-print("Validate data with summary complete")
-close_log_file()
-
-# send error notification
-if mail_settings["errors"]["send_notification"] and send_validation_error_notification:
-        notifications.send_email(mail_settings["errors"]["subject"],
-                         validation_error_notification, 
-                         mail_settings["errors"]["recipients"],
-                         mail_settings["mail_server"]["address"],
-                         mail_settings["mail_server"]["port"],
-                         mail_settings["mail_server"]["user"],
-                         mail_settings["mail_server"]["password"],
-                         (log_file_name, ))
\ No newline at end of file
+    return notification
+
+# send notification with the validation errors of all sessions (called after the log file was closed)
+# results: validation errors returned by "process_session" for each session
+def finish(context, state, results):
+
+    mail_settings = state["mail_settings"]
+
+    # collect validation errors
+    validation_error_notification = "Attention: Errors were encountered while validating the downloaded session data.\nPlease check the attached log file for further details.\n\n"
+    send_validation_error_notification = False
+    for notification in results:
+        if notification != "":
+            send_validation_error_notification = True
+            validation_error_notification = validation_error_notification + notification
+
+    # send error notification
+    if mail_settings["errors"]["send_notification"] and send_validation_error_notification:
+            notifications.send_email(mail_settings["errors"]["subject"],
+                             validation_error_notification, 
+                             mail_settings["errors"]["recipients"],
+                             mail_settings["mail_server"]["address"],
+                             mail_settings["mail_server"]["port"],
+                             mail_settings["mail_server"]["user"],
+                             mail_settings["mail_server"]["password"],
+                             (log_file_name, ))
+
+# run data validation with summary with the given pipeline context (see "pipeline_context")
+def run(context):
+
+    # open log file
+    context.open_log_file(log_file_name, *log_title)
+
+    state = prepare(context)
+
+    # connect to database
+    db = context.get_db()
+    if db == -1: context.terminate_after_error()
+
+    # find sessions for which data is available and extracted and validated, but not validated with summary
+    # skip sessions that should be skipped
+    sessions_requiring_validation = db.find_mri_sessions_requiring_data_validation_with_summary(exclude_skipped=True)
+    if sessions_requiring_validation == -1: context.terminate_after_error()
+
+    results = []
+    for session in sessions_requiring_validation:
+        results.append(process_session(context, state, session))
+
+    # close log file
+    print("Validate data with summary complete")
+    context.close_log_file()
+
+    # send error notification
+    finish(context, state, results)
+
+if __name__ == "__main__":
+    pipeline_context.run_script("validate_data_with_summary.py", run)
@@ -10,60 +10,9 @@ cd $SCRIPT_DIR
 # activate virtual environment
 source .automated_pipeline_env/bin/activate
 
-# call python scripts using its dedicated venv
-echo "Started automated MRI pipeline"
-echo ""
-
-echo "Running CBI SYNC script ..."
-python3 code/mri_pipeline/cbi_sync.py
-echo "Done"
-
-echo "Running local sync script ..."
-python3 code/mri_pipeline/local_sync.py
-echo "Done"
-
-echo ""
-echo "Running data extraction script ..."
-python3 code/mri_pipeline/extract_data.py
-echo "Done"
-
-echo ""
-echo "Running data validation script ..."
-python3 code/mri_pipeline/validate_data.py
-echo "Done"
-
-echo ""
-echo "Running notification script ..."
-python3 code/mri_pipeline/send_validation_notifications.py
-echo "Done"
-
-echo ""
-echo "Running data validation with summary script ..."
-python3 code/mri_pipeline/validate_data_with_summary.py
-echo "Done"
-
-echo ""
-echo "Running data conversion script ..."
-python3 code/mri_pipeline/process_data.py
-echo "Done"
-
-echo ""
-echo "Running data upload script ..."
-python3 code/mri_pipeline/upload_data.py
-echo "Done"
-
-echo ""
-echo "Running data cleanup script ..."
-python3 code/mri_pipeline/cleanup_data.py
-echo "Done"
-
-echo ""
-echo "Running app backup script ..."
-python3 code/mri_pipeline/backup_application.py
-echo "Done"
-
-echo ""
-echo "MRI pipeline completed"
+# run all stages of the pipeline in one python process (see "code/mri_pipeline/run_pipeline.py")
+# each stage can also be run on its own by calling its script, e.g. "python3 code/mri_pipeline/cbi_sync.py"
+python3 code/mri_pipeline/run_pipeline.py
 
 # deactivate virtual environment
 deactivate